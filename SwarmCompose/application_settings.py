@@ -27,6 +27,43 @@ DATABASES = {
     }
 }
 
+SQLITE_PROFILE = os.environ.get("SWARM_COMPOSE_SQLITE_PROFILE", "default").lower()
+"""
+Which connection settings to use when the database is SQLite. 'default' leaves SQLite as Django configures it while
+'tuned' switches to WAL journaling, the pragmas in `SQLITE_PRAGMAS`, and transactions that take their write lock up
+front
+"""
+
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("SWARM_COMPOSE_SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SWARM_COMPOSE_SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.environ.get("SWARM_COMPOSE_SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    "cache_size": int(os.environ.get("SWARM_COMPOSE_SQLITE_CACHE_SIZE", -64 * 1024)),
+    "busy_timeout": int(os.environ.get("SWARM_COMPOSE_SQLITE_BUSY_TIMEOUT", 5000)),
+    "temp_store": os.environ.get("SWARM_COMPOSE_SQLITE_TEMP_STORE", "MEMORY"),
+}
+"""
+Pragmas set on every connection by the tuned SQLite profile. `mmap_size` is in bytes, a negative `cache_size` is in
+kibibytes, and `busy_timeout` is the number of milliseconds to wait for a lock before giving up
+"""
+
+SQLITE_TRANSACTION_MODE = os.environ.get("SWARM_COMPOSE_SQLITE_TRANSACTION_MODE", "IMMEDIATE")
+"""How the tuned SQLite profile begins transactions: 'DEFERRED', 'IMMEDIATE', or 'EXCLUSIVE'"""
+
+SQLITE_OPTIMIZE_INTERVAL = float(os.environ.get("SWARM_COMPOSE_SQLITE_OPTIMIZE_INTERVAL", 60 * 60))
+"""The number of seconds between runs of `PRAGMA optimize` on long lived SQLite connections"""
+
+TUNED_SQLITE_ENGINE = "SwarmCompose.backends.sqlite3"
+TUNED_SQLITE_OPTIONS = {
+    "pragmas": SQLITE_PRAGMAS,
+    "transaction_mode": SQLITE_TRANSACTION_MODE,
+    "optimize_interval": SQLITE_OPTIMIZE_INTERVAL,
+}
+
+if SQLITE_PROFILE == "tuned" and DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default']['ENGINE'] = TUNED_SQLITE_ENGINE
+    DATABASES['default']['OPTIONS'] = TUNED_SQLITE_OPTIONS
+
 DEBUG = utils.is_true(
     os.environ.get(
         'DEBUG_SWARM_COMPOSE',
@@ -42,3 +79,70 @@ TIME_ZONE = os.environ.get(
 
 DATETIME_FORMAT = '%Y-%m-%d %H:%M%z'
 
+JOB_WORKERS = int(os.environ.get("SWARM_COMPOSE_JOB_WORKERS", 2))
+"""The number of threads that `manage.py run_job_workers` will start by default"""
+
+JOB_POLL_INTERVAL = float(os.environ.get("SWARM_COMPOSE_JOB_POLL_INTERVAL", 1.0))
+"""The number of seconds an idle job worker will wait before checking the queue again"""
+
+WEB_JOB_TYPES = [
+    name.strip()
+    for name in os.environ.get("SWARM_COMPOSE_WEB_JOB_TYPES", "validate_stacks,rebuild_search_index").split(",")
+    if name.strip()
+]
+"""The types of jobs that may be enqueued through the API, separated by commas in the environment variable"""
+
+API_TOKEN = os.environ.get("SWARM_COMPOSE_API_TOKEN") or None
+"""
+A secret that API clients may send as `Authorization: Bearer <token>` to change data. Without it, only the sessions
+of signed in staff members may change data
+"""
+
+VALIDATE_RENDERED_OUTPUT = utils.is_true(os.environ.get("SWARM_COMPOSE_VALIDATE_OUTPUT", True))
+"""Whether rendered compose documents should be checked against the compose specification"""
+
+METRICS_ENABLED = utils.is_true(os.environ.get("SWARM_COMPOSE_METRICS", False))
+"""Whether hot path timings and counters should be recorded and served from the /metrics endpoint"""
+
+QUERY_COUNT_HEADER = utils.is_true(os.environ.get("SWARM_COMPOSE_QUERY_COUNT_HEADER", False))
+"""Whether responses should report how many database queries were issued to produce them in an X-DB-Queries header"""
+
+SOFT_DELETE = utils.is_true(os.environ.get("SWARM_COMPOSE_SOFT_DELETE", False))
+"""Whether deleted stacks, services, and networks should be marked and purged in the background by default"""
+
+SOFT_DELETE_RETENTION = float(os.environ.get("SWARM_COMPOSE_SOFT_DELETE_RETENTION", 0))
+"""The number of seconds to keep soft deleted rows before they may be purged"""
+
+SEARCH_TEXT_CONFIG = os.environ.get("SWARM_COMPOSE_SEARCH_TEXT_CONFIG", "simple")
+"""
+The Postgres text search configuration used to build the search index. 'simple' leaves words unstemmed, which suits
+image names, file names, and labels better than a language specific configuration
+"""
+
+JSON_ENCODER = os.environ.get("SWARM_COMPOSE_JSON_ENCODER", "json")
+"""
+The encoder used to write JSON exports, like 'json' or 'orjson'. The standard library's 'json' writes the same bytes
+wherever it runs. 'auto' picks the fastest installed encoder that matches it on a probe document, which may spell some
+values, like floats with exponents, differently
+"""
+
+YAML_ENCODER = os.environ.get("SWARM_COMPOSE_YAML_ENCODER", "yaml")
+"""
+The encoder used to write YAML exports, like 'yaml' or 'yaml-c'. PyYAML's pure Python 'yaml' writes the same bytes
+wherever it runs. 'auto' picks the fastest installed encoder that matches it on a probe document
+"""
+
+CHANGE_FEED_POLL_INTERVAL = float(os.environ.get("SWARM_COMPOSE_CHANGE_FEED_POLL_INTERVAL", 0.5))
+"""The number of seconds a reader waiting on the change feed will wait before checking for new events again"""
+
+CHANGE_FEED_MAX_WAIT = float(os.environ.get("SWARM_COMPOSE_CHANGE_FEED_MAX_WAIT", 30))
+"""The most seconds that a long polling read of the change feed may wait for new events"""
+
+CHANGE_FEED_STREAM_DURATION = float(os.environ.get("SWARM_COMPOSE_CHANGE_FEED_STREAM_DURATION", 300))
+"""
+The number of seconds that an event stream of the change feed stays open. Clients reconnect with the `Last-Event-ID`
+header to carry on where they left off
+"""
+
+CHANGE_FEED_KEEPALIVE = float(os.environ.get("SWARM_COMPOSE_CHANGE_FEED_KEEPALIVE", 15))
+"""The number of seconds an idle event stream of the change feed waits before sending a comment to keep it open"""
@@ -0,0 +1,3 @@
+"""
+Database backends tuned for the way SwarmCompose uses its database
+"""
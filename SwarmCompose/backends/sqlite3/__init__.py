@@ -0,0 +1,3 @@
+"""
+A SQLite backend that tunes each connection for many concurrent readers alongside a few writers
+"""
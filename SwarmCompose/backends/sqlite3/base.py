@@ -0,0 +1,122 @@
+"""
+Django's SQLite backend, with pragmas applied to every new connection and write locks taken at the start of transactions
+
+Configured through the database's `OPTIONS`:
+
+    pragmas
+        Pragma names mapped to the values to set when a connection opens, like `{"journal_mode": "WAL"}`. Values have
+        to be integers or single keywords, since pragmas can't take query parameters and are written into the
+        statement as they are
+    transaction_mode
+        How `atomic` blocks begin their transactions: 'DEFERRED', 'IMMEDIATE', or 'EXCLUSIVE'. A deferred transaction
+        that reads before it writes has to upgrade its lock midway, and SQLite fails that upgrade with
+        "database is locked" right away, without waiting out `busy_timeout`, whenever another connection is writing.
+        Taking the write lock up front lets the wait happen where SQLite is able to wait
+    optimize_interval
+        The number of seconds between runs of `PRAGMA optimize` on a connection that stays open. It is also run
+        whenever a connection closes
+"""
+from __future__ import annotations
+
+import re
+import time
+import typing
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+TRANSACTION_MODES = ("DEFERRED", "IMMEDIATE", "EXCLUSIVE")
+"""The ways that SQLite may begin a transaction"""
+
+CUSTOM_OPTIONS = ("pragmas", "transaction_mode", "optimize_interval")
+"""Options understood by this backend that must not be passed along to `sqlite3.connect`"""
+
+PRAGMA_NAME_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+"""What the name of a pragma looks like"""
+
+PRAGMA_VALUE_PATTERN = re.compile(r"[+-]?[0-9]+|[A-Za-z_][A-Za-z0-9_]*")
+"""What a pragma value may look like: an integer or a single keyword, like 'WAL' or 'NORMAL'"""
+
+
+def _check_pragma(pragma: str, value: typing.Union[str, int]) -> typing.Union[str, int]:
+    """
+    :param pragma: The name of a pragma to set
+    :param value: What to set the pragma to
+    :return: The value, if it is safe to write into a `PRAGMA` statement
+    :raises ImproperlyConfigured: If the name or value could be anything other than a single name or value
+    """
+    if not isinstance(pragma, str) or not PRAGMA_NAME_PATTERN.fullmatch(pragma):
+        raise ImproperlyConfigured(f"'{pragma}' is not a valid SQLite pragma name")
+
+    if isinstance(value, bool) or not isinstance(value, (str, int)) or not PRAGMA_VALUE_PATTERN.fullmatch(str(value)):
+        raise ImproperlyConfigured(
+            f"'{value}' is not a valid value for the SQLite pragma '{pragma}'. Use an integer or a single keyword"
+        )
+
+    return value
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        options = self.settings_dict["OPTIONS"]
+
+        self.pragmas: typing.Dict[str, typing.Union[str, int]] = {
+            pragma: _check_pragma(pragma, value) for pragma, value in (options.get("pragmas") or {}).items()
+        }
+        self.transaction_mode: typing.Optional[str] = options.get("transaction_mode")
+        self.optimize_interval: typing.Optional[float] = options.get("optimize_interval")
+        self._last_optimized = 0.0
+
+        if self.transaction_mode is not None:
+            self.transaction_mode = self.transaction_mode.upper()
+            if self.transaction_mode not in TRANSACTION_MODES:
+                raise ImproperlyConfigured(
+                    f"'{self.transaction_mode}' is not a valid SQLite transaction mode. "
+                    f"Use one of: {', '.join(TRANSACTION_MODES)}"
+                )
+
+    def get_connection_params(self):
+        connection_parameters = super().get_connection_params()
+        for option in CUSTOM_OPTIONS:
+            connection_parameters.pop(option, None)
+        return connection_parameters
+
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+
+        for pragma, value in self.pragmas.items():
+            connection.execute(f"PRAGMA {pragma} = {value}")
+
+        self._last_optimized = time.monotonic()
+        return connection
+
+    def create_cursor(self, name=None):
+        # Connections held open by job workers or persistent connections never reach `_close`, so they have to
+        # refresh the query planner's statistics as they go. This is only safe between transactions
+        if self.optimize_interval and not self.in_atomic_block:
+            if time.monotonic() - self._last_optimized >= self.optimize_interval:
+                self.optimize()
+        return super().create_cursor(name)
+
+    def optimize(self):
+        """
+        Let SQLite refresh the statistics its query planner relies on for any tables that need them
+        """
+        self._last_optimized = time.monotonic()
+        self.connection.execute("PRAGMA optimize")
+
+    def _start_transaction_under_autocommit(self):
+        if self.transaction_mode is None:
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute(f"BEGIN {self.transaction_mode}")
+
+    def _close(self):
+        if self.connection is not None and not self.in_atomic_block:
+            try:
+                self.optimize()
+            except base.Database.Error:
+                # A connection that is being thrown away because it broke shouldn't fail to close
+                pass
+        return super()._close()
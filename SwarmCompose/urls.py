@@ -15,8 +15,13 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
+from django.urls import include
 from django.urls import path
 
+from builder import views as builder_views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('builder/', include('builder.urls')),
+    path('metrics', builder_views.metrics, name="metrics"),
 ]
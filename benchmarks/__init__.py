@@ -0,0 +1,5 @@
+"""
+Benchmarks for measuring how SwarmCompose performs against a synthetic corpus of compose documents
+
+Each benchmark may be run as a module from the root of the repository, e.g. `python -m benchmarks.validation`
+"""
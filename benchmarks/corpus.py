@@ -0,0 +1,181 @@
+"""
+Generates a deterministic, synthetic corpus of compose documents shaped like those that stacks render
+"""
+from __future__ import annotations
+
+import random
+import typing
+
+CORPUS_SIZES: typing.Sequence[int] = (10, 100, 1000)
+"""The number of services in each document of the default corpus"""
+
+DEPENDENCY_CONDITIONS = ("service_started", "service_healthy", "service_completed_successfully")
+
+
+def generate_network(generator: random.Random, index: int) -> typing.Dict[str, typing.Any]:
+    """
+    :param generator: The source of randomness
+    :param index: The position of the network within its document
+    :return: A network fragment
+    """
+    network: typing.Dict[str, typing.Any] = {
+        "name": f"network-{index}",
+        "driver": generator.choice(["bridge", "overlay"]),
+    }
+
+    if generator.random() < 0.5:
+        network["attachable"] = True
+
+    network["labels"] = {
+        f"com.example.network.label-{label}": f"value-{generator.randrange(1000)}"
+        for label in range(generator.randrange(4))
+    }
+
+    if generator.random() < 0.5:
+        network["ipam"] = {
+            "driver": "default",
+            "config": [
+                {
+                    "subnet": f"10.{index % 256}.{config}.0/24",
+                    "gateway": f"10.{index % 256}.{config}.1",
+                    "aux_addresses": {
+                        f"host-{address}": f"10.{index % 256}.{config}.{address + 2}"
+                        for address in range(generator.randrange(3))
+                    }
+                }
+                for config in range(generator.randrange(1, 3))
+            ]
+        }
+
+    return network
+
+
+def generate_service(
+    generator: random.Random,
+    index: int,
+    network_names: typing.Sequence[str]
+) -> typing.Dict[str, typing.Any]:
+    """
+    :param generator: The source of randomness
+    :param index: The position of the service within its document
+    :param network_names: The names of networks that the service may attach to
+    :return: A service fragment
+    """
+    service: typing.Dict[str, typing.Any] = {}
+
+    if generator.random() < 0.2:
+        service["build"] = "."
+    else:
+        service["build"] = {
+            "context": f"./service-{index}",
+            "dockerfile": generator.choice(["Dockerfile", "Dockerfile-dev", "Dockerfile-web"]),
+            "target": generator.choice(["build", "runtime", "test"]),
+            "args": {
+                f"ARG_{arg}": f"value-{generator.randrange(1000)}"
+                for arg in range(generator.randrange(6))
+            },
+            "labels": {
+                f"com.example.team-{label}": generator.choice(["payments", "search", "platform", "web"])
+                for label in range(generator.randrange(6))
+            },
+            "secrets": [
+                generator.choice([
+                    f"secret-{generator.randrange(20)}",
+                    {"source": f"secret-{generator.randrange(20)}", "target": "token", "mode": "0440"}
+                ])
+                for _ in range(generator.randrange(3))
+            ],
+            "tags": [f"registry.example.com/service-{index}:{tag}" for tag in range(generator.randrange(3))],
+        }
+
+    service["command"] = f"python -m service_{index} --port {8000 + index}"
+
+    if generator.random() < 0.3:
+        service["container_name"] = f"service-{index}"
+
+    if generator.random() < 0.5:
+        service["cpu_count"] = generator.randrange(1, 8)
+
+    service["annotations"] = {
+        f"com.example.annotation-{annotation}": f"value-{generator.randrange(1000)}"
+        for annotation in range(generator.randrange(4))
+    }
+
+    if index > 0 and generator.random() < 0.6:
+        service["depends_on"] = {
+            f"service-{dependency}": {"condition": generator.choice(DEPENDENCY_CONDITIONS)}
+            for dependency in generator.sample(range(index), min(index, generator.randrange(1, 4)))
+        }
+
+    if network_names:
+        service["networks"] = generator.sample(list(network_names), min(len(network_names), generator.randrange(1, 3)))
+
+    if generator.random() < 0.3:
+        service["deploy"] = {
+            "endpoint_mode": generator.choice(["vip", "dnsrr"]),
+            "labels": {"com.example.deployed-by": "swarm-compose"},
+        }
+
+    return service
+
+
+def generate_document(service_count: int, seed: int = 0) -> typing.Dict[str, typing.Any]:
+    """
+    Create a compose document with the given number of services
+
+    :param service_count: The number of services to put in the document
+    :param seed: The seed for the random number generator. The same seed always produces the same document
+    :return: A compose document
+    """
+    generator = random.Random(f"{seed}:{service_count}")
+    network_count = max(service_count // 10, 1)
+
+    networks = {
+        f"network-{index}": generate_network(generator, index)
+        for index in range(network_count)
+    }
+
+    return {
+        "services": {
+            f"service-{index}": generate_service(generator, index, list(networks))
+            for index in range(service_count)
+        },
+        "networks": networks,
+    }
+
+
+def generate_corpus(
+    sizes: typing.Sequence[int] = CORPUS_SIZES,
+    seed: int = 0
+) -> typing.Dict[int, typing.Dict[str, typing.Any]]:
+    """
+    :param sizes: The number of services in each document
+    :param seed: The seed for the random number generator
+    :return: A compose document for each requested size
+    """
+    return {size: generate_document(size, seed=seed) for size in sizes}
+
+
+def mutate_document(
+    document: typing.Dict[str, typing.Any],
+    fraction: float,
+    seed: int = 0
+) -> typing.Dict[str, typing.Any]:
+    """
+    Create a copy of a document where a fraction of its services have been edited
+
+    :param document: The document to copy
+    :param fraction: The fraction of services to edit, from 0 to 1
+    :param seed: The seed for the random number generator
+    :return: The edited copy
+    """
+    generator = random.Random(seed)
+    services = dict(document["services"])
+    edited_count = int(len(services) * fraction)
+
+    for name in generator.sample(sorted(services), edited_count):
+        service = dict(services[name])
+        service["command"] = f"{service.get('command', '')} --revision {generator.randrange(1_000_000)}"
+        services[name] = service
+
+    return dict(document, services=services)
@@ -0,0 +1,293 @@
+"""
+Loads stacks generated by `benchmarks.corpus` into the database so that the web and API layers have realistic data
+
+Every table is written with a single `bulk_create` (split into batches), so even stacks with tens of thousands of
+services load in seconds. Run with `python -m benchmarks.fixtures --stacks 3 --services 1000` to fill the configured
+database.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import time
+import typing
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "SwarmCompose.settings")
+
+from benchmarks import corpus
+
+BATCH_SIZE = 500
+"""The maximum number of rows to insert with a single statement"""
+
+SECRET_COUNT = 20
+"""The number of secrets declared in each stack. Generated builds refer to secrets named 'secret-0' to 'secret-19'"""
+
+
+def _bulk_create(model, instances: typing.Sequence, stack_id: int) -> typing.Sequence:
+    """
+    Insert rows and record their creation, since rows inserted in bulk don't send signals
+
+    :param model: The type of rows to insert
+    :param instances: The unsaved rows
+    :param stack_id: The primary key of the stack that every row belongs to
+    :return: The saved rows, with their primary keys
+    """
+    from builder import changes
+
+    if not instances:
+        return instances
+
+    created = model.objects.bulk_create(instances, batch_size=BATCH_SIZE)
+    changes.record_created(created, stack_id=stack_id)
+    return created
+
+
+def _load_networks(stack, networks: typing.Mapping[str, typing.Dict[str, typing.Any]]) -> typing.Dict[str, int]:
+    """
+    :param stack: The stack that the networks belong to
+    :param networks: Network fragments keyed by name
+    :return: The primary key of each new network keyed by its name
+    """
+    from builder.models import IPAddressManagementConfig
+    from builder.models import IPAMAuxilaryAddresses
+    from builder.models import Network
+    from builder.models import NetworkLabel
+
+    fragments = list(networks.values())
+    created = _bulk_create(Network, [
+        Network(
+            stack=stack,
+            name=fragment["name"],
+            driver=fragment.get("driver"),
+            attachable=fragment.get("attachable", False)
+        )
+        for fragment in fragments
+    ], stack_id=stack.pk)
+
+    _bulk_create(NetworkLabel, [
+        NetworkLabel(network=network, key=key, label=label)
+        for network, fragment in zip(created, fragments)
+        for key, label in fragment.get("labels", {}).items()
+    ], stack_id=stack.pk)
+
+    ipam_fragments = [
+        (network, fragment["ipam"].get("driver"), config)
+        for network, fragment in zip(created, fragments)
+        if "ipam" in fragment
+        for config in fragment["ipam"].get("config", [])
+    ]
+    ipam_configs = _bulk_create(IPAddressManagementConfig, [
+        IPAddressManagementConfig(network=network, driver=driver, subnet=config["subnet"], gateway=config["gateway"])
+        for network, driver, config in ipam_fragments
+    ], stack_id=stack.pk)
+    _bulk_create(IPAMAuxilaryAddresses, [
+        IPAMAuxilaryAddresses(ipam=ipam_config, address_name=name, address=address)
+        for ipam_config, (_, _, config) in zip(ipam_configs, ipam_fragments)
+        for name, address in config.get("aux_addresses", {}).items()
+    ], stack_id=stack.pk)
+
+    return {network.name: network.pk for network in created}
+
+
+def _get_secret_fields(secret: typing.Union[str, typing.Dict[str, typing.Any]]) -> typing.Dict[str, typing.Any]:
+    """
+    :param secret: Either the name of a secret or its long form
+    :return: The fields for a used secret
+    """
+    if isinstance(secret, str):
+        return {"source": secret}
+    return {key: value for key, value in secret.items() if key in ("source", "target", "uid", "gid", "mode")}
+
+
+def _load_builds(stack, services: typing.Sequence, fragments: typing.Sequence[typing.Dict[str, typing.Any]]):
+    """
+    :param stack: The stack that the services belong to
+    :param services: Saved services
+    :param fragments: The service fragments that the services were made from, in the same order
+    :return: The primary keys of the new build secrets
+    """
+    from builder.models import BuildArg
+    from builder.models import BuildConfiguration
+    from builder.models import BuildSecret
+    from builder.models import ImageLabel
+    from builder.models import ImageTags
+
+    builds = [
+        (service, {"context": fragment["build"]} if isinstance(fragment["build"], str) else fragment["build"])
+        for service, fragment in zip(services, fragments)
+        if "build" in fragment
+    ]
+    configurations = _bulk_create(BuildConfiguration, [
+        BuildConfiguration(
+            service=service,
+            context=build.get("context", "."),
+            dockerfile=build.get("dockerfile"),
+            target=build.get("target")
+        )
+        for service, build in builds
+    ], stack_id=stack.pk)
+    pairs = [(configuration, build) for configuration, (_, build) in zip(configurations, builds)]
+
+    _bulk_create(BuildArg, [
+        BuildArg(build_configuration=configuration, key=key, value=value)
+        for configuration, build in pairs
+        for key, value in build.get("args", {}).items()
+    ], stack_id=stack.pk)
+    _bulk_create(ImageLabel, [
+        ImageLabel(build_configuration=configuration, key=key, value=value)
+        for configuration, build in pairs
+        for key, value in build.get("labels", {}).items()
+    ], stack_id=stack.pk)
+    _bulk_create(ImageTags, [
+        ImageTags(build_configuration=configuration, value=tag)
+        for configuration, build in pairs
+        for tag in build.get("tags", [])
+    ], stack_id=stack.pk)
+    secrets = _bulk_create(BuildSecret, [
+        BuildSecret(build_configuration=configuration, **_get_secret_fields(secret))
+        for configuration, build in pairs
+        for secret in build.get("secrets", [])
+    ], stack_id=stack.pk)
+
+    return [secret.pk for secret in secrets]
+
+
+def load_document(document: typing.Dict[str, typing.Any], name: str):
+    """
+    Create a stack from a compose document generated by `benchmarks.corpus`
+
+    :param document: The compose document to load
+    :param name: The name of the new stack
+    :return: The new stack
+    """
+    from django.db import transaction
+
+    from builder import overlays
+    from builder import search
+    from builder import secret_usage
+    from builder.models import Deploy
+    from builder.models import DeployLabel
+    from builder.models import Secret
+    from builder.models import Service
+    from builder.models import ServiceAnnotation
+    from builder.models import ServiceDependency
+    from builder.models import Stack
+
+    with transaction.atomic():
+        stack = Stack.objects.create(name=name, description=f"{len(document['services'])} generated services")
+        _bulk_create(Secret, [
+            Secret(stack=stack, name=f"secret-{index}", file=f"./secrets/secret-{index}.txt")
+            for index in range(SECRET_COUNT)
+        ], stack_id=stack.pk)
+        network_ids = _load_networks(stack, document.get("networks", {}))
+
+        names = list(document["services"])
+        fragments = [document["services"][service_name] for service_name in names]
+        services = _bulk_create(Service, [
+            Service(
+                stack=stack,
+                name=service_name,
+                command=fragment.get("command"),
+                container_name=fragment.get("container_name"),
+                cpu_count=fragment.get("cpu_count")
+            )
+            for service_name, fragment in zip(names, fragments)
+        ], stack_id=stack.pk)
+        pairs = list(zip(services, fragments))
+
+        Service.networks.through.objects.bulk_create(
+            [
+                Service.networks.through(service_id=service.pk, network_id=network_ids[network_name])
+                for service, fragment in pairs
+                for network_name in fragment.get("networks", [])
+            ],
+            batch_size=BATCH_SIZE
+        )
+        _bulk_create(ServiceAnnotation, [
+            ServiceAnnotation(service=service, key=key, value=value)
+            for service, fragment in pairs
+            for key, value in fragment.get("annotations", {}).items()
+        ], stack_id=stack.pk)
+        _bulk_create(ServiceDependency, [
+            ServiceDependency(service=service, name=dependency, condition=options.get("condition"))
+            for service, fragment in pairs
+            for dependency, options in fragment.get("depends_on", {}).items()
+        ], stack_id=stack.pk)
+
+        deploys = [(service, fragment["deploy"]) for service, fragment in pairs if "deploy" in fragment]
+        created_deploys = _bulk_create(Deploy, [
+            Deploy(service=service, endpoint_mode=deploy.get("endpoint_mode"))
+            for service, deploy in deploys
+        ], stack_id=stack.pk)
+        _bulk_create(DeployLabel, [
+            DeployLabel(deploy=created, key=key, value=value)
+            for created, (_, deploy) in zip(created_deploys, deploys)
+            for key, value in deploy.get("labels", {}).items()
+        ], stack_id=stack.pk)
+
+        build_secret_ids = _load_builds(stack, services, fragments)
+
+        # Rows inserted in bulk don't send signals, so the new services have to be indexed and the stack given a new
+        # revision here
+        search.schedule_indexing([service.pk for service in services])
+        overlays.touch_stacks(Stack.objects.filter(pk=stack.pk))
+        secret_usage.index_build_secrets(build_secret_ids)
+
+    return stack
+
+
+def load_stacks(stacks: int, services: int, seed: int = 0) -> typing.List[int]:
+    """
+    Create tables and the search index if they don't exist yet, then fill them with generated stacks
+
+    :param stacks: The number of stacks to create
+    :param services: The number of services within each stack
+    :param seed: The seed for the first stack's document. Each following stack uses the next seed
+    :return: The primary keys of the new stacks
+    """
+    from django.apps import apps
+    from django.core.management import call_command
+    from django.db import connection
+
+    from builder import search
+
+    call_command("migrate", verbosity=0)
+
+    # Tables are created directly so that the fixtures don't depend on the state of the project's migrations
+    existing_tables = set(connection.introspection.table_names())
+    with connection.schema_editor() as editor:
+        for model in apps.get_app_config("builder").get_models():
+            if model._meta.db_table not in existing_tables:
+                editor.create_model(model)
+
+    # `migrate` installs the search index after it creates tables. Tables created here would otherwise be written
+    # without the index's triggers, which would make writes look cheaper than they are
+    search.install_index()
+
+    return [
+        load_document(corpus.generate_document(services, seed=seed + index), name=f"stack-{seed + index}").pk
+        for index in range(stacks)
+    ]
+
+
+def main():
+    import django
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--stacks", type=int, default=1, help="The number of stacks to create")
+    parser.add_argument("--services", type=int, default=1000, help="The number of services within each stack")
+    parser.add_argument("--seed", type=int, default=0, help="The seed for the generated documents")
+    arguments = parser.parse_args()
+
+    django.setup()
+
+    start = time.perf_counter()
+    stack_ids = load_stacks(stacks=arguments.stacks, services=arguments.services, seed=arguments.seed)
+    print(
+        f"Loaded {len(stack_ids)} stacks of {arguments.services} services in {time.perf_counter() - start:.1f}s: "
+        f"{', '.join(f'#{stack_id}' for stack_id in stack_ids)}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+"""
+Drives the web and API layer through real WSGI and ASGI servers at several levels of concurrency
+
+A new database file is filled with generated stacks, then each available server is started against it in its own
+process and every workload is run against it from client threads that each hold their own keep-alive connection.
+Throughput, latency percentiles, failed requests, and the database queries per request (read from the `X-DB-Queries`
+header) are reported for each combination. Run with `python -m benchmarks.load_test`
+"""
+from __future__ import annotations
+
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+"""The directory holding manage.py"""
+
+WORKLOADS: typing.Sequence[str] = ("list", "detail", "export", "edit")
+"""The kinds of requests that may be sent, in the order they are run"""
+
+CONCURRENCY_LEVELS: typing.Sequence[int] = (1, 8, 32)
+"""The number of client threads to send requests with by default"""
+
+STARTUP_TIMEOUT = 30.0
+"""How many seconds to wait for a server to start answering requests"""
+
+REQUEST = typing.Tuple[str, str, typing.Optional[bytes]]
+"""The method, path, and body of a request"""
+
+
+def get_environment(database: Path) -> typing.Dict[str, str]:
+    """
+    :param database: The path of the database file to serve
+    :return: The environment variables that the harness and every server should run with
+    """
+    environment = dict(os.environ)
+    environment.update({
+        "DJANGO_SETTINGS_MODULE": "SwarmCompose.settings",
+        "SWARM_COMPOSE_SQL_DATABASE": str(database),
+        "SWARM_COMPOSE_SQLITE_PROFILE": environment.get("SWARM_COMPOSE_SQLITE_PROFILE", "tuned"),
+        "DEBUG_SWARM_COMPOSE": "false",
+        "SWARM_COMPOSE_QUERY_COUNT_HEADER": "true",
+        # The edit workload changes services, which takes the API token
+        "SWARM_COMPOSE_API_TOKEN": environment.get("SWARM_COMPOSE_API_TOKEN") or secrets.token_urlsafe(32),
+    })
+    return environment
+
+
+def get_servers(port: int, workers: int, threads: int) -> typing.Dict[str, typing.Tuple[str, typing.List[str]]]:
+    """
+    :param port: The port that the server should listen on
+    :param workers: The number of worker processes for servers that support them
+    :param threads: The number of threads within each worker for servers that support them
+    :return: The name of each server mapped to the module it needs and the command that starts it
+    """
+    address = "127.0.0.1"
+    return {
+        "gunicorn (wsgi)": (
+            "gunicorn",
+            [
+                sys.executable, "-m", "gunicorn", "SwarmCompose.wsgi:application",
+                "--bind", f"{address}:{port}",
+                "--worker-class", "gthread",
+                "--workers", str(workers),
+                "--threads", str(threads),
+                "--log-level", "warning",
+            ]
+        ),
+        "runserver (wsgi)": (
+            "django",
+            [sys.executable, "manage.py", "runserver", "--noreload", f"{address}:{port}"]
+        ),
+        "uvicorn (asgi)": (
+            "uvicorn",
+            [
+                sys.executable, "-m", "uvicorn", "SwarmCompose.asgi:application",
+                "--host", address,
+                "--port", str(port),
+                "--workers", str(workers),
+                "--no-access-log",
+                "--log-level", "warning",
+            ]
+        ),
+    }
+
+
+def _get_free_port() -> int:
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        return listener.getsockname()[1]
+
+
+def _seed(stacks: int, services: int) -> typing.Tuple[typing.List[int], typing.List[int]]:
+    """
+    Fill the configured database with generated stacks
+
+    :return: The primary keys of the new stacks and of the services within them
+    """
+    import django
+
+    django.setup()
+
+    from django.db import connection
+
+    from benchmarks import fixtures
+    from builder.models import Service
+
+    stack_ids = fixtures.load_stacks(stacks=stacks, services=services)
+    service_ids = list(Service.objects.filter(stack_id__in=stack_ids).values_list("pk", flat=True))
+    connection.close()
+    return stack_ids, service_ids
+
+
+class Outcome:
+    """
+    What a workload achieved against a server over the course of a run
+    """
+    def __init__(self):
+        self.timings: typing.List[float] = []
+        self.queries = 0
+        self.errors = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, timings: typing.Sequence[float], queries: int, errors: int):
+        with self._lock:
+            self.timings.extend(timings)
+            self.queries += queries
+            self.errors += errors
+
+    def percentile(self, fraction: float) -> float:
+        """
+        :param fraction: How far into the sorted timings to look, like 0.95
+        :return: The timing, in milliseconds, at that point
+        """
+        if not self.timings:
+            return float("nan")
+        ordered = sorted(self.timings)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000
+
+    @property
+    def throughput(self) -> float:
+        """
+        The successful requests per second, measured until the last request in flight finished
+        """
+        return len(self.timings) / self.elapsed if self.elapsed else float("nan")
+
+    @property
+    def queries_per_request(self) -> float:
+        return self.queries / len(self.timings) if self.timings else float("nan")
+
+
+def get_request(
+    workload: str,
+    generator: random.Random,
+    stack_ids: typing.Sequence[int],
+    service_ids: typing.Sequence[int]
+) -> REQUEST:
+    """
+    :param workload: The kind of request to build
+    :param generator: The source of randomness
+    :param stack_ids: The stacks that may be read
+    :param service_ids: The services that may be read or edited
+    :return: The next request to send
+    """
+    if workload == "list":
+        return "GET", f"/builder/stacks/?page={generator.randrange(1, max(len(stack_ids) // 25, 1) + 1)}", None
+    if workload == "detail":
+        return "GET", f"/builder/services/{generator.choice(service_ids)}/", None
+    if workload == "export":
+        return "GET", f"/builder/stacks/{generator.choice(stack_ids)}/export/", None
+    if workload == "edit":
+        body = json.dumps({"command": f"python -m app --edit {generator.randrange(1_000_000)}"}).encode()
+        return "PATCH", f"/builder/services/{generator.choice(service_ids)}/", body
+    raise ValueError(f"'{workload}' is not a workload. Use one of: {', '.join(WORKLOADS)}")
+
+
+def _send(connection: http.client.HTTPConnection, request: REQUEST) -> typing.Tuple[int, int]:
+    """
+    :return: The status of the response and the number of database queries that it reported
+    """
+    method, path, body = request
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    if method != "GET":
+        headers["Authorization"] = f"Bearer {os.environ['SWARM_COMPOSE_API_TOKEN']}"
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    response.read()
+    return response.status, int(response.getheader("X-DB-Queries", 0))
+
+
+def _work(
+    port: int,
+    workload: str,
+    stack_ids: typing.Sequence[int],
+    service_ids: typing.Sequence[int],
+    outcome: Outcome,
+    deadline: float,
+    seed: int
+):
+    generator = random.Random(seed)
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    timings: typing.List[float] = []
+    queries = 0
+    errors = 0
+
+    try:
+        while time.perf_counter() < deadline:
+            request = get_request(workload, generator, stack_ids, service_ids)
+            start = time.perf_counter()
+            try:
+                status, request_queries = _send(connection, request)
+            except (OSError, http.client.HTTPException):
+                # The connection can't be trusted after a failure, so the next request gets a new one
+                connection.close()
+                errors += 1
+                continue
+
+            if status >= 400:
+                errors += 1
+            else:
+                timings.append(time.perf_counter() - start)
+                queries += request_queries
+    finally:
+        connection.close()
+        outcome.record(timings, queries, errors)
+
+
+def run_workload(
+    port: int,
+    workload: str,
+    concurrency: int,
+    stack_ids: typing.Sequence[int],
+    service_ids: typing.Sequence[int],
+    duration: float
+) -> Outcome:
+    """
+    :return: What the client threads achieved
+    """
+    outcome = Outcome()
+    start = time.perf_counter()
+    deadline = start + duration
+    threads = [
+        threading.Thread(target=_work, args=(port, workload, stack_ids, service_ids, outcome, deadline, index))
+        for index in range(concurrency)
+    ]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    outcome.elapsed = time.perf_counter() - start
+    return outcome
+
+
+def _wait_until_ready(server: subprocess.Popen, port: int):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"The server stopped before it was ready, with exit code {server.returncode}")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", "/builder/stacks/")
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"The server did not answer within {STARTUP_TIMEOUT:.0f}s")
+
+
+def run(
+    stacks: int,
+    services: int,
+    servers: typing.Sequence[str],
+    workloads: typing.Sequence[str],
+    concurrency_levels: typing.Sequence[int],
+    duration: float,
+    workers: int,
+    threads: int
+):
+    with tempfile.TemporaryDirectory() as directory:
+        environment = get_environment(Path(directory) / "load_test.sqlite3")
+        # Settings are read from the environment when Django starts, so the harness has to see the same values as the
+        # servers it launches
+        os.environ.update(environment)
+
+        start = time.perf_counter()
+        stack_ids, service_ids = _seed(stacks=stacks, services=services)
+        print(f"Loaded {stacks} stacks of {services} services in {time.perf_counter() - start:.1f}s")
+        print(f"{duration:.0f}s per run, {workers} workers and {threads} threads per worker where supported")
+        print()
+        print(
+            f"{'server':>16} | {'workload':>8} | {'clients':>7} | {'req/s':>8} | {'p50':>9} | {'p95':>9} | "
+            f"{'p99':>9} | {'errors':>6} | {'queries':>7}"
+        )
+        print("-" * 103)
+
+        port = _get_free_port()
+        available_servers = get_servers(port, workers=workers, threads=threads)
+
+        for name in servers:
+            module, command = available_servers[name]
+            if importlib.util.find_spec(module) is None:
+                print(f"{name:>16} | skipped because '{module}' is not installed")
+                continue
+
+            server = subprocess.Popen(
+                command,
+                cwd=ROOT,
+                env=environment,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+            try:
+                _wait_until_ready(server, port)
+                for workload in workloads:
+                    for concurrency in concurrency_levels:
+                        outcome = run_workload(
+                            port,
+                            workload,
+                            concurrency,
+                            stack_ids=stack_ids,
+                            service_ids=service_ids,
+                            duration=duration
+                        )
+                        print(
+                            f"{name:>16} | {workload:>8} | {concurrency:>7} | {outcome.throughput:>8.1f} | "
+                            f"{outcome.percentile(0.5):>7.1f}ms | {outcome.percentile(0.95):>7.1f}ms | "
+                            f"{outcome.percentile(0.99):>7.1f}ms | {outcome.errors:>6} | "
+                            f"{outcome.queries_per_request:>7.1f}"
+                        )
+            finally:
+                server.terminate()
+                server.wait()
+
+
+def main():
+    server_names = list(get_servers(0, workers=1, threads=1))
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--stacks", type=int, default=4, help="The number of stacks to generate")
+    parser.add_argument("--services", type=int, default=500, help="The number of services within each stack")
+    parser.add_argument(
+        "--servers",
+        nargs="+",
+        choices=server_names,
+        default=server_names,
+        help="The servers to run the workloads against"
+    )
+    parser.add_argument(
+        "--workloads",
+        nargs="+",
+        choices=WORKLOADS,
+        default=list(WORKLOADS),
+        help="The kinds of requests to send"
+    )
+    parser.add_argument(
+        "--concurrency",
+        nargs="+",
+        type=int,
+        default=list(CONCURRENCY_LEVELS),
+        help="The numbers of client threads to send requests with"
+    )
+    parser.add_argument("--duration", type=float, default=5.0, help="How many seconds to run each combination for")
+    parser.add_argument("--workers", type=int, default=2, help="The number of server processes, where supported")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=8,
+        help="The number of threads per server process, where supported"
+    )
+    arguments = parser.parse_args()
+    run(
+        stacks=arguments.stacks,
+        services=arguments.services,
+        servers=arguments.servers,
+        workloads=arguments.workloads,
+        concurrency_levels=arguments.concurrency,
+        duration=arguments.duration,
+        workers=arguments.workers,
+        threads=arguments.threads
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Measures how quickly each installed encoder writes canonical compose documents and which one writes exports
+
+Run with `python -m benchmarks.serialization`
+"""
+from __future__ import annotations
+
+import argparse
+import time
+import typing
+
+from benchmarks import corpus
+from builder import serialization
+
+
+def _measure(function: typing.Callable[[], typing.Any], repeat: int) -> float:
+    """
+    :return: The fastest of the given number of runs, in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(sizes: typing.Sequence[int], repeat: int):
+    documents = corpus.generate_corpus(sizes)
+    canonical_documents = {size: serialization.canonicalize(document) for size, document in documents.items()}
+
+    for output_format in serialization.get_formats():
+        selected = serialization.select_encoder(output_format)
+        print(f"{output_format} (used for exports: {selected.name})")
+        print(f"{'encoder':>10} | {'matches':>7} | " + " | ".join(f"{size:>6} services" for size in sizes))
+        print("-" * (23 + 18 * len(sizes)))
+
+        matching_encoders = {
+            size: {
+                candidate.name
+                for candidate, matches, _ in serialization.compare_encoders(output_format, canonical_documents[size])
+                if matches
+            }
+            for size in sizes
+        }
+
+        for encoder in serialization.get_encoders(output_format):
+            if not encoder.is_available():
+                print(f"{encoder.name:>10} | not installed")
+                continue
+
+            matches = all(encoder.name in matching_encoders[size] for size in sizes)
+            timings = [
+                _measure(lambda: encoder.encode(canonical_documents[size]), repeat)
+                for size in sizes
+            ]
+            print(
+                f"{encoder.name:>10} | {'yes' if matches else 'no':>7} | "
+                + " | ".join(f"{timing * 1000:>12.2f}ms" for timing in timings)
+            )
+        print()
+
+    print("Other costs")
+    for size, document in documents.items():
+        canonicalize = _measure(lambda: serialization.canonicalize(document), repeat)
+        digests = _measure(lambda: serialization.get_digests(document), repeat)
+        print(f"{size:>6} services | canonicalize {canonicalize * 1000:>8.2f}ms | all digests {digests * 1000:>8.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=corpus.CORPUS_SIZES, help="Services per document")
+    parser.add_argument("--repeat", type=int, default=5, help="How many times to run each measurement")
+    arguments = parser.parse_args()
+    run(sizes=arguments.sizes, repeat=arguments.repeat)
+
+
+if __name__ == "__main__":
+    main()
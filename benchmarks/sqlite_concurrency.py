@@ -0,0 +1,238 @@
+"""
+Compares Django's default SQLite settings against the tuned SQLite profile under concurrent readers and writers
+
+Readers export whole stacks while writers edit them, each on their own thread and connection, against a new database
+file for each profile. Run with `python -m benchmarks.sqlite_concurrency`
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+import typing
+
+from pathlib import Path
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "SwarmCompose.settings")
+
+import django
+
+from django.conf import settings
+
+from SwarmCompose import application_settings
+
+
+def get_profiles(directory: Path) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    """
+    :param directory: Where the database file for each profile should be created
+    :return: The name of each profile mapped to its database settings
+    """
+    return {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": str(directory / "default.sqlite3"),
+        },
+        "tuned": {
+            "ENGINE": application_settings.TUNED_SQLITE_ENGINE,
+            "NAME": str(directory / "tuned.sqlite3"),
+            "OPTIONS": application_settings.TUNED_SQLITE_OPTIONS,
+        },
+    }
+
+
+class Outcome:
+    """
+    What one kind of operation achieved over the course of a run
+    """
+    def __init__(self):
+        self.timings: typing.List[float] = []
+        self.locked = 0
+        self._lock = threading.Lock()
+
+    def record(self, timings: typing.Sequence[float], locked: int):
+        with self._lock:
+            self.timings.extend(timings)
+            self.locked += locked
+
+    def percentile(self, fraction: float) -> float:
+        """
+        :param fraction: How far into the sorted timings to look, like 0.95
+        :return: The timing, in milliseconds, at that point
+        """
+        if not self.timings:
+            return float("nan")
+        ordered = sorted(self.timings)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000
+
+
+def _seed(alias: str, stacks: int, services: int) -> typing.List[int]:
+    """
+    Create the tables and fill them with stacks to read and edit
+
+    :return: The primary keys of the new stacks
+    """
+    from django.apps import apps
+    from django.db import connections
+
+    from builder.models import BuildArg
+    from builder.models import BuildConfiguration
+    from builder.models import Service
+    from builder.models import ServiceAnnotation
+    from builder.models import Stack
+
+    # Tables are created directly so that the benchmark doesn't depend on the state of the project's migrations
+    with connections[alias].schema_editor() as editor:
+        for model in apps.get_app_config("builder").get_models():
+            editor.create_model(model)
+
+    stack_ids = []
+    for stack_index in range(stacks):
+        stack = Stack.objects.using(alias).create(name=f"stack-{stack_index}")
+        stack_ids.append(stack.pk)
+        created_services = Service.objects.using(alias).bulk_create([
+            Service(stack=stack, name=f"service-{index}", command="python -m app", container_name=f"service-{index}")
+            for index in range(services)
+        ])
+        builds = BuildConfiguration.objects.using(alias).bulk_create([
+            BuildConfiguration(service=service, context=".", dockerfile="Dockerfile")
+            for service in created_services
+        ])
+        BuildArg.objects.using(alias).bulk_create([
+            BuildArg(build_configuration=build, key=f"ARG_{index}", value=str(index))
+            for build in builds
+            for index in range(3)
+        ])
+        ServiceAnnotation.objects.using(alias).bulk_create([
+            ServiceAnnotation(service=service, key="owner", value="benchmark")
+            for service in created_services
+        ])
+
+    connections[alias].close()
+    return stack_ids
+
+
+def _read(alias: str, stack_id: int, generator: random.Random):
+    from builder.models import Stack
+
+    return Stack.objects.using(alias).get(pk=stack_id).value
+
+
+def _write(alias: str, stack_id: int, generator: random.Random):
+    from django.db import transaction
+
+    from builder.models import Service
+    from builder.models import ServiceAnnotation
+
+    # An edit reads what it is about to change before it changes it, all within one transaction
+    with transaction.atomic(using=alias):
+        service_ids = list(Service.objects.using(alias).filter(stack_id=stack_id).values_list("pk", flat=True))
+        service_id = generator.choice(service_ids)
+        Service.objects.using(alias).filter(pk=service_id).update(command=f"python -m app --edit {generator.random()}")
+        ServiceAnnotation.objects.using(alias).filter(service_id=service_id).update(value=str(generator.random()))
+
+
+def _work(
+    alias: str,
+    operation: typing.Callable[[str, int, random.Random], typing.Any],
+    stack_ids: typing.Sequence[int],
+    outcome: Outcome,
+    deadline: float,
+    seed: int
+):
+    from django.db import OperationalError
+    from django.db import connections
+
+    generator = random.Random(seed)
+    timings: typing.List[float] = []
+    locked = 0
+
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                operation(alias, generator.choice(stack_ids), generator)
+            except OperationalError as error:
+                if "locked" not in str(error):
+                    raise
+                locked += 1
+            else:
+                timings.append(time.perf_counter() - start)
+    finally:
+        connections[alias].close()
+        outcome.record(timings, locked)
+
+
+def run_profile(alias: str, stack_ids: typing.Sequence[int], readers: int, writers: int, duration: float):
+    """
+    :return: What the readers and what the writers achieved
+    """
+    reads = Outcome()
+    writes = Outcome()
+    deadline = time.perf_counter() + duration
+
+    threads = [
+        threading.Thread(target=_work, args=(alias, _read, stack_ids, reads, deadline, index))
+        for index in range(readers)
+    ] + [
+        threading.Thread(target=_work, args=(alias, _write, stack_ids, writes, deadline, readers + index))
+        for index in range(writers)
+    ]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return reads, writes
+
+
+def run(stacks: int, services: int, readers: int, writers: int, duration: float):
+    with tempfile.TemporaryDirectory() as directory:
+        profiles = get_profiles(Path(directory))
+        settings.DATABASES.update(profiles)
+        django.setup()
+
+        print(
+            f"{readers} readers and {writers} writers for {duration:.0f}s per profile against "
+            f"{stacks} stacks of {services} services"
+        )
+        print()
+        print(
+            f"{'profile':>8} | {'reads/s':>8} | {'read p50':>9} | {'read p95':>9} | "
+            f"{'writes/s':>8} | {'write p50':>9} | {'write p95':>9} | {'locked':>6}"
+        )
+        print("-" * 88)
+
+        for alias in profiles:
+            stack_ids = _seed(alias, stacks=stacks, services=services)
+            reads, writes = run_profile(alias, stack_ids, readers=readers, writers=writers, duration=duration)
+            print(
+                f"{alias:>8} | {len(reads.timings) / duration:>8.1f} | {reads.percentile(0.5):>7.1f}ms | "
+                f"{reads.percentile(0.95):>7.1f}ms | {len(writes.timings) / duration:>8.1f} | "
+                f"{writes.percentile(0.5):>7.1f}ms | {writes.percentile(0.95):>7.1f}ms | "
+                f"{reads.locked + writes.locked:>6}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--stacks", type=int, default=10, help="The number of stacks to read and edit")
+    parser.add_argument("--services", type=int, default=25, help="The number of services within each stack")
+    parser.add_argument("--readers", type=int, default=4, help="The number of threads exporting stacks")
+    parser.add_argument("--writers", type=int, default=4, help="The number of threads editing stacks")
+    parser.add_argument("--duration", type=float, default=5.0, help="How many seconds to run each profile for")
+    arguments = parser.parse_args()
+    run(
+        stacks=arguments.stacks,
+        services=arguments.services,
+        readers=arguments.readers,
+        writers=arguments.writers,
+        duration=arguments.duration
+    )
+
+
+if __name__ == "__main__":
+    main()
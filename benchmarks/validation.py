@@ -0,0 +1,76 @@
+"""
+Measures what validating rendered compose documents against the compose specification costs
+
+Run with `python -m benchmarks.validation`
+"""
+from __future__ import annotations
+
+import argparse
+import time
+import typing
+
+from benchmarks import corpus
+from builder import validation
+
+
+def _measure(function: typing.Callable[[], typing.Any], repeat: int) -> float:
+    """
+    :return: The fastest of the given number of runs, in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run(sizes: typing.Sequence[int], repeat: int, changed_fraction: float):
+    start = time.perf_counter()
+    validation.get_schema()
+    validation.get_validator()
+    print(f"Loading and compiling the schema: {(time.perf_counter() - start) * 1000:.1f}ms (once per process)")
+    print()
+    print(f"{'services':>8} | {'full':>10} | {'cold':>10} | {'warm':>10} | {f'{changed_fraction:.0%} changed':>12}")
+    print("-" * 63)
+
+    for size, document in corpus.generate_corpus(sizes).items():
+        # Every run needs its own edits; otherwise the edited fragments would already be cached after the first run
+        changed_documents = iter([
+            corpus.mutate_document(document, changed_fraction, seed=seed)
+            for seed in range(repeat)
+        ])
+        fragment_validator = validation.FragmentValidator()
+
+        def cold():
+            fragment_validator.clear()
+            fragment_validator.validate(document)
+
+        full = _measure(lambda: validation.validate_document(document, use_cache=False), repeat)
+        cold_time = _measure(cold, repeat)
+        fragment_validator.validate(document)
+        warm = _measure(lambda: fragment_validator.validate(document), repeat)
+        changed_time = _measure(lambda: fragment_validator.validate(next(changed_documents)), repeat)
+
+        print(
+            f"{size:>8} | {full * 1000:>8.2f}ms | {cold_time * 1000:>8.2f}ms | {warm * 1000:>8.2f}ms | "
+            f"{changed_time * 1000:>10.2f}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=corpus.CORPUS_SIZES, help="Services per document")
+    parser.add_argument("--repeat", type=int, default=5, help="How many times to run each measurement")
+    parser.add_argument(
+        "--changed-fraction",
+        type=float,
+        default=0.05,
+        help="The fraction of services that change between renders"
+    )
+    arguments = parser.parse_args()
+    run(sizes=arguments.sizes, repeat=arguments.repeat, changed_fraction=arguments.changed_fraction)
+
+
+if __name__ == "__main__":
+    main()
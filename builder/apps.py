@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class BuilderConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'builder'
+
+    def ready(self):
+        # Import modules that register job types so that workers know how to run them
+        from builder import tasks
+        # Import modules that connect signal handlers
+        from builder import changes
+        from builder import overlays
+        from builder import search
+        from builder import secret_usage
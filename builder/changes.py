@@ -0,0 +1,595 @@
+"""
+An append only feed of every create, update, and delete made to builder data
+
+Signal handlers record an event for each changed row along with the stack it belongs to and, for updates, the names of
+the fields that changed. Events recorded within a transaction are buffered and written with a single bulk insert just
+before the transaction commits, so the feed holds exactly what was committed: rolling back a transaction or a savepoint
+throws its events away. Changes made outside of a transaction write their events right away.
+
+Consumers read the feed with a cursor: every event has an increasing primary key, and asking for the events after the
+last key that was processed returns only what changed since then. Keys become visible in the order that they were
+handed out because only one transaction at a time may write events. SQLite only ever has one writer, and on Postgres a
+transaction takes a lock as it writes its events, right before it commits, so transactions only take turns for as long
+as it takes to insert their events and commit.
+
+Models that extend `TrackedModel` remember what was loaded, so finding the changed fields of an update doesn't read the
+row again. Other rows, and rows that were only partly loaded, cost one extra query per save. Bulk operations that
+skip signals, like `bulk_create` and `QuerySet.update`, have to call `record_created` or `record_queryset` themselves.
+The job queue and tables that are derived from other tables, like the search and secret usage indexes, aren't
+recorded, and neither are changes to fields that aren't editable, like revisions.
+"""
+from __future__ import annotations
+
+import contextlib
+import functools
+import time
+import typing
+import weakref
+
+from django.apps import apps
+from django.core.exceptions import EmptyResultSet
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.db import models
+from django.db import transaction
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from SwarmCompose import application_settings
+
+from builder import transactions
+from builder.models import ChangeAction
+from builder.models import ChangeEvent
+from builder.models import Job
+from builder.models import SearchDocument
+from builder.models import SecretUsage
+from builder.models import Stack
+from builder.models.common import TrackedModel
+
+BATCH_SIZE = 500
+"""The maximum number of events to write with a single statement"""
+
+DEFAULT_LIMIT = 100
+"""The number of events returned by a read that doesn't ask for a specific number"""
+
+MAX_LIMIT = 1000
+"""The largest number of events that may be read at once"""
+
+STACK_IDS = typing.Dict[typing.Tuple[typing.Type[models.Model], int], typing.Optional[int]]
+"""The primary key of the stack of each row, keyed by the row's model and primary key"""
+
+UNTRACKED_MODELS: typing.Sequence[typing.Type[models.Model]] = (ChangeEvent, Job, SearchDocument, SecretUsage)
+"""Builder models whose changes aren't recorded"""
+
+
+def is_tracked(model: typing.Type[models.Model]) -> bool:
+    """
+    :param model: A model class
+    :return: Whether changes to the model are recorded
+    """
+    return model._meta.app_label == "builder" and not model._meta.auto_created and model not in UNTRACKED_MODELS
+
+
+def get_tracked_labels() -> typing.List[str]:
+    """
+    :return: The label of every model whose changes are recorded, like 'builder.Service'
+    """
+    return sorted(model._meta.label for model in apps.get_app_config("builder").get_models() if is_tracked(model))
+
+
+@functools.lru_cache(maxsize=None)
+def get_parent_field(model: typing.Type[models.Model]) -> typing.Optional[models.Field]:
+    """
+    :param model: A builder model
+    :return: The foreign key that leads from the model towards the stack it belongs to. None if it doesn't belong to
+        a stack
+    """
+    candidates = [
+        field
+        for field in model._meta.concrete_fields
+        if (field.many_to_one or field.one_to_one) and field.related_model is not model
+    ]
+
+    for field in candidates:
+        if field.related_model is Stack:
+            return field
+
+    for field in candidates:
+        if field.related_model._meta.app_label == "builder" and get_parent_field(field.related_model) is not None:
+            return field
+
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_stack_path(model: typing.Type[models.Model]) -> typing.Optional[str]:
+    """
+    Example:
+        >>> get_stack_path(BuildArg)
+        'build_configuration__service__stack_id'
+
+    :param model: A builder model
+    :return: The lookup that finds the primary key of the stack a row belongs to. None if it doesn't belong to a stack
+    """
+    if model is Stack:
+        return "pk"
+
+    field = get_parent_field(model)
+
+    if field is None:
+        return None
+
+    if field.related_model is Stack:
+        return field.attname
+
+    return f"{field.name}__{get_stack_path(field.related_model)}"
+
+
+class _EventBuffer:
+    """
+    Events recorded within a single transaction, or for a single change made outside of one, that are yet to be written
+    """
+    def __init__(self, using: str):
+        """
+        :param using: The alias of the database that changed
+        """
+        self.using = using
+        self.events: typing.List[ChangeEvent] = []
+        self.savepoints: typing.List[typing.Tuple[str, int]] = []
+        self.stack_ids: STACK_IDS = {}
+
+    def add(
+        self,
+        action: str,
+        model: typing.Type[models.Model],
+        rows: typing.Iterable[typing.Tuple[int, typing.Optional[int]]],
+        changed_fields: typing.Sequence[str] = ()
+    ):
+        """
+        :param action: What happened to the rows
+        :param model: The model of the rows
+        :param rows: The primary key of each row along with the primary key of its stack
+        :param changed_fields: The names of the fields that an update changed
+        """
+        label = model._meta.label
+        self.events.extend(
+            ChangeEvent(
+                action=action,
+                model=label,
+                object_id=object_id,
+                stack_id=stack_id,
+                changed_fields=list(changed_fields)
+            )
+            for object_id, stack_id in rows
+        )
+
+    def get_stack_id(self, model: typing.Type[models.Model], primary_key: int) -> typing.Optional[int]:
+        """
+        :param model: A builder model
+        :param primary_key: The primary key of a row that exists
+        :return: The primary key of the stack that the row belongs to
+        """
+        key = (model, primary_key)
+        if key not in self.stack_ids:
+            self.stack_ids[key] = model._base_manager.using(self.using).filter(pk=primary_key).values_list(
+                get_stack_path(model),
+                flat=True
+            ).first()
+        return self.stack_ids[key]
+
+    def savepoint_created(self, savepoint_id: str):
+        self.savepoints.append((savepoint_id, len(self.events)))
+
+    def savepoint_released(self, savepoint_id: str):
+        # Events recorded since the savepoint was created now belong to the savepoint or transaction around it
+        index = self._find_savepoint(savepoint_id)
+        if index is not None:
+            del self.savepoints[index:]
+
+    def savepoint_rolled_back(self, savepoint_id: str):
+        index = self._find_savepoint(savepoint_id)
+        if index is not None:
+            del self.events[self.savepoints[index][1]:]
+            del self.savepoints[index + 1:]
+
+        # Rows looked up since the savepoint was created may have been rolled back along with it
+        self.stack_ids.clear()
+
+    def _find_savepoint(self, savepoint_id: str) -> typing.Optional[int]:
+        for index, (created_id, _) in enumerate(self.savepoints):
+            if created_id == savepoint_id:
+                return index
+        return None
+
+    def flush(self):
+        """
+        Write every buffered event with as few inserts as possible
+        """
+        events, self.events = self.events, []
+        if not events:
+            return
+
+        # Outside of a transaction the lock has to be taken within the same transaction as the insert to mean anything
+        with transaction.atomic(using=self.using, savepoint=False):
+            _lock_feed(self.using)
+            ChangeEvent.objects.using(self.using).bulk_create(events, batch_size=BATCH_SIZE)
+
+
+def _lock_feed(using: str):
+    """
+    Keep other transactions from writing events until the current transaction ends
+
+    Keys are handed out when events are inserted but only become visible when their transaction commits. If two
+    transactions could write events at once, the one holding the higher keys could commit first and a reader could
+    move its cursor past keys that are yet to appear. Events are only written right before a transaction commits, so
+    the lock is only held for that long. SQLite only ever has one writer, so only Postgres needs the lock.
+
+    :param using: The alias of the database that events are about to be written to
+    """
+    connection = connections[using]
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", ["builder.changeevent"])
+
+
+class _TransactionBuffers(transactions.TransactionListener):
+    """
+    Buffers the events recorded within the transaction open on each connection and writes them just before it commits
+    """
+    def __init__(self):
+        self.buffers: typing.MutableMapping[BaseDatabaseWrapper, _EventBuffer] = weakref.WeakKeyDictionary()
+
+    def get(self, connection: BaseDatabaseWrapper) -> _EventBuffer:
+        """
+        :param connection: A connection with an open transaction
+        :return: The buffer of the connection's transaction
+        """
+        buffer = self.buffers.get(connection)
+        if buffer is None:
+            buffer = self.buffers[connection] = _EventBuffer(connection.alias)
+        return buffer
+
+    def committing(self, connection: BaseDatabaseWrapper):
+        buffer = self.buffers.get(connection)
+        if buffer is not None:
+            buffer.flush()
+
+    def ended(self, connection: BaseDatabaseWrapper):
+        self.buffers.pop(connection, None)
+
+    def savepoint_created(self, connection: BaseDatabaseWrapper, savepoint_id: str):
+        self.get(connection).savepoint_created(savepoint_id)
+
+    def savepoint_released(self, connection: BaseDatabaseWrapper, savepoint_id: str):
+        buffer = self.buffers.get(connection)
+        if buffer is not None:
+            buffer.savepoint_released(savepoint_id)
+
+    def savepoint_rolled_back(self, connection: BaseDatabaseWrapper, savepoint_id: str):
+        buffer = self.buffers.get(connection)
+        if buffer is not None:
+            buffer.savepoint_rolled_back(savepoint_id)
+
+
+_transaction_buffers = transactions.add_listener(_TransactionBuffers())
+
+
+@contextlib.contextmanager
+def _buffer(using: str) -> typing.Iterator[_EventBuffer]:
+    """
+    :param using: The alias of the database that changed
+    :return: A buffer to add events to. Within a transaction its events are written just before the transaction
+        commits. Otherwise they are written when the block exits
+    """
+    connection = connections[using]
+
+    if connection.in_atomic_block:
+        transactions.watch(connection)
+        yield _transaction_buffers.get(connection)
+        return
+
+    buffer = _EventBuffer(using)
+    yield buffer
+    buffer.flush()
+
+
+def _get_stack_id(instance: models.Model, buffer: _EventBuffer) -> typing.Optional[int]:
+    """
+    :param instance: A row of a builder model
+    :param buffer: The buffer whose cache to use when the row's parents have to be looked up
+    :return: The primary key of the stack that the row belongs to
+    """
+    if isinstance(instance, Stack):
+        return instance.pk
+
+    field = get_parent_field(type(instance))
+    parent_id = getattr(instance, field.attname) if field is not None else None
+
+    if parent_id is None:
+        return None
+
+    if field.related_model is Stack:
+        return parent_id
+
+    if field.is_cached(instance):
+        return _get_stack_id(field.get_cached_value(instance), buffer)
+
+    return buffer.get_stack_id(field.related_model, parent_id)
+
+
+def record_created(
+    instances: typing.Sequence[models.Model],
+    stack_id: typing.Optional[int],
+    using: str = DEFAULT_DB_ALIAS
+):
+    """
+    Record the creation of rows that were inserted without sending signals
+
+    :param instances: Saved rows of a single model
+    :param stack_id: The primary key of the stack that every row belongs to
+    :param using: The alias of the database that the rows were inserted into
+    """
+    if not instances or not is_tracked(type(instances[0])):
+        return
+
+    with _buffer(using) as buffer:
+        buffer.add(ChangeAction.created, type(instances[0]), ((instance.pk, stack_id) for instance in instances))
+
+
+def record_queryset(queryset: models.QuerySet, action: str, changed_fields: typing.Sequence[str] = ()) -> int:
+    """
+    Record changes to rows that are about to be, or were just, changed without sending signals
+
+    Events are written by a single `INSERT ... SELECT` statement, so none of the changed rows are loaded no matter how
+    many there are. Rows that are about to be deleted must be recorded before they are deleted, since their stacks are
+    looked up here. Within a transaction, the events that it already buffered are written first so that the feed keeps
+    the order that changes were made in, which means that on Postgres the feed stays locked until the transaction ends.
+
+    :param queryset: The changed rows
+    :param action: What happened to the rows
+    :param changed_fields: The names of the fields that an update changed
+    :return: The number of events that were recorded
+    """
+    model = queryset.model
+    if not is_tracked(model):
+        return 0
+
+    using = queryset.db
+    connection = connections[using]
+    stack_path = get_stack_path(model)
+    rows = queryset.order_by("pk").values_list(
+        models.Value(timezone.now(), output_field=models.DateTimeField()),
+        models.Value(action, output_field=models.CharField()),
+        models.Value(model._meta.label, output_field=models.CharField()),
+        models.F("pk"),
+        models.Value(None, output_field=models.BigIntegerField()) if stack_path is None else models.F(stack_path),
+        models.Value(list(changed_fields), output_field=models.JSONField()),
+    )
+    try:
+        select, params = rows.query.get_compiler(using=using).as_sql()
+    except EmptyResultSet:
+        return 0
+
+    quote = connection.ops.quote_name
+    columns = ", ".join(
+        quote(ChangeEvent._meta.get_field(name).column)
+        for name in ("created", "action", "model", "object_id", "stack_id", "changed_fields")
+    )
+
+    with transaction.atomic(using=using, savepoint=False):
+        buffer = _transaction_buffers.buffers.get(connection)
+        if buffer is not None:
+            buffer.flush()
+
+        _lock_feed(using)
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {quote(ChangeEvent._meta.db_table)} ({columns}) {select}", params)
+            return cursor.rowcount
+
+
+def _get_changed_fields(instance: models.Model, using: str) -> typing.Optional[typing.List[str]]:
+    """
+    :param instance: A row that is about to be saved over an existing row
+    :param using: The alias of the database that the row is saved to
+    :return: The names of the fields whose values differ from what is stored. None if nothing is stored
+    """
+    fields = [field for field in instance._meta.concrete_fields if field.editable and not field.primary_key]
+    stored = instance.get_stored_values() if isinstance(instance, TrackedModel) else {}
+
+    # Rows that were loaded in full from the same database already know what is stored, so only others are read again
+    if instance._state.db != using or any(field.attname not in stored for field in fields):
+        stored = type(instance)._base_manager.using(using).filter(pk=instance.pk).values(
+            *(field.attname for field in fields)
+        ).first()
+
+    if stored is None:
+        return None
+
+    changed = []
+    for field in fields:
+        try:
+            differs = field.to_python(getattr(instance, field.attname)) != field.to_python(stored[field.attname])
+        except ValidationError:
+            differs = True
+
+        if differs:
+            changed.append(field.name)
+
+    return changed
+
+
+@receiver(pre_save)
+def _row_saving(sender, instance: models.Model, using: str, raw: bool = False, update_fields=None, **kwargs):
+    if raw or not is_tracked(sender) or instance._state.adding or instance.pk is None:
+        return
+
+    if update_fields is not None:
+        fields = [sender._meta.get_field(name) for name in update_fields]
+        changed = sorted(field.name for field in fields if field.editable)
+    else:
+        changed = _get_changed_fields(instance, using)
+
+    instance._change_feed_changed_fields = changed
+
+
+@receiver(post_save)
+def _row_saved(
+    sender,
+    instance: models.Model,
+    created: bool,
+    using: str,
+    raw: bool = False,
+    update_fields: typing.Optional[typing.FrozenSet[str]] = None,
+    **kwargs
+):
+    if raw or not is_tracked(sender):
+        return
+
+    if isinstance(instance, TrackedModel):
+        instance.remember_stored_values(update_fields)
+
+    changed = instance.__dict__.pop("_change_feed_changed_fields", None)
+
+    if created:
+        action, changed = ChangeAction.created, []
+    elif changed is None:
+        # Rows that were saved from new instances over existing keys can't be compared, so all of their fields count
+        action = ChangeAction.updated
+        changed = [field.name for field in sender._meta.concrete_fields if field.editable and not field.primary_key]
+    elif not changed:
+        return
+    else:
+        action = ChangeAction.updated
+
+    with _buffer(using) as buffer:
+        buffer.add(action, sender, [(instance.pk, _get_stack_id(instance, buffer))], changed)
+
+
+@receiver(pre_delete)
+def _row_deleting(sender, instance: models.Model, using: str, **kwargs):
+    # Stacks have to be found while the parents of the row still exist, which isn't the case once a cascade is done
+    if is_tracked(sender):
+        with _buffer(using) as buffer:
+            instance._change_feed_stack_id = _get_stack_id(instance, buffer)
+
+
+@receiver(post_delete)
+def _row_deleted(sender, instance: models.Model, using: str, **kwargs):
+    if is_tracked(sender):
+        stack_id = instance.__dict__.pop("_change_feed_stack_id", None)
+        with _buffer(using) as buffer:
+            buffer.add(ChangeAction.deleted, sender, [(instance.pk, stack_id)])
+
+
+@receiver(m2m_changed)
+def _relation_changed(
+    sender,
+    instance: models.Model,
+    action: str,
+    reverse: bool,
+    model: typing.Type[models.Model],
+    pk_set: typing.Optional[typing.Set[int]],
+    using: str,
+    **kwargs
+):
+    # Changes to a many to many relation are recorded as updates to the rows that declare it
+    if action not in ("post_add", "post_remove", "pre_clear", "post_clear"):
+        return
+
+    owner = model if reverse else type(instance)
+    if not is_tracked(owner):
+        return
+
+    field = next(field for field in owner._meta.many_to_many if field.remote_field.through is sender)
+
+    if not reverse:
+        if action != "pre_clear":
+            with _buffer(using) as buffer:
+                buffer.add(ChangeAction.updated, owner, [(instance.pk, _get_stack_id(instance, buffer))], [field.name])
+        return
+
+    if action == "pre_clear":
+        instance._change_feed_cleared_ids = list(
+            owner._base_manager.using(using).filter(**{field.name: instance.pk}).values_list("pk", flat=True)
+        )
+        return
+
+    owner_ids = instance.__dict__.pop("_change_feed_cleared_ids", []) if action == "post_clear" else pk_set
+    if owner_ids:
+        record_queryset(owner._base_manager.using(using).filter(pk__in=owner_ids), ChangeAction.updated, [field.name])
+
+
+def get_events(
+    after: int = 0,
+    limit: int = DEFAULT_LIMIT,
+    stack_id: int = None,
+    model: str = None,
+    using: str = DEFAULT_DB_ALIAS
+) -> typing.List[ChangeEvent]:
+    """
+    Read the events recorded after a cursor
+
+    Example:
+        >>> events = get_events(after=cursor)
+        >>> cursor = events[-1].pk if events else cursor
+
+    :param after: Only include events whose primary keys are greater than this
+    :param limit: The largest number of events to return
+    :param stack_id: Only include events for rows within this stack
+    :param model: Only include events for rows of the model with this label, like 'builder.Service'
+    :param using: The alias of the database to read from
+    :return: The oldest events after the cursor
+    """
+    if limit < 1 or limit > MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+
+    if model is not None and model not in get_tracked_labels():
+        raise ValueError(f"Changes to '{model}' aren't recorded")
+
+    events = ChangeEvent.objects.using(using).filter(pk__gt=after)
+
+    if stack_id is not None:
+        events = events.filter(stack_id=stack_id)
+
+    if model is not None:
+        events = events.filter(model=model)
+
+    return list(events.order_by("pk")[:limit])
+
+
+def wait_for_events(
+    after: int = 0,
+    timeout: float = 0,
+    limit: int = DEFAULT_LIMIT,
+    stack_id: int = None,
+    model: str = None,
+    using: str = DEFAULT_DB_ALIAS
+) -> typing.List[ChangeEvent]:
+    """
+    Read the events recorded after a cursor, waiting for some to be recorded if there are none yet
+
+    :param after: Only include events whose primary keys are greater than this
+    :param timeout: The most seconds to wait. Capped by the `CHANGE_FEED_MAX_WAIT` application setting
+    :param limit: The largest number of events to return
+    :param stack_id: Only include events for rows within this stack
+    :param model: Only include events for rows of the model with this label, like 'builder.Service'
+    :param using: The alias of the database to read from
+    :return: The oldest events after the cursor. Empty if none were recorded before the timeout
+    """
+    deadline = time.monotonic() + min(max(timeout, 0), application_settings.CHANGE_FEED_MAX_WAIT)
+
+    while True:
+        events = get_events(after=after, limit=limit, stack_id=stack_id, model=model, using=using)
+        remaining = deadline - time.monotonic()
+
+        if events or remaining <= 0:
+            return events
+
+        time.sleep(min(application_settings.CHANGE_FEED_POLL_INTERVAL, remaining))
@@ -0,0 +1,371 @@
+"""
+Deep copies of stacks and services that take a fixed number of queries no matter how large the copy is
+
+The source graph is read with prefetching, primary keys are remapped in memory, and each table is written with a
+single `bulk_create` (split into batches where the database requires it).
+"""
+from __future__ import annotations
+
+import typing
+
+from django.db import connections
+from django.db import models
+from django.db import transaction
+
+from builder import changes
+from builder import overlays
+from builder import search
+from builder import secret_usage
+from builder.models import BuildArg
+from builder.models import BuildConfiguration
+from builder.models import BuildSecret
+from builder.models import Deploy
+from builder.models import DeployLabel
+from builder.models import IPAddressManagementConfig
+from builder.models import IPAMAuxilaryAddresses
+from builder.models import ImageLabel
+from builder.models import ImageTags
+from builder.models import Network
+from builder.models import NetworkDriverOptions
+from builder.models import NetworkLabel
+from builder.models import Secret
+from builder.models import Service
+from builder.models import ServiceAnnotation
+from builder.models import ServiceDependency
+from builder.models import Stack
+
+BATCH_SIZE = 500
+"""The maximum number of rows to insert with a single statement"""
+
+_MODEL = typing.TypeVar("_MODEL", bound=models.Model)
+RENAME = typing.Callable[[str], str]
+
+
+def _copy(instance: _MODEL, **overrides) -> _MODEL:
+    """
+    Copies start out live and with a revision of their own rather than inheriting the state of the original
+
+    :param instance: The row to copy
+    :param overrides: Values, keyed by attribute name (like `stack_id`), to use instead of the copied values
+    :return: An unsaved copy of the row
+    """
+    values = {
+        field.attname: getattr(instance, field.attname)
+        for field in instance._meta.concrete_fields
+        if not field.primary_key
+    }
+
+    if "deleted_at" in values:
+        values["deleted_at"] = None
+
+    if "revision" in values:
+        values["revision"] = overlays.new_revision()
+
+    values.update(overrides)
+    return type(instance)(**values)
+
+
+def _bulk_create(
+    model: typing.Type[_MODEL],
+    instances: typing.Sequence[_MODEL],
+    stack_id: int
+) -> typing.Sequence[_MODEL]:
+    """
+    Insert rows, making sure that each ends up with its new primary key
+
+    :param model: The type of rows to insert
+    :param instances: The unsaved rows
+    :param stack_id: The primary key of the stack that every row belongs to
+    :return: The saved rows
+    """
+    if not instances:
+        return instances
+
+    if connections[model.objects.db].features.can_return_rows_from_bulk_insert:
+        created = model.objects.bulk_create(instances, batch_size=BATCH_SIZE)
+        # Rows inserted in bulk don't send signals, so their creation has to be recorded here
+        changes.record_created(created, stack_id=stack_id)
+        return created
+
+    # Primary keys are needed to link children to their parents, so rows have to be saved one at a time on databases
+    # that can't report the keys of rows inserted in bulk
+    for instance in instances:
+        instance.save(force_insert=True)
+
+    return instances
+
+
+def _clone_networks(
+    networks: typing.Sequence[Network],
+    stack: Stack,
+    rename: RENAME
+) -> typing.Dict[int, Network]:
+    """
+    :param networks: Networks loaded with `for_rendering`
+    :param stack: The stack that the copies will belong to
+    :param rename: Produces the name of a copy from the name of the original
+    :return: The primary keys of the original networks mapped to their copies
+    """
+    clones = _bulk_create(Network, [
+        _copy(network, stack_id=stack.pk, name=rename(network.name))
+        for network in networks
+    ], stack_id=stack.pk)
+    network_map = {original.pk: clone for original, clone in zip(networks, clones)}
+
+    _bulk_create(NetworkLabel, [
+        _copy(label, network_id=network_map[network.pk].pk)
+        for network in networks
+        for label in network.labels.all()
+    ], stack_id=stack.pk)
+    _bulk_create(NetworkDriverOptions, [
+        _copy(option, network_id=network_map[network.pk].pk)
+        for network in networks
+        for option in network.driver_opts.all()
+    ], stack_id=stack.pk)
+
+    ipam_configs = [ipam_config for network in networks for ipam_config in network.ipam_configs.all()]
+    ipam_clones = _bulk_create(IPAddressManagementConfig, [
+        _copy(ipam_config, network_id=network_map[ipam_config.network_id].pk)
+        for ipam_config in ipam_configs
+    ], stack_id=stack.pk)
+    _bulk_create(IPAMAuxilaryAddresses, [
+        _copy(address, ipam_id=ipam_clone.pk)
+        for ipam_config, ipam_clone in zip(ipam_configs, ipam_clones)
+        for address in ipam_config.auxilary_addresses.all()
+    ], stack_id=stack.pk)
+
+    return network_map
+
+
+def _clone_services(
+    services: typing.Sequence[Service],
+    stack: Stack,
+    names: typing.Mapping[int, str],
+    rename_container: RENAME,
+    rename_dependency: RENAME,
+    network_ids: typing.Mapping[int, int]
+) -> typing.Sequence[Service]:
+    """
+    :param services: Services loaded with `for_rendering`
+    :param stack: The stack that the copies will belong to
+    :param names: The primary keys of the originals mapped to the names of their copies
+    :param rename_container: Produces the container name of a copy from the container name of the original
+    :param rename_dependency: Produces the name of a dependency for the copies from the original dependency name
+    :param network_ids: The primary keys of the networks that the originals are attached to mapped to the primary keys
+        of the networks that the copies should be attached to
+    :return: The copies of the services, in the same order as the originals
+    """
+    clones = _bulk_create(Service, [
+        _copy(
+            service,
+            stack_id=stack.pk,
+            name=names[service.pk],
+            container_name=rename_container(service.container_name) if service.container_name else None
+        )
+        for service in services
+    ], stack_id=stack.pk)
+    pairs = list(zip(services, clones))
+
+    # Copies of services that extend another service being copied along with them extend that copy instead, so that
+    # they don't reach back into the original for their build or networks
+    clone_ids = {service.pk: clone.pk for service, clone in pairs}
+    extending_clones = []
+    for service, clone in pairs:
+        if service.extends_id in clone_ids:
+            clone.extends_id = clone_ids[service.extends_id]
+            extending_clones.append(clone)
+    Service.objects.bulk_update(extending_clones, ["extends"], batch_size=BATCH_SIZE)
+
+    Service.networks.through.objects.bulk_create(
+        [
+            Service.networks.through(service_id=clone.pk, network_id=network_ids[network.pk])
+            for service, clone in pairs
+            for network in service.networks.all()
+        ],
+        batch_size=BATCH_SIZE
+    )
+
+    _bulk_create(ServiceAnnotation, [
+        _copy(annotation, service_id=clone.pk)
+        for service, clone in pairs
+        for annotation in service.annotations.all()
+    ], stack_id=stack.pk)
+    _bulk_create(ServiceDependency, [
+        _copy(dependency, service_id=clone.pk, name=rename_dependency(dependency.name))
+        for service, clone in pairs
+        for dependency in service.depends_on.all()
+    ], stack_id=stack.pk)
+
+    deploys = [(service.deploy, clone) for service, clone in pairs if getattr(service, "deploy", None) is not None]
+    deploy_clones = _bulk_create(
+        Deploy,
+        [_copy(deploy, service_id=clone.pk) for deploy, clone in deploys],
+        stack_id=stack.pk
+    )
+    _bulk_create(DeployLabel, [
+        _copy(label, deploy_id=deploy_clone.pk)
+        for (deploy, _), deploy_clone in zip(deploys, deploy_clones)
+        for label in deploy.labels.all()
+    ], stack_id=stack.pk)
+
+    builds = [(build, clone) for service, clone in pairs for build in service.buildconfiguration_set.all()]
+    build_clones = _bulk_create(
+        BuildConfiguration,
+        [_copy(build, service_id=clone.pk) for build, clone in builds],
+        stack_id=stack.pk
+    )
+    build_pairs = [(build, build_clone) for (build, _), build_clone in zip(builds, build_clones)]
+
+    build_children = ((BuildArg, "args"), (ImageLabel, "labels"), (BuildSecret, "secrets"), (ImageTags, "tags"))
+    child_clones: typing.Dict[typing.Type[models.Model], typing.Sequence[models.Model]] = {}
+    for model, related_name in build_children:
+        child_clones[model] = _bulk_create(model, [
+            _copy(child, build_configuration_id=build_clone.pk)
+            for build, build_clone in build_pairs
+            for child in getattr(build, related_name).all()
+        ], stack_id=stack.pk)
+
+    # Rows inserted in bulk don't send signals, so the copies have to be indexed, and the stack they were copied into
+    # given a new revision, here
+    search.schedule_indexing([clone.pk for clone in clones])
+    overlays.touch_stacks(Stack.objects.filter(pk=stack.pk))
+    secret_usage.index_build_secrets([secret.pk for secret in child_clones[BuildSecret]])
+
+    return clones
+
+
+def _prefixer(prefix: str) -> RENAME:
+    return lambda name: f"{prefix}{name}" if prefix else name
+
+
+@transaction.atomic
+def clone_stack(stack: Stack, name: str, prefix: str = "") -> Stack:
+    """
+    Copy a stack along with every service, network, and everything that belongs to them
+
+    Example:
+        >>> payments_staging = clone_stack(payments, name="payments-staging", prefix="staging-")
+
+    :param stack: The stack to copy
+    :param name: The name of the new stack
+    :param prefix: Text to put in front of the name of every copied service, container, and network. References
+        between services and from services to networks are rewritten to match
+    :return: The new stack
+    """
+    rename = _prefixer(prefix)
+    new_stack = _copy(stack, name=name)
+    new_stack.save(force_insert=True)
+
+    _bulk_create(
+        Secret,
+        [_copy(secret, stack_id=new_stack.pk) for secret in stack.secrets.all()],
+        stack_id=new_stack.pk
+    )
+
+    network_map = _clone_networks(list(stack.networks.alive().for_rendering()), stack=new_stack, rename=rename)
+
+    services = list(stack.services.alive().for_rendering())
+    _clone_services(
+        services,
+        stack=new_stack,
+        names={service.pk: rename(service.name) for service in services},
+        rename_container=rename,
+        rename_dependency=rename,
+        network_ids={original: clone.pk for original, clone in network_map.items()}
+    )
+
+    return new_stack
+
+
+def _get_network_ids(
+    services: typing.Sequence[Service],
+    source_stack_id: int,
+    target_stack: Stack
+) -> typing.Dict[int, int]:
+    """
+    :param services: Services, loaded with `for_rendering`, that are being copied out of the same stack
+    :param source_stack_id: The primary key of the stack that the services belong to
+    :param target_stack: The stack that the services are being copied into
+    :return: The primary keys of the networks that the services use mapped to the networks their copies should use
+    """
+    used_networks = {network.pk: network for service in services for network in service.networks.all()}
+
+    if target_stack.pk == source_stack_id:
+        return {network_id: network_id for network_id in used_networks}
+
+    target_networks = dict(target_stack.networks.alive().values_list("name", "pk"))
+    missing_names = sorted({network.name for network in used_networks.values()}.difference(target_networks))
+
+    if missing_names:
+        raise ValueError(
+            f"Services can't be copied into '{target_stack.name}' because it has no networks named: "
+            f"{', '.join(missing_names)}"
+        )
+
+    return {network_id: target_networks[network.name] for network_id, network in used_networks.items()}
+
+
+@transaction.atomic
+def clone_services(
+    services: typing.Iterable[Service],
+    stack: Stack = None,
+    prefix: str = "",
+    names: typing.Mapping[int, str] = None
+) -> typing.Sequence[Service]:
+    """
+    Copy services and everything that belongs to them
+
+    Copies are attached to the networks with the same names within the stack they are copied into. Dependencies on
+    other services that are copied along with them are rewritten to match their new names.
+
+    :param services: The services to copy
+    :param stack: The stack to copy the services into. Each service's own stack if None
+    :param prefix: Text to put in front of the name, and container name, of every copy
+    :param names: Primary keys of services mapped to exact names for their copies. Takes precedence over `prefix`
+    :return: The copies, in the same order as the services that were given
+    """
+    names = names or {}
+    requested_ids = [service.pk for service in services]
+    loaded = Service.objects.for_rendering().in_bulk(requested_ids)
+    rename = _prefixer(prefix)
+
+    services_by_stack: typing.Dict[int, typing.List[Service]] = {}
+    for service_id in requested_ids:
+        service = loaded[service_id]
+        services_by_stack.setdefault(service.stack_id, []).append(service)
+
+    target_stacks = Stack.objects.in_bulk(services_by_stack) if stack is None else {}
+    clones: typing.Dict[int, Service] = {}
+
+    for source_stack_id, stack_services in services_by_stack.items():
+        target_stack = stack if stack is not None else target_stacks[source_stack_id]
+        new_names = {
+            service.pk: names.get(service.pk) or rename(service.name)
+            for service in stack_services
+        }
+        renamed_dependencies = {service.name: new_names[service.pk] for service in stack_services}
+
+        stack_clones = _clone_services(
+            stack_services,
+            stack=target_stack,
+            names=new_names,
+            rename_container=rename,
+            rename_dependency=lambda name: renamed_dependencies.get(name, name),
+            network_ids=_get_network_ids(stack_services, source_stack_id, target_stack)
+        )
+        clones.update((service.pk, clone) for service, clone in zip(stack_services, stack_clones))
+
+    return [clones[service_id] for service_id in requested_ids]
+
+
+def clone_service(service: Service, name: str = None, prefix: str = "", stack: Stack = None) -> Service:
+    """
+    Copy a single service and everything that belongs to it
+
+    :param service: The service to copy
+    :param name: The name of the copy. Takes precedence over `prefix`
+    :param prefix: Text to put in front of the name, and container name, of the copy
+    :param stack: The stack to copy the service into. The service's own stack if None
+    :return: The copy
+    """
+    return clone_services([service], stack=stack, prefix=prefix, names={service.pk: name} if name else None)[0]
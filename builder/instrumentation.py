@@ -0,0 +1,334 @@
+"""
+Lightweight timing spans and counters for the rendering hot path, exposed in the Prometheus text format
+
+Instrumentation is switched on with the `SWARM_COMPOSE_METRICS` environment variable. When it is off, `instrumented`
+hands back the function it was given, so disabled instrumentation costs nothing on the hot path. The setting is read
+whenever it matters rather than once at import, so it may be changed at runtime, but functions that were decorated
+while it was off stay uninstrumented.
+
+Metrics are kept per process; each worker process of a multi-process server reports its own values.
+"""
+from __future__ import annotations
+
+import bisect
+import contextlib
+import functools
+import threading
+import time
+import typing
+
+from SwarmCompose import application_settings
+
+DURATION_BUCKETS: typing.Sequence[float] = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+"""The upper bounds, in seconds, of the buckets that span durations are sorted into"""
+
+SPAN_DURATION = "swarm_compose_span_duration_seconds"
+SPAN_QUERIES = "swarm_compose_span_db_queries_total"
+CACHE_HITS = "swarm_compose_cache_hits_total"
+CACHE_MISSES = "swarm_compose_cache_misses_total"
+REQUESTS = "swarm_compose_requests_total"
+REQUEST_QUERIES = "swarm_compose_request_db_queries_total"
+
+QUERY_COUNT_HEADER = "X-DB-Queries"
+"""The response header that carries the number of database queries issued while handling a request"""
+
+LABELS = typing.Tuple[typing.Tuple[str, str], ...]
+SAMPLE = typing.Tuple[str, typing.Dict[str, str], float]
+"""The name, labels, and value of a single reported value"""
+
+_FUNCTION = typing.TypeVar("_FUNCTION", bound=typing.Callable)
+
+
+def is_enabled() -> bool:
+    """
+    :return: Whether instrumentation is switched on
+    """
+    return application_settings.METRICS_ENABLED
+
+
+def _freeze_labels(labels: typing.Mapping[str, typing.Any]) -> LABELS:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: typing.Iterable[typing.Tuple[str, str]]) -> str:
+    formatted = ",".join(
+        '{}="{}"'.format(key, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for key, value in labels
+    )
+    return "{" + formatted + "}" if formatted else ""
+
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    Counts observations into cumulative buckets the way a Prometheus histogram does
+    """
+    def __init__(self, buckets: typing.Sequence[float] = DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: LABELS) -> typing.Iterable[str]:
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            bucket_labels = labels + (("le", _format_number(float(bound))),)
+            yield f"{name}_bucket{_format_labels(bucket_labels)} {cumulative}"
+        yield f"{name}_sum{_format_labels(labels)} {_format_number(self.sum)}"
+        yield f"{name}_count{_format_labels(labels)} {self.count}"
+
+
+class MetricsRegistry:
+    """
+    Holds every counter and histogram for the process along with functions that report values when scraped
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._descriptions: typing.Dict[str, typing.Tuple[str, str]] = {}
+        self._counters: typing.Dict[str, typing.Dict[LABELS, float]] = {}
+        self._histograms: typing.Dict[str, typing.Dict[LABELS, Histogram]] = {}
+        self._collectors: typing.List[typing.Callable[[], typing.Iterable[SAMPLE]]] = []
+
+    def describe(self, name: str, metric_type: str, description: str):
+        """
+        :param name: The name of the metric
+        :param metric_type: The Prometheus type of the metric, like 'counter' or 'histogram'
+        :param description: What the metric measures
+        """
+        self._descriptions[name] = (metric_type, description)
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        """
+        :param name: The name of the counter to increase
+        :param amount: How much to increase the counter by
+        :param labels: Labels that distinguish this counter from others with the same name
+        """
+        key = _freeze_labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        :param name: The name of the histogram to add an observation to
+        :param value: The observed value
+        :param labels: Labels that distinguish this histogram from others with the same name
+        """
+        key = _freeze_labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def register_collector(self, collector: typing.Callable[[], typing.Iterable[SAMPLE]]):
+        """
+        :param collector: A function that reports counter values whenever metrics are scraped
+        """
+        self._collectors.append(collector)
+
+    def reset(self):
+        """
+        Forget every recorded value
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self) -> str:
+        """
+        :return: Every metric in the Prometheus text exposition format
+        """
+        counters: typing.Dict[str, typing.Dict[LABELS, float]] = {}
+
+        with self._lock:
+            for name, series in self._counters.items():
+                counters[name] = dict(series)
+            histograms = {
+                name: {labels: list(histogram.samples(name, labels)) for labels, histogram in series.items()}
+                for name, series in self._histograms.items()
+            }
+
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                counters.setdefault(name, {})[_freeze_labels(labels)] = value
+
+        lines: typing.List[str] = []
+
+        for name in sorted(counters):
+            lines.extend(self._header(name, "counter"))
+            for labels, value in sorted(counters[name].items()):
+                lines.append(f"{name}{_format_labels(labels)} {_format_number(value)}")
+
+        for name in sorted(histograms):
+            lines.extend(self._header(name, "histogram"))
+            for labels in sorted(histograms[name]):
+                lines.extend(histograms[name][labels])
+
+        return "\n".join(lines) + "\n"
+
+    def _header(self, name: str, default_type: str) -> typing.Iterable[str]:
+        metric_type, description = self._descriptions.get(name, (default_type, None))
+        if description:
+            yield f"# HELP {name} {description}"
+        yield f"# TYPE {name} {metric_type}"
+
+
+REGISTRY = MetricsRegistry()
+REGISTRY.describe(SPAN_DURATION, "histogram", "How long instrumented operations took")
+REGISTRY.describe(SPAN_QUERIES, "counter", "Database queries issued within instrumented operations")
+REGISTRY.describe(CACHE_HITS, "counter", "Lookups that were answered from a cache")
+REGISTRY.describe(CACHE_MISSES, "counter", "Lookups that a cache could not answer")
+REGISTRY.describe(REQUESTS, "counter", "Requests handled by each view")
+REGISTRY.describe(REQUEST_QUERIES, "counter", "Database queries issued while handling requests to each view")
+
+
+class Span:
+    """
+    Records how long a block of code took
+    """
+    __slots__ = ("name", "_start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self._start = 0.0
+
+    def __enter__(self) -> Span:
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        REGISTRY.observe(SPAN_DURATION, time.perf_counter() - self._start, span=self.name)
+
+
+class _DisabledSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> _DisabledSpan:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_DISABLED_SPAN = _DisabledSpan()
+
+
+def span(name: str) -> typing.ContextManager:
+    """
+    Time a block of code
+
+    Example:
+        >>> with span("import"):
+        ...     import_stack(data)
+
+    :param name: What to call the timed operation
+    :return: A context manager that records how long its block took
+    """
+    if not is_enabled():
+        return _DISABLED_SPAN
+    return Span(name)
+
+
+def _count_queries(name: str, function: typing.Callable, *args, **kwargs):
+    from django.db import connection
+
+    queries = 0
+
+    def count(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    try:
+        with connection.execute_wrapper(count):
+            return function(*args, **kwargs)
+    finally:
+        REGISTRY.increment(SPAN_QUERIES, queries, span=name)
+
+
+def instrumented(name: str, count_queries: bool = False) -> typing.Callable[[_FUNCTION], _FUNCTION]:
+    """
+    Time every call to a function
+
+    The function is returned untouched if instrumentation is disabled
+
+    Example:
+        >>> @property
+        ... @instrumented("network")
+        ... def value(self):
+        ...     ...
+
+    :param name: What to call the timed operation
+    :param count_queries: Whether to also count the database queries issued during each call
+    :return: A decorator that adds instrumentation to a function
+    """
+    def decorate(function: _FUNCTION) -> _FUNCTION:
+        if not is_enabled():
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Span(name):
+                if count_queries:
+                    return _count_queries(name, function, *args, **kwargs)
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+class QueryCountMiddleware:
+    """
+    Counts the database queries issued while handling each request
+
+    The count is sent back in the `X-DB-Queries` header when `SWARM_COMPOSE_QUERY_COUNT_HEADER` is on and added to the
+    per view totals when instrumentation is on. The middleware removes itself when neither is on.
+    """
+    def __init__(self, get_response: typing.Callable):
+        from django.core.exceptions import MiddlewareNotUsed
+
+        if not (is_enabled() or application_settings.QUERY_COUNT_HEADER):
+            raise MiddlewareNotUsed()
+
+        self.get_response = get_response
+
+    def __call__(self, request):
+        from django.db import connections
+
+        queries = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with contextlib.ExitStack() as wrappers:
+            for connection in connections.all():
+                wrappers.enter_context(connection.execute_wrapper(count))
+            response = self.get_response(request)
+
+        if application_settings.QUERY_COUNT_HEADER:
+            response[QUERY_COUNT_HEADER] = str(queries)
+
+        if is_enabled():
+            view = request.resolver_match.view_name if request.resolver_match else "unresolved"
+            REGISTRY.increment(REQUESTS, view=view)
+            REGISTRY.increment(REQUEST_QUERIES, queries, view=view)
+
+        return response
@@ -0,0 +1,374 @@
+"""
+Resolves compose variable interpolation (`$VAR`, `${VAR}`, `${VAR:-default}`, `${VAR:?error}`, and friends)
+
+Every templated string is parsed once into a cached sequence of tokens. A rendered document is compiled once into a
+plan that only remembers where its templated strings are, so resolving the same document against many environments
+only touches the values that actually change.
+"""
+from __future__ import annotations
+
+import abc
+import functools
+import re
+import typing
+
+from builder import instrumentation
+
+ENVIRONMENT = typing.Mapping[str, str]
+
+NAME_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+OPERATORS: typing.Sequence[str] = (":-", ":?", ":+", "-", "?", "+")
+"""Operators that may follow a variable name within braces, longest first so that ':-' isn't read as ':'"""
+
+TEMPLATE_CACHE_SIZE = 65536
+"""The maximum number of parsed templates to remember"""
+
+
+class InterpolationError(ValueError):
+    """
+    Raised when a templated string is malformed or a required variable is missing
+    """
+    def __init__(
+        self,
+        message: str,
+        path: typing.Sequence[typing.Union[str, int]] = (),
+        environment: typing.Optional[str] = None
+    ):
+        """
+        :param message: What went wrong
+        :param path: The keys leading to the value that could not be resolved
+        :param environment: The name of the environment that was being resolved against
+        """
+        self.message = message
+        self.path = tuple(path)
+        self.environment = environment
+        location = ".".join(str(key) for key in self.path)
+        description = f"{location}: {message}" if location else message
+        super().__init__(f"[{environment}] {description}" if environment else description)
+
+
+class Literal(typing.NamedTuple):
+    """
+    Text that is used exactly as written
+    """
+    text: str
+
+
+class Variable(typing.NamedTuple):
+    """
+    A reference to a variable, optionally with an operator deciding what to do when it is unset or empty
+    """
+    name: str
+    operator: typing.Optional[str] = None
+    argument: typing.Tuple[typing.Union[Literal, Variable], ...] = ()
+
+
+TOKENS = typing.Tuple[typing.Union[Literal, Variable], ...]
+
+
+def _find_closing_brace(template: str, start: int) -> int:
+    """
+    :param template: The string being parsed
+    :param start: The index just after an opening '${'
+    :return: The index of the brace that closes it
+    """
+    depth = 1
+    index = start
+
+    while index < len(template):
+        character = template[index]
+        if character == "$" and template.startswith("$$", index):
+            index += 2
+            continue
+        if character == "$" and template.startswith("${", index):
+            depth += 1
+            index += 2
+            continue
+        if character == "}":
+            depth -= 1
+            if depth == 0:
+                return index
+        index += 1
+
+    raise InterpolationError(f"Invalid interpolation format: missing '}}' in '{template}'")
+
+
+def _parse_braced(expression: str, template: str) -> Variable:
+    """
+    :param expression: Everything between '${' and its closing '}'
+    :param template: The whole string being parsed, for error messages
+    :return: The variable described by the expression
+    """
+    name_match = NAME_PATTERN.match(expression)
+
+    if name_match is None:
+        raise InterpolationError(f"Invalid interpolation format for '{template}': '${{{expression}}}'")
+
+    name = name_match.group()
+    remainder = expression[name_match.end():]
+
+    if not remainder:
+        return Variable(name=name)
+
+    for operator in OPERATORS:
+        if remainder.startswith(operator):
+            return Variable(name=name, operator=operator, argument=parse(remainder[len(operator):]))
+
+    raise InterpolationError(f"Invalid interpolation format for '{template}': '${{{expression}}}'")
+
+
+def _flush_literal(tokens: typing.List[typing.Union[Literal, Variable]], text: typing.List[str]):
+    """
+    Move collected text into the list of tokens
+
+    :param tokens: The tokens parsed so far
+    :param text: Pieces of text that have been collected since the last variable. Emptied afterwards
+    """
+    literal = "".join(text)
+    if literal:
+        tokens.append(Literal(literal))
+    text.clear()
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def parse(template: str) -> TOKENS:
+    """
+    Break a templated string into tokens
+
+    Example:
+        >>> parse("app:${TAG:-latest}")
+        (Literal(text='app:'), Variable(name='TAG', operator=':-', argument=(Literal(text='latest'),)))
+
+    :param template: The string to parse
+    :return: The literal and variable pieces of the string, in order
+    """
+    tokens: typing.List[typing.Union[Literal, Variable]] = []
+    text: typing.List[str] = []
+    index = 0
+
+    while index < len(template):
+        dollar = template.find("$", index)
+
+        if dollar < 0:
+            text.append(template[index:])
+            break
+
+        text.append(template[index:dollar])
+        following = template[dollar + 1:dollar + 2]
+
+        if following == "$":
+            text.append("$")
+            index = dollar + 2
+        elif following == "{":
+            closing = _find_closing_brace(template, dollar + 2)
+            _flush_literal(tokens, text)
+            tokens.append(_parse_braced(template[dollar + 2:closing], template))
+            index = closing + 1
+        else:
+            name_match = NAME_PATTERN.match(template, dollar + 1)
+            if name_match is None:
+                text.append("$")
+                index = dollar + 1
+            else:
+                _flush_literal(tokens, text)
+                tokens.append(Variable(name=name_match.group()))
+                index = name_match.end()
+
+    _flush_literal(tokens, text)
+    return tuple(tokens)
+
+
+def resolve(tokens: TOKENS, environment: ENVIRONMENT) -> str:
+    """
+    :param tokens: A parsed template
+    :param environment: Variable names mapped to their values
+    :return: The template with every variable replaced
+    """
+    pieces: typing.List[str] = []
+
+    for token in tokens:
+        if isinstance(token, Literal):
+            pieces.append(token.text)
+            continue
+
+        value = environment.get(token.name)
+        operator = token.operator
+
+        if operator is None:
+            pieces.append(value or "")
+        elif operator == ":-":
+            pieces.append(value if value else resolve(token.argument, environment))
+        elif operator == "-":
+            pieces.append(value if value is not None else resolve(token.argument, environment))
+        elif operator == ":+":
+            pieces.append(resolve(token.argument, environment) if value else "")
+        elif operator == "+":
+            pieces.append(resolve(token.argument, environment) if value is not None else "")
+        elif operator == ":?":
+            if not value:
+                raise InterpolationError(
+                    resolve(token.argument, environment) or f"required variable {token.name} is missing a value"
+                )
+            pieces.append(value)
+        elif operator == "?":
+            if value is None:
+                raise InterpolationError(
+                    resolve(token.argument, environment) or f"required variable {token.name} is missing a value"
+                )
+            pieces.append(value)
+
+    return "".join(pieces)
+
+
+def interpolate(template: str, environment: ENVIRONMENT) -> str:
+    """
+    :param template: A string that may contain variables
+    :param environment: Variable names mapped to their values
+    :return: The string with every variable replaced
+    """
+    if "$" not in template:
+        return template
+    return resolve(parse(template), environment)
+
+
+def get_variable_names(tokens: TOKENS) -> typing.Set[str]:
+    """
+    :param tokens: A parsed template
+    :return: The name of every variable the template refers to, including those within defaults
+    """
+    names: typing.Set[str] = set()
+    for token in tokens:
+        if isinstance(token, Variable):
+            names.add(token.name)
+            names.update(get_variable_names(token.argument))
+    return names
+
+
+class _Plan(abc.ABC):
+    """
+    Describes where the templated strings are within part of a document
+    """
+    @abc.abstractmethod
+    def resolve(self, environment: ENVIRONMENT, path: typing.Tuple[typing.Union[str, int], ...]) -> typing.Any:
+        """
+        :param environment: Variable names mapped to their values
+        :param path: The keys leading to this part of the document, for error messages
+        :return: This part of the document with every variable replaced
+        """
+
+    @abc.abstractmethod
+    def get_variable_names(self) -> typing.Set[str]:
+        """
+        :return: The name of every variable that this part of the document refers to
+        """
+
+
+class _TemplatePlan(_Plan):
+    def __init__(self, tokens: TOKENS):
+        self.tokens = tokens
+
+    def resolve(self, environment: ENVIRONMENT, path: typing.Tuple[typing.Union[str, int], ...]) -> str:
+        try:
+            return resolve(self.tokens, environment)
+        except InterpolationError as error:
+            raise InterpolationError(error.message, path=path) from None
+
+    def get_variable_names(self) -> typing.Set[str]:
+        return get_variable_names(self.tokens)
+
+
+class _ContainerPlan(_Plan):
+    def __init__(
+        self,
+        original: typing.Union[typing.Dict[str, typing.Any], typing.List[typing.Any]],
+        members: typing.Dict[typing.Union[str, int], _Plan]
+    ):
+        self.original = original
+        self.members = members
+
+    def resolve(
+        self,
+        environment: ENVIRONMENT,
+        path: typing.Tuple[typing.Union[str, int], ...]
+    ) -> typing.Union[typing.Dict[str, typing.Any], typing.List[typing.Any]]:
+        resolved = self.original.copy()
+        for key, plan in self.members.items():
+            resolved[key] = plan.resolve(environment, path + (key,))
+        return resolved
+
+    def get_variable_names(self) -> typing.Set[str]:
+        names: typing.Set[str] = set()
+        for plan in self.members.values():
+            names.update(plan.get_variable_names())
+        return names
+
+
+def _compile(value: typing.Any) -> typing.Optional[_Plan]:
+    """
+    :param value: Part of a document
+    :return: A plan for resolving that part of the document. None if it contains no templates
+    """
+    if isinstance(value, str):
+        if "$" not in value:
+            return None
+        return _TemplatePlan(parse(value))
+
+    if isinstance(value, dict):
+        members = {key: _compile(member) for key, member in value.items()}
+    elif isinstance(value, list):
+        members = {index: _compile(member) for index, member in enumerate(value)}
+    else:
+        return None
+
+    members = {key: plan for key, plan in members.items() if plan is not None}
+    return _ContainerPlan(value, members) if members else None
+
+
+class CompiledDocument:
+    """
+    A rendered document that has been prepared to be resolved against any number of environments
+
+    Parts of the document that contain no variables are shared between every resolved copy rather than copied, so
+    resolved documents should be treated as read only.
+    """
+    def __init__(self, document: typing.Dict[str, typing.Any]):
+        """
+        :param document: The rendered document to prepare
+        """
+        self.document = document
+        self._plan = _compile(document)
+
+    @property
+    def variable_names(self) -> typing.Set[str]:
+        """
+        The name of every variable that the document refers to
+        """
+        return self._plan.get_variable_names() if self._plan else set()
+
+    @instrumentation.instrumented("interpolation")
+    def resolve(self, environment: ENVIRONMENT) -> typing.Dict[str, typing.Any]:
+        """
+        :param environment: Variable names mapped to their values
+        :return: A copy of the document with every variable replaced
+        """
+        if self._plan is None:
+            return self.document
+        return self._plan.resolve(environment, ())
+
+    def resolve_all(
+        self,
+        environments: typing.Mapping[str, ENVIRONMENT]
+    ) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """
+        :param environments: Environment names mapped to their variables
+        :return: Environment names mapped to the document resolved against them
+        """
+        documents: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+
+        for name, environment in environments.items():
+            try:
+                documents[name] = self.resolve(environment)
+            except InterpolationError as error:
+                raise InterpolationError(error.message, path=error.path, environment=name) from None
+
+        return documents
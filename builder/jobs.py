@@ -0,0 +1,418 @@
+"""
+A local, database backed job queue that lets web requests hand off heavy work and return immediately
+
+Job types are registered with the `job_type` decorator and are performed by the worker pool started through
+`manage.py run_job_workers`. No external broker is needed; the `Job` table is the queue.
+"""
+from __future__ import annotations
+
+import inspect
+import os
+import socket
+import threading
+import traceback
+import typing
+
+from datetime import timedelta
+
+from django.db import close_old_connections
+from django.db import connection
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import Subquery
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import LessThan
+from django.utils import timezone
+
+from builder.models.jobs import Job
+from builder.models.jobs import JobStatus
+
+JOB_HANDLER = typing.Callable[..., typing.Any]
+"""A function that accepts the running `Job` followed by its keyword arguments"""
+
+CLAIM_BATCH_SIZE = 20
+"""The number of candidate jobs that a worker will look at each time it checks the queue"""
+
+
+class UnknownJobType(KeyError):
+    """
+    Raised when a job type is requested that was never registered
+    """
+
+
+class RetryPolicy:
+    """
+    Dictates how many times a job may be attempted and how long to wait between attempts
+    """
+    def __init__(self, max_attempts: int = 1, delay: float = 0.0, backoff: float = 2.0):
+        """
+        :param max_attempts: How many times a job may be started before it is considered failed
+        :param delay: The number of seconds to wait before the first retry
+        :param backoff: What to multiply the delay by for each subsequent retry
+        """
+        self.max_attempts = max(int(max_attempts), 1)
+        self.delay = max(float(delay), 0.0)
+        self.backoff = max(float(backoff), 1.0)
+
+    def get_delay(self, attempt: int) -> float:
+        """
+        Get the number of seconds to wait before starting a job again
+
+        :param attempt: The number of the attempt that just failed, starting at 1
+        :return: The number of seconds to wait
+        """
+        return self.delay * (self.backoff ** max(attempt - 1, 0))
+
+
+class JobType:
+    """
+    A registered kind of job, describing how to run it and how many may run at once
+    """
+    def __init__(
+        self,
+        name: str,
+        handler: JOB_HANDLER,
+        concurrency: typing.Optional[int] = None,
+        retry_policy: RetryPolicy = None
+    ):
+        """
+        :param name: The name that jobs will be enqueued under
+        :param handler: The function that performs the work
+        :param concurrency: The maximum number of jobs of this type that may run at once. Unlimited if None
+        :param retry_policy: How failures should be retried
+        """
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.retry_policy = retry_policy or RetryPolicy()
+
+    def __str__(self):
+        return self.name
+
+
+_JOB_TYPES: typing.Dict[str, JobType] = {}
+
+
+def job_type(
+    name: str,
+    concurrency: typing.Optional[int] = None,
+    max_attempts: int = 1,
+    retry_delay: float = 0.0,
+    backoff: float = 2.0
+) -> typing.Callable[[JOB_HANDLER], JOB_HANDLER]:
+    """
+    Register a function as a job type that may be enqueued
+
+    Example:
+        >>> @job_type("validate_stack", concurrency=2, max_attempts=3, retry_delay=5)
+        ... def validate_stack(job: Job, stack_id: int):
+        ...     ...
+
+    :param name: The name that jobs will be enqueued under
+    :param concurrency: The maximum number of jobs of this type that may run at once. Unlimited if None
+    :param max_attempts: How many times a job may be started before it is considered failed
+    :param retry_delay: The number of seconds to wait before the first retry
+    :param backoff: What to multiply the delay by for each subsequent retry
+    :return: A decorator that registers the function and returns it unchanged
+    """
+    def register(handler: JOB_HANDLER) -> JOB_HANDLER:
+        _JOB_TYPES[name] = JobType(
+            name=name,
+            handler=handler,
+            concurrency=concurrency,
+            retry_policy=RetryPolicy(max_attempts=max_attempts, delay=retry_delay, backoff=backoff)
+        )
+        return handler
+
+    return register
+
+
+def get_job_type(name: str) -> JobType:
+    """
+    :param name: The name of a registered job type
+    :return: The registered job type
+    """
+    try:
+        return _JOB_TYPES[name]
+    except KeyError:
+        raise UnknownJobType(f"There is no job type named '{name}'") from None
+
+
+def get_job_types() -> typing.Sequence[JobType]:
+    """
+    :return: Every registered job type
+    """
+    return list(_JOB_TYPES.values())
+
+
+def enqueue(name: str, delay: float = 0.0, **arguments) -> Job:
+    """
+    Add a job to the queue
+
+    :param name: The name of the registered job type to run
+    :param delay: The number of seconds to wait before the job may be started
+    :param arguments: JSON serializable keyword arguments for the job's handler
+    :return: The newly queued job
+    :raises TypeError: If the handler can't be called with the given arguments
+    """
+    registered_type = get_job_type(name)
+
+    # The handler won't be called until a worker picks the job up, so bad arguments are caught now, while there is
+    # still someone to tell about them
+    try:
+        inspect.signature(registered_type.handler).bind(None, **arguments)
+    except TypeError as error:
+        raise TypeError(f"Invalid arguments for job type '{name}': {error}") from error
+
+    return Job.objects.create(
+        job_type=registered_type.name,
+        arguments=arguments,
+        max_attempts=registered_type.retry_policy.max_attempts,
+        run_after=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+def claim_next_job(worker: str, job_types: typing.Iterable[str] = None) -> typing.Optional[Job]:
+    """
+    Mark the next available job as running on behalf of a worker
+
+    A job is only claimed if doing so would not exceed the concurrency limit of its type. Each claim is a single
+    conditional update that both checks the limit and takes the job, so two workers can never claim the same job and
+    can't both slip in under a limit.
+
+    :param worker: The name of the worker claiming the job
+    :param job_types: The names of the job types that the worker is allowed to run. Any registered type if None
+    :return: The claimed job, if one was available
+    """
+    allowed_types = set(job_types) if job_types is not None else set(_JOB_TYPES)
+
+    running_counts = dict(
+        Job.objects.filter(status=JobStatus.running, job_type__in=allowed_types)
+        .order_by()
+        .values_list("job_type")
+        .annotate(count=Count("pk"))
+    )
+
+    for type_name, running_count in running_counts.items():
+        limit = _JOB_TYPES[type_name].concurrency
+        if limit is not None and running_count >= limit:
+            allowed_types.discard(type_name)
+
+    if not allowed_types:
+        return None
+
+    candidates = (
+        Job.objects.filter(status=JobStatus.queued, job_type__in=allowed_types, run_after__lte=timezone.now())
+        .order_by("run_after", "pk")
+        .values_list("pk", "job_type")[:CLAIM_BATCH_SIZE]
+    )
+
+    for candidate, type_name in candidates:
+        if _claim(candidate, type_name, worker):
+            return Job.objects.get(pk=candidate)
+
+    return None
+
+
+def _claim(job_id: int, type_name: str, worker: str) -> bool:
+    """
+    Take a queued job for a worker as long as its type is still under its concurrency limit
+
+    :param job_id: The primary key of the job to take
+    :param type_name: The name of the job's type
+    :param worker: The name of the worker taking the job
+    :return: True if the job was taken
+    """
+    claimable = Job.objects.filter(pk=job_id, status=JobStatus.queued)
+    limit = _JOB_TYPES[type_name].concurrency
+
+    with transaction.atomic():
+        # Other workers may have claimed jobs of the same type since the candidates were picked, so the limit is
+        # checked again within the same statement that takes the job
+        if limit is not None:
+            running_count = (
+                Job.objects.filter(job_type=type_name, status=JobStatus.running)
+                .order_by()
+                .values("job_type")
+                .annotate(count=Count("pk"))
+                .values("count")
+            )
+            claimable = claimable.filter(LessThan(Coalesce(Subquery(running_count), Value(0)), limit))
+
+            # Postgres lets concurrent updates of different rows each count the running jobs before the others commit,
+            # so claims of the same type are made one at a time. SQLite only ever has one writer anyway
+            if connection.vendor == "postgresql":
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [f"builder.job:{type_name}"])
+
+        return bool(
+            claimable.update(
+                status=JobStatus.running,
+                worker=worker,
+                started=timezone.now(),
+                attempts=F("attempts") + 1,
+                progress=0.0,
+                progress_message=None,
+            )
+        )
+
+
+def run_job(job: Job):
+    """
+    Perform a claimed job and record its outcome
+
+    Failed jobs are put back in the queue if their retry policy allows it
+
+    :param job: A job that has been claimed by a worker
+    """
+    try:
+        registered_type = get_job_type(job.job_type)
+        result = registered_type.handler(job, **job.arguments)
+    except Exception as exception:
+        job.error = "".join(traceback.format_exception(exception))
+
+        retry_policy = _JOB_TYPES[job.job_type].retry_policy if job.job_type in _JOB_TYPES else RetryPolicy()
+
+        if job.attempts < job.max_attempts:
+            job.status = JobStatus.queued
+            job.run_after = timezone.now() + timedelta(seconds=retry_policy.get_delay(job.attempts))
+        else:
+            job.status = JobStatus.failed
+            job.finished = timezone.now()
+
+        job.save(update_fields=["status", "error", "run_after", "finished"])
+        return
+
+    job.status = JobStatus.succeeded
+    job.result = result
+    job.progress = 1.0
+    job.finished = timezone.now()
+    job.save(update_fields=["status", "result", "progress", "finished"])
+
+
+def cancel_job(job: Job) -> bool:
+    """
+    Cancel a job if it has not been started yet
+
+    :param job: The job to cancel
+    :return: True if the job was cancelled
+    """
+    cancelled = Job.objects.filter(pk=job.pk, status=JobStatus.queued).update(
+        status=JobStatus.cancelled,
+        finished=timezone.now()
+    )
+    job.refresh_from_db()
+    return bool(cancelled)
+
+
+def get_pool_name(process_id: int = None) -> str:
+    """
+    :param process_id: The id of the process running the pool. The current process if None
+    :return: The name that a worker pool in the given process on this host goes by
+    """
+    return f"{socket.gethostname()}:{process_id or os.getpid()}"
+
+
+def _is_process_alive(process_id: int) -> bool:
+    try:
+        os.kill(process_id, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to someone else
+        return True
+    return True
+
+
+def requeue_running_jobs() -> int:
+    """
+    Put jobs that were left running by workers on this host that are no longer alive back in the queue
+
+    Jobs held by workers on other hosts, or by pools on this host whose processes are still running, are left alone
+    since there is no way to tell from here whether they are still being worked on.
+
+    :return: The number of jobs that were put back in the queue
+    """
+    host_prefix = f"{socket.gethostname()}:"
+    workers = (
+        Job.objects.filter(status=JobStatus.running, worker__startswith=host_prefix)
+        .values_list("worker", flat=True)
+        .distinct()
+    )
+    abandoned = []
+
+    for worker in workers:
+        process_id = worker[len(host_prefix):].split(":", 1)[0]
+        if process_id.isdigit() and not _is_process_alive(int(process_id)):
+            abandoned.append(worker)
+
+    return Job.objects.filter(status=JobStatus.running, worker__in=abandoned).update(
+        status=JobStatus.queued,
+        worker=None
+    )
+
+
+class WorkerPool:
+    """
+    A set of threads that repeatedly claim and run jobs from the queue
+    """
+    def __init__(self, workers: int, poll_interval: float = 1.0, job_types: typing.Iterable[str] = None):
+        """
+        :param workers: The number of threads to run jobs on
+        :param poll_interval: The number of seconds an idle worker waits before checking the queue again
+        :param job_types: The names of the job types that this pool may run. Any registered type if None
+        """
+        self.workers = max(int(workers), 1)
+        self.poll_interval = poll_interval
+        self.job_types = list(job_types) if job_types else None
+        self.name = get_pool_name()
+        self._stop = threading.Event()
+        self._threads: typing.List[threading.Thread] = []
+
+    def _work(self, worker: str):
+        try:
+            while not self._stop.is_set():
+                close_old_connections()
+                job = claim_next_job(worker=worker, job_types=self.job_types)
+
+                if job is None:
+                    self._stop.wait(self.poll_interval)
+                else:
+                    run_job(job)
+        finally:
+            close_old_connections()
+
+    def start(self):
+        """
+        Start every worker thread
+        """
+        self._stop.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._work,
+                args=(f"{self.name}:{index}",),
+                name=f"job-worker-{index}",
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = None):
+        """
+        Ask every worker to stop once it finishes its current job and wait for them to do so
+
+        :param timeout: The number of seconds to wait for each thread
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads.clear()
+
+    def wait(self):
+        """
+        Block until the pool is stopped
+        """
+        while not self._stop.wait(self.poll_interval):
+            pass
@@ -0,0 +1,27 @@
+"""
+Regenerates the search document of every service
+"""
+from django.core.management.base import BaseCommand
+
+from builder import jobs
+from builder import search
+
+
+class Command(BaseCommand):
+    help = "Regenerate the search document of every service and recreate the database's search index if needed"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--background",
+            action="store_true",
+            help="Queue a job to rebuild the index rather than rebuilding it right away"
+        )
+
+    def handle(self, *args, **options):
+        if options["background"]:
+            job = jobs.enqueue(search.REBUILD_JOB)
+            self.stdout.write(f"Queued job {job.pk} to rebuild the search index")
+            return
+
+        written = search.rebuild_index()
+        self.stdout.write(f"Wrote {written} search document(s)")
@@ -0,0 +1,67 @@
+"""
+Starts a pool of workers that perform jobs from the local background job queue
+"""
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from SwarmCompose import application_settings
+
+from builder import jobs
+
+
+class Command(BaseCommand):
+    help = "Start a pool of workers that perform queued background jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=application_settings.JOB_WORKERS,
+            help="The number of jobs that may be performed at once"
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=application_settings.JOB_POLL_INTERVAL,
+            help="The number of seconds an idle worker waits before checking the queue again"
+        )
+        parser.add_argument(
+            "--job-type",
+            action="append",
+            dest="job_types",
+            help="Only perform jobs of this type. May be given more than once"
+        )
+        parser.add_argument(
+            "--requeue-running",
+            action="store_true",
+            help="Put jobs that were left running by stopped pools on this host back in the queue before starting"
+        )
+
+    def handle(self, *args, **options):
+        if options["job_types"]:
+            for name in options["job_types"]:
+                try:
+                    jobs.get_job_type(name)
+                except jobs.UnknownJobType as error:
+                    raise CommandError(error.args[0]) from error
+
+        if options["requeue_running"]:
+            requeued = jobs.requeue_running_jobs()
+            self.stdout.write(f"Put {requeued} running job(s) back in the queue")
+
+        pool = jobs.WorkerPool(
+            workers=options["workers"],
+            poll_interval=options["poll_interval"],
+            job_types=options["job_types"]
+        )
+        pool.start()
+
+        registered = ", ".join(sorted(job_type.name for job_type in jobs.get_job_types())) or "none"
+        self.stdout.write(f"Started {pool.workers} worker(s) as {pool.name}; registered job types: {registered}")
+
+        try:
+            pool.wait()
+        except KeyboardInterrupt:
+            self.stdout.write("Waiting for running jobs to finish...")
+        finally:
+            pool.stop()
@@ -0,0 +1,63 @@
+"""
+Reports where secrets are used and which secrets are unused or undeclared
+"""
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from builder import secret_usage
+
+
+class Command(BaseCommand):
+    help = "Show everything that uses a secret, or list secrets that are unused or used without being declared"
+
+    def add_arguments(self, parser):
+        parser.add_argument("secrets", nargs="*", help="The names of secrets to show the consumers of")
+        parser.add_argument("--stack", type=int, help="Only look within the stack with this id")
+        parser.add_argument(
+            "--unused",
+            action="store_true",
+            help="List secrets that are declared by a stack but never used within it"
+        )
+        parser.add_argument(
+            "--undeclared",
+            action="store_true",
+            help="List secrets that are used within a stack that doesn't declare them"
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Regenerate the index of secret usages before reporting"
+        )
+
+    def handle(self, *args, **options):
+        if not (options["secrets"] or options["unused"] or options["undeclared"] or options["rebuild"]):
+            raise CommandError("Name at least one secret or pass --unused, --undeclared, or --rebuild")
+
+        stack_id = options["stack"]
+
+        if options["rebuild"]:
+            self.stdout.write(f"Indexed {secret_usage.rebuild_index()} secret usage(s)")
+
+        for source in options["secrets"]:
+            consumers = list(secret_usage.find_consumers(source, stack_id=stack_id))
+            self.stdout.write(f"{source}: used {len(consumers)} time(s)")
+            for usage in consumers:
+                details = ", ".join(
+                    f"{field}={getattr(usage, field)}"
+                    for field in ("target", "uid", "gid", "mode")
+                    if getattr(usage, field) is not None
+                )
+                location = f"{usage.stack.name}/{usage.service.name} ({usage.consumer})"
+                self.stdout.write(f"    {location}" + (f": {details}" if details else ""))
+
+        if options["unused"]:
+            unused = list(secret_usage.find_unused_secrets(stack_id=stack_id))
+            self.stdout.write(f"Unused secrets: {len(unused)}")
+            for secret in unused:
+                self.stdout.write(f"    {secret.stack.name}/{secret.name}")
+
+        if options["undeclared"]:
+            undeclared = secret_usage.find_undeclared_secrets(stack_id=stack_id)
+            self.stdout.write(f"Undeclared secrets: {len(undeclared)}")
+            for secret in undeclared:
+                self.stdout.write(f"    {secret.stack_name}/{secret.source}")
@@ -1,6 +1,8 @@
 """
 @TODO: Put a module wide description here
 """
+from .stack import Stack
+
 from .networking import Network
 from .networking import NetworkDriverOptions
 from .networking import IPAddressManagementConfig
@@ -9,9 +11,30 @@ from .networking import NetworkLabel
 
 from .service import Service
 from .service import ServiceAnnotation
+from .service import ServiceDependency
+from .service import ServiceDependencyCondition
+
+from .deploy import Deploy
+from .deploy import DeployLabel
 
 from .build import BuildConfiguration
 from .build import BuildArg
 from .build import BuildSecret
 from .build import ImageLabel
 from .build import ImageTags
+
+from .secrets import Secret
+
+from .secret_usage import SecretConsumer
+from .secret_usage import SecretUsage
+
+from .environment import EnvironmentProfile
+from .environment import EnvironmentVariable
+
+from .jobs import Job
+from .jobs import JobStatus
+
+from .search import SearchDocument
+
+from .changes import ChangeAction
+from .changes import ChangeEvent
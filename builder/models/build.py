@@ -7,16 +7,21 @@ import typing
 
 from django.db import models
 
+from builder.instrumentation import instrumented
 from builder.models.common import StringMap
 from builder.models.common import StringList
+from builder.models.common import TrackedModel
 from builder.models.secrets import UsedSecret
 from builder.models.service import Service
 
 
-class BuildConfiguration(models.Model):
+class BuildConfiguration(TrackedModel):
     """
     Dictates how a Service's container should be built
     """
+    class Meta:
+        ordering = ["pk"]
+
     service: Service = models.ForeignKey(Service, on_delete=models.CASCADE)
     context = models.FilePathField(
         default=".",
@@ -54,9 +59,11 @@ class BuildConfiguration(models.Model):
 
     # shm_size is a bit too in the weeds for now so that won't be included
 
-    target: str = models.CharField(
+    target: typing.Optional[str] = models.CharField(
         max_length=255,
-        help_text="Defines the stage to build as defined inside a multi-stage Dockerfile"
+        help_text="Defines the stage to build as defined inside a multi-stage Dockerfile",
+        blank=True,
+        null=True
     )
 
     # ulimits is a bit too in the weeds for now so that won't be included
@@ -75,6 +82,7 @@ class BuildConfiguration(models.Model):
         )
 
     @property
+    @instrumented("build_configuration")
     def value(self) -> typing.Union[str, typing.Dict[str, typing.Any]]:
         if self.is_short_form:
             return self.context
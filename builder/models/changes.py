@@ -0,0 +1,67 @@
+"""
+Models describing the append only record of changes made to builder data
+"""
+from __future__ import annotations
+
+import typing
+
+from django.db import models
+
+
+class ChangeAction(models.TextChoices):
+    """
+    What happened to a row
+    """
+    created = "created"
+    updated = "updated"
+    deleted = "deleted"
+
+
+class ChangeEvent(models.Model):
+    """
+    A single change to a row of a builder model
+
+    Events are written by `builder.changes` just before the transaction that made the change commits. Their primary
+    keys only ever increase, and become visible in that order, so a consumer that remembers the last key it processed
+    can ask for everything that came after it.
+    The stack is stored as a plain number rather than a foreign key so that events outlive what they describe.
+    """
+    class Meta:
+        ordering = ["pk"]
+        indexes = [
+            models.Index(fields=["stack_id", "id"], name="builder_change_stack_idx"),
+            models.Index(fields=["model", "id"], name="builder_change_model_idx"),
+        ]
+
+    created = models.DateTimeField(auto_now_add=True, help_text="When the event was recorded")
+    action: str = models.CharField(max_length=20, choices=ChangeAction, help_text="What happened to the row")
+    model: str = models.CharField(
+        max_length=100,
+        help_text="The label of the changed row's model, like 'builder.Service'"
+    )
+    object_id: int = models.BigIntegerField(help_text="The primary key of the changed row")
+    stack_id: typing.Optional[int] = models.BigIntegerField(
+        blank=True,
+        null=True,
+        help_text="The primary key of the stack that the changed row belongs to. Empty for rows outside of any stack"
+    )
+    changed_fields: typing.List[str] = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="The names of the fields that an update changed"
+    )
+
+    @property
+    def value(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "id": self.pk,
+            "created": self.created.isoformat() if self.created else None,
+            "action": self.action,
+            "model": self.model,
+            "object_id": self.object_id,
+            "stack": self.stack_id,
+            "changed_fields": self.changed_fields,
+        }
+
+    def __str__(self):
+        return f"#{self.pk}: {self.model} #{self.object_id} {self.action}"
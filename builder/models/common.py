@@ -2,10 +2,57 @@
 @TODO: Put a module wide description here
 """
 
+from __future__ import annotations
+
+import typing
+
 from django.db import models
 
 
-class StringList(models.Model):
+class TrackedModel(models.Model):
+    """
+    An abstract model that remembers the values of its fields as they were last loaded or saved, so that the change
+    feed can tell which fields an update changed without reading the row again
+    """
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._stored_values = dict(zip(field_names, values))
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self.remember_stored_values(fields)
+
+    def remember_stored_values(self, fields: typing.Iterable[str] = None):
+        """
+        Record the current values of fields as what is stored for the row
+
+        :param fields: The names of the fields whose values were just loaded or saved. Every loaded field if not given
+        """
+        if fields is None:
+            deferred = self.get_deferred_fields()
+            attnames = [field.attname for field in self._meta.concrete_fields if field.attname not in deferred]
+            stored = self.__dict__["_stored_values"] = {}
+        else:
+            attnames = [self._meta.get_field(name).attname for name in fields]
+            stored = self.__dict__.setdefault("_stored_values", {})
+
+        for attname in attnames:
+            stored[attname] = getattr(self, attname)
+
+    def get_stored_values(self) -> typing.Mapping[str, typing.Any]:
+        """
+        :return: The value of each field, keyed by attname, as it was last loaded or saved. Fields whose stored values
+            aren't known are left out
+        """
+        return self.__dict__.get("_stored_values", {})
+
+
+class StringList(TrackedModel):
     """
     An abstract model that specifies a list of values that can be used as a field for another model.
 
@@ -13,11 +60,13 @@ class StringList(models.Model):
     """
     class Meta:
         abstract = True
+        # Lists are rendered in the order their values were added so that output is the same every time
+        ordering = ["pk"]
 
     value: str = models.CharField(max_length=255)
 
 
-class StringMap(models.Model):
+class StringMap(TrackedModel):
     """
     An abstract model that maps a key string to a value string that can be used as a field for another model.
 
@@ -25,6 +74,7 @@ class StringMap(models.Model):
     """
     class Meta:
         abstract = True
+        ordering = ["pk"]
 
     key: str = models.CharField(max_length=255)
     value: str = models.CharField(max_length=255)
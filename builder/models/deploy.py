@@ -8,6 +8,8 @@ import typing
 from django.db import models
 
 from .common import StringMap
+from .common import TrackedModel
+from .service import Service
 
 
 ENDPOINT_MODE_CHOICES: typing.Iterable[typing.Tuple[str, str]] = [
@@ -16,11 +18,12 @@ ENDPOINT_MODE_CHOICES: typing.Iterable[typing.Tuple[str, str]] = [
 ]
 
 
-class Deploy(models.Model):
+class Deploy(TrackedModel):
     """
     The Compose Deploy Specification lets you declare additional metadata on services so Compose gets relevant data
     to allocate adequate resources on the platform and configure them to match your needs.
     """
+    service: Service = models.OneToOneField(Service, on_delete=models.CASCADE, related_name="deploy")
     endpoint_mode: typing.Optional[str] = models.CharField(
         max_length=10,
         choices=ENDPOINT_MODE_CHOICES,
@@ -29,6 +32,21 @@ class Deploy(models.Model):
         help_text="Specifies a service discovery method for external clients connecting to a service"
     )
 
+    @property
+    def value(self) -> typing.Dict[str, typing.Any]:
+        configuration: typing.Dict[str, typing.Any] = {}
+
+        if self.endpoint_mode:
+            configuration["endpoint_mode"] = self.endpoint_mode
+
+        if self.labels.exists():
+            configuration["labels"] = {
+                label.key: label.value
+                for label in self.labels.all()
+            }
+
+        return configuration
+
 
 class DeployLabel(StringMap):
     """
@@ -0,0 +1,49 @@
+"""
+Models describing named sets of variables that compose files may be interpolated with
+"""
+from __future__ import annotations
+
+import typing
+
+from django.db import models
+
+from builder.models.common import StringMap
+from builder.models.common import TrackedModel
+
+
+class EnvironmentProfile(TrackedModel):
+    """
+    A named set of variables, like 'dev' or 'prod-us-east', that templated values may be resolved against
+    """
+    name: str = models.CharField(max_length=255, unique=True, help_text="The name of the environment")
+    description: typing.Optional[str] = models.TextField(
+        blank=True,
+        null=True,
+        help_text="A description of where this environment is used"
+    )
+
+    @property
+    def value(self) -> typing.Dict[str, str]:
+        return {
+            variable.key: variable.value
+            for variable in self.variables.all()
+        }
+
+    def __str__(self):
+        return self.name
+
+
+class EnvironmentVariable(StringMap):
+    """
+    A variable that may be referenced as `${KEY}` within a compose file
+    """
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["profile", "key"], name="unique_variable_per_environment_profile")
+        ]
+
+    profile: EnvironmentProfile = models.ForeignKey(
+        EnvironmentProfile,
+        on_delete=models.CASCADE,
+        related_name="variables"
+    )
@@ -0,0 +1,135 @@
+"""
+Models describing work that has been handed off to the local background job queue
+"""
+from __future__ import annotations
+
+import typing
+
+from django.db import models
+from django.utils import timezone
+
+
+class JobStatus(models.TextChoices):
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+    cancelled = "cancelled"
+
+
+FINISHED_STATUSES: typing.Sequence[str] = (
+    JobStatus.succeeded,
+    JobStatus.failed,
+    JobStatus.cancelled,
+)
+"""Statuses that a job will never leave"""
+
+
+class Job(models.Model):
+    """
+    A unit of work that will be picked up and performed by a worker started through `manage.py run_job_workers`
+    """
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "run_after"], name="builder_job_claim_idx"),
+            models.Index(fields=["job_type", "status"], name="builder_job_type_status_idx"),
+        ]
+
+    job_type: str = models.CharField(max_length=255, help_text="The name of the registered job type to run")
+    status: str = models.CharField(
+        max_length=20,
+        choices=JobStatus,
+        default=JobStatus.queued,
+        help_text="Where the job is within its lifecycle"
+    )
+    arguments: typing.Dict[str, typing.Any] = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="Keyword arguments that will be passed to the job's handler"
+    )
+    result: typing.Any = models.JSONField(
+        blank=True,
+        null=True,
+        help_text="The value returned by the job's handler"
+    )
+    error: typing.Optional[str] = models.TextField(
+        blank=True,
+        null=True,
+        help_text="A description of the last error encountered while running the job"
+    )
+    progress: float = models.FloatField(default=0.0, help_text="How far along the job is, from 0 to 1")
+    progress_message: typing.Optional[str] = models.CharField(
+        max_length=255,
+        blank=True,
+        null=True,
+        help_text="A human readable description of what the job is currently doing"
+    )
+    attempts: int = models.PositiveIntegerField(default=0, help_text="How many times the job has been started")
+    max_attempts: int = models.PositiveIntegerField(
+        default=1,
+        help_text="How many times the job may be started before it is considered failed"
+    )
+    run_after = models.DateTimeField(
+        default=timezone.now,
+        help_text="The job will not be picked up by a worker before this time"
+    )
+    worker: typing.Optional[str] = models.CharField(
+        max_length=255,
+        blank=True,
+        null=True,
+        help_text="The name of the worker that last picked up the job"
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    @property
+    def is_finished(self) -> bool:
+        """
+        Whether the job has reached a state that it will never leave
+        """
+        return self.status in FINISHED_STATUSES
+
+    def report_progress(self, progress: float, message: str = None):
+        """
+        Record how far along the job is without touching any other field
+
+        :param progress: How far along the job is, from 0 to 1
+        :param message: An optional description of what the job is currently doing
+        """
+        self.progress = min(max(float(progress), 0.0), 1.0)
+        self.progress_message = message
+        Job.objects.filter(pk=self.pk).update(progress=self.progress, progress_message=self.progress_message)
+
+    @property
+    def progress_value(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "id": self.pk,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.progress_message,
+        }
+
+    @property
+    def value(self) -> typing.Dict[str, typing.Any]:
+        job = {
+            "id": self.pk,
+            "job_type": self.job_type,
+            "status": self.status,
+            "arguments": self.arguments,
+            "progress": self.progress,
+            "message": self.progress_message,
+            "attempts": self.attempts,
+            "max_attempts": self.max_attempts,
+            "created": self.created.isoformat() if self.created else None,
+            "started": self.started.isoformat() if self.started else None,
+            "finished": self.finished.isoformat() if self.finished else None,
+        }
+
+        if self.is_finished:
+            job["result"] = self.result
+
+        if self.error:
+            job["error"] = self.error
+
+        return job
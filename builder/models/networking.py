@@ -8,17 +8,58 @@ import typing
 from django.db import models
 from django.core.validators import RegexValidator
 
+from builder.instrumentation import instrumented
+from builder.models.common import TrackedModel
+from builder.models.stack import Stack
+
 IP_RANGE_VALIDATOR = RegexValidator(
     r'^(\d{3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|10\.\d{1,3}\.\d{1,3}\.\d{1,2})\/\d{2}$',
     message='Values must be in the format of "10.226.126.0/24" or "192.168.127.12/27"'
 )
 
 
-class Network(models.Model):
+class NetworkQuerySet(models.QuerySet):
+    def alive(self) -> NetworkQuerySet:
+        """
+        Leave out networks that have been marked for deletion
+        """
+        return self.filter(deleted_at__isnull=True)
+
+    def for_rendering(self) -> NetworkQuerySet:
+        """
+        Load everything needed to render networks up front so that rendering a network doesn't issue queries
+        """
+        return self.prefetch_related(
+            "labels",
+            "driver_opts",
+            "ipam_configs__auxilary_addresses",
+        )
+
+
+class Network(TrackedModel):
     """
     Defines how a network may be created and referenced
     """
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["stack", "name"],
+                condition=models.Q(deleted_at__isnull=True),
+                name="unique_live_network_name_per_stack"
+            )
+        ]
+        ordering = ["name"]
+
+    objects = NetworkQuerySet.as_manager()
+
+    stack: Stack = models.ForeignKey(Stack, on_delete=models.CASCADE, related_name="networks")
     name: str = models.CharField(max_length=255, help_text="The name of the network that services will reference")
+    deleted_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        db_index=True,
+        help_text="When the network was marked for deletion. Marked networks are purged in the background"
+    )
     driver: str = models.CharField(
         max_length=255,
         help_text="Which driver should be used for this network",
@@ -94,6 +135,7 @@ class Network(models.Model):
         ]
 
     @property
+    @instrumented("network")
     def value(self) -> typing.Dict[str, typing.Any]:
         config = {
             "name": self.name
@@ -124,22 +166,31 @@ class Network(models.Model):
             }
 
         if self.ipam_configs.exists():
-            configurations = [
-                config.value
-                for config in self.ipam_configs.all()
-                if config.is_populated
+            populated_configurations = [
+                ipam_config
+                for ipam_config in self.ipam_configs.all()
+                if ipam_config.is_populated
             ]
 
-            if configurations:
+            if populated_configurations:
+                # Compose only accepts a driver for the IPAM as a whole, so the first one that was given is used
+                drivers = [ipam_config.driver for ipam_config in populated_configurations if ipam_config.driver]
                 config['ipam'] = {
-                    "driver": "default",
-                    "config": configurations
+                    "driver": drivers[0] if drivers else "default",
+                    "config": [
+                        ipam_config.value
+                        for ipam_config in populated_configurations
+                        if ipam_config.value
+                    ]
                 }
 
         return config
 
+    def __str__(self):
+        return self.name
+
 
-class NetworkDriverOptions(models.Model):
+class NetworkDriverOptions(TrackedModel):
     """
     Additional options for chosen network drivers
     """
@@ -148,7 +199,7 @@ class NetworkDriverOptions(models.Model):
     value: str = models.CharField(max_length=255, help_text="The value for the option")
 
 
-class NetworkLabel(models.Model):
+class NetworkLabel(TrackedModel):
     """
     Metadata that may be attached to networks as a series of names
     """
@@ -161,13 +212,16 @@ class NetworkLabel(models.Model):
     label: str = models.CharField(max_length=255, help_text="The text for the label")
 
 
-class IPAddressManagementConfig(models.Model):
+class IPAddressManagementConfig(TrackedModel):
     """
     Represents the IPAM configuration for Networks
 
     Configs are generally stored as many configs on a central IPAM object, but IPAM drivers and IPAM driver options
     aren't going to be supported, so this links directly back at the network
     """
+    class Meta:
+        ordering = ["pk"]
+
     network = models.ForeignKey(Network, on_delete=models.CASCADE, related_name="ipam_configs")
     driver = models.CharField(max_length=255, help_text="The type of driver to use", blank=True, null=True)
     subnet = models.CharField(max_length=255, help_text="", blank=True, null=True, validators=[IP_RANGE_VALIDATOR])
@@ -191,12 +245,10 @@ class IPAddressManagementConfig(models.Model):
         )
 
     @property
+    @instrumented("ipam")
     def value(self) -> typing.Dict[str, typing.Any]:
         configuration: typing.Dict[str, typing.Any] = {}
 
-        if self.driver is not None:
-            configuration["driver"] = self.driver
-
         if self.subnet is not None:
             configuration["subnet"] = self.subnet
 
@@ -206,7 +258,7 @@ class IPAddressManagementConfig(models.Model):
         if self.gateway is not None:
             configuration["gateway"] = self.gateway
 
-        if self.auxilary_addresses.exist():
+        if self.auxilary_addresses.exists():
             configuration["aux_addresses"] = {
                 auxilary_address.address_name: auxilary_address.address
                 for auxilary_address in self.auxilary_addresses.all()
@@ -215,7 +267,7 @@ class IPAddressManagementConfig(models.Model):
         return configuration
 
 
-class IPAMAuxilaryAddresses(models.Model):
+class IPAMAuxilaryAddresses(TrackedModel):
     """
     Auxiliary IPv4 or IPv6 address used by a Network driver, as a mapping from hostname to IP
     """
@@ -0,0 +1,43 @@
+"""
+Models holding the searchable text of services
+"""
+from __future__ import annotations
+
+import typing
+
+from django.db import models
+
+from builder.models.service import Service
+
+
+class SearchDocument(models.Model):
+    """
+    The text of a service, and everything that belongs to it, that the full text index is built from
+
+    Documents are maintained by `builder.search`; the database specific index over them is created after migrating
+    """
+    service: Service = models.OneToOneField(Service, on_delete=models.CASCADE, related_name="search_document")
+    name: str = models.TextField(blank=True, default="", help_text="The names of the service and its container")
+    command: str = models.TextField(blank=True, default="", help_text="The command that the service runs")
+    build: str = models.TextField(
+        blank=True,
+        default="",
+        help_text="The context, dockerfile, target, arguments, and tags of the service's builds"
+    )
+    labels: str = models.TextField(
+        blank=True,
+        default="",
+        help_text="The keys and values of the service's image labels, annotations, and deploy labels"
+    )
+
+    @property
+    def value(self) -> typing.Dict[str, str]:
+        return {
+            "name": self.name,
+            "command": self.command,
+            "build": self.build,
+            "labels": self.labels,
+        }
+
+    def __str__(self):
+        return f"Search document for service #{self.service_id}"
@@ -0,0 +1,79 @@
+"""
+Models describing where each secret is used
+"""
+from __future__ import annotations
+
+import typing
+
+from django.db import models
+
+from builder.models.build import BuildConfiguration
+from builder.models.build import BuildSecret
+from builder.models.service import Service
+from builder.models.stack import Stack
+
+
+class SecretConsumer(models.TextChoices):
+    """
+    The kinds of things that may use a secret
+    """
+    build = "build"
+
+
+class SecretUsage(models.Model):
+    """
+    A single use of a secret, copied from the row that uses it so that every use of a secret is found in one lookup
+
+    Usages are maintained by `builder.secret_usage`
+    """
+    class Meta:
+        indexes = [
+            models.Index(fields=["stack", "source"], name="builder_secret_usage_stack_idx"),
+        ]
+
+    source: str = models.CharField(max_length=255, db_index=True, help_text="The name of the secret that is used")
+    consumer: str = models.CharField(
+        max_length=20,
+        choices=SecretConsumer,
+        default=SecretConsumer.build,
+        help_text="What kind of thing uses the secret"
+    )
+    stack: Stack = models.ForeignKey(Stack, on_delete=models.CASCADE, related_name="secret_usages")
+    service: Service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name="secret_usages")
+    build_configuration: typing.Optional[BuildConfiguration] = models.ForeignKey(
+        BuildConfiguration,
+        on_delete=models.CASCADE,
+        related_name="secret_usages",
+        null=True,
+        blank=True
+    )
+    build_secret: typing.Optional[BuildSecret] = models.OneToOneField(
+        BuildSecret,
+        on_delete=models.CASCADE,
+        related_name="usage",
+        null=True,
+        blank=True
+    )
+    target: typing.Optional[str] = models.CharField(max_length=255, null=True, blank=True)
+    uid: typing.Optional[str] = models.CharField(max_length=255, null=True, blank=True)
+    gid: typing.Optional[str] = models.CharField(max_length=255, null=True, blank=True)
+    mode: typing.Optional[str] = models.CharField(max_length=4, null=True, blank=True)
+
+    @property
+    def value(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "secret": self.source,
+            "consumer": self.consumer,
+            "stack": self.stack_id,
+            "stack_name": self.stack.name,
+            "service": self.service_id,
+            "service_name": self.service.name,
+            "build_configuration": self.build_configuration_id,
+            "target": self.target,
+            "uid": self.uid,
+            "gid": self.gid,
+            "mode": self.mode,
+        }
+
+    def __str__(self):
+        return f"{self.source} used by {self.consumer} of {self.service}"
@@ -8,18 +8,23 @@ import typing
 from django.db import models
 from django.core.validators import RegexValidator
 
+from builder.instrumentation import instrumented
+from builder.models.common import TrackedModel
+from builder.models.stack import Stack
+
 INTEGER_STRING = RegexValidator(r"^\d+$", message="The value must be at least one integer and only integers")
 OCTAL_STRING = RegexValidator(r"^[0-7]{3}$", message="The value must be a 4 character octal")
 
 
-class UsedSecret(models.Model):
+class UsedSecret(TrackedModel):
     """
     Represents the usage of a secret
     """
     class Meta:
         abstract = True
+        ordering = ["pk"]
 
-    source: str = models.CharField(max_length=255, help_text="The name of the secret to use")
+    source: str = models.CharField(max_length=255, db_index=True, help_text="The name of the secret to use")
     target: str = models.CharField(
         max_length=255,
         help_text="The name of file to be mounted in '/run/secrets/' in the service's task containers. Defaults to the source value if not specified",
@@ -53,6 +58,7 @@ class UsedSecret(models.Model):
     )
 
     @property
+    @instrumented("secret")
     def value(self) -> typing.Union[str, typing.Dict[str, str]]:
         is_short = all(
             value is None
@@ -78,4 +84,60 @@ class UsedSecret(models.Model):
         if self.mode is not None:
             secret["mode"] = self.mode
 
-        return secret
\ No newline at end of file
+        return secret
+
+
+class Secret(TrackedModel):
+    """
+    A secret declared at the top level of a stack that its services and builds may use by name
+    """
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["stack", "name"], name="unique_secret_name_per_stack")
+        ]
+
+    stack: Stack = models.ForeignKey(Stack, on_delete=models.CASCADE, related_name="secrets")
+    name: str = models.CharField(max_length=255, help_text="The name that services and builds refer to the secret by")
+    file: typing.Optional[str] = models.CharField(
+        max_length=255,
+        help_text="The path of the file that holds the secret's value",
+        null=True,
+        blank=True
+    )
+    environment: typing.Optional[str] = models.CharField(
+        max_length=255,
+        help_text="The environment variable that holds the secret's value",
+        null=True,
+        blank=True
+    )
+    external: bool = models.BooleanField(
+        default=False,
+        help_text="Whether the secret has already been created on the platform, outside of this stack"
+    )
+    secret_name: typing.Optional[str] = models.CharField(
+        max_length=255,
+        help_text="The name of the secret on the platform, if it differs from the name used within the stack",
+        null=True,
+        blank=True
+    )
+
+    @property
+    def value(self) -> typing.Dict[str, typing.Any]:
+        secret: typing.Dict[str, typing.Any] = {}
+
+        if self.secret_name:
+            secret["name"] = self.secret_name
+
+        if self.external:
+            secret["external"] = True
+
+        if self.file:
+            secret["file"] = self.file
+
+        if self.environment:
+            secret["environment"] = self.environment
+
+        return secret
+
+    def __str__(self):
+        return f"{self.stack}: {self.name}"
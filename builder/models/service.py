@@ -10,7 +10,11 @@ from django.core.validators import RegexValidator
 from django.core.validators import MinValueValidator
 from django.core.validators import MaxValueValidator
 
+from builder.instrumentation import instrumented
 from builder.models.common import StringMap
+from builder.models.common import TrackedModel
+from builder.models.stack import Stack
+from builder.models.networking import Network
 
 SAFE_STRING_PATTERN = RegexValidator(
     "^[a-zA-Z0-9][a-zA-Z0-9_.-]+$",
@@ -20,10 +24,83 @@ MINIMUM_IS_ZERO = MinValueValidator(limit_value=0, message="The value must be mo
 MAXIMUM_IS_ONE_HUNDRED = MaxValueValidator(limit_value=100.0001, message="The value must be less than or equal to 100")
 
 
-class Service(models.Model):
+class ServiceQuerySet(models.QuerySet):
+    def alive(self) -> ServiceQuerySet:
+        """
+        Leave out services that have been marked for deletion
+        """
+        return self.filter(deleted_at__isnull=True)
+
+    def for_rendering(self) -> ServiceQuerySet:
+        """
+        Load everything needed to render services up front so that rendering a service doesn't issue queries
+        """
+        return self.select_related("deploy").prefetch_related(
+            "buildconfiguration_set__args",
+            "buildconfiguration_set__labels",
+            "buildconfiguration_set__secrets",
+            "buildconfiguration_set__tags",
+            "annotations",
+            "depends_on",
+            models.Prefetch("networks", queryset=Network.objects.alive()),
+            "deploy__labels",
+        )
+
+    def for_search(self) -> ServiceQuerySet:
+        """
+        Load everything that a service's search document is built from up front
+        """
+        return self.select_related("deploy").prefetch_related(
+            "buildconfiguration_set__args",
+            "buildconfiguration_set__labels",
+            "buildconfiguration_set__tags",
+            "annotations",
+            "deploy__labels",
+        )
+
+
+class Service(TrackedModel):
     """
     Represents a Docker service
     """
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["stack", "name"],
+                condition=models.Q(deleted_at__isnull=True),
+                name="unique_live_service_name_per_stack"
+            )
+        ]
+
+    objects = ServiceQuerySet.as_manager()
+
+    stack: Stack = models.ForeignKey(Stack, on_delete=models.CASCADE, related_name="services")
+    name: str = models.CharField(
+        max_length=255,
+        help_text="The name of the service that other services and the compose file will refer to it by",
+        validators=[SAFE_STRING_PATTERN]
+    )
+    deleted_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        db_index=True,
+        help_text="When the service was marked for deletion. Marked services are purged in the background"
+    )
+    extends: typing.Optional[Service] = models.ForeignKey(
+        "self",
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name="extended_by",
+        help_text="A service, possibly within another stack, whose configuration this service builds on"
+    )
+    revision: int = models.BigIntegerField(
+        default=0,
+        editable=False,
+        help_text="Changes whenever the service or anything that belongs to it changes. Maintained by "
+                  "`builder.overlays`"
+    )
+
     attach: bool = models.BooleanField(
         default=True,
         help_text="When attach is defined and set to false Compose does not collect service logs, "
@@ -92,6 +169,68 @@ class Service(models.Model):
 
     # develop is a fairly new option, so it'll be implemented later
 
+    networks = models.ManyToManyField(
+        Network,
+        blank=True,
+        related_name="services",
+        help_text="The networks that the service's containers will be attached to"
+    )
+
+    @property
+    @instrumented("service")
+    def value(self) -> typing.Dict[str, typing.Any]:
+        configuration: typing.Dict[str, typing.Any] = {}
+
+        build_configurations = list(self.buildconfiguration_set.all())
+        if build_configurations:
+            configuration["build"] = build_configurations[0].value
+
+        if not self.attach:
+            configuration["attach"] = self.attach
+
+        if self.cpu_count is not None:
+            configuration["cpu_count"] = self.cpu_count
+
+        if self.cpu_percent is not None:
+            configuration["cpu_percent"] = self.cpu_percent
+
+        if self.cpu_shares is not None:
+            configuration["cpu_shares"] = self.cpu_shares
+
+        if self.command:
+            configuration["command"] = self.command
+
+        if self.container_name:
+            configuration["container_name"] = self.container_name
+
+        if self.annotations.exists():
+            configuration["annotations"] = {
+                annotation.key: annotation.value
+                for annotation in self.annotations.all()
+            }
+
+        if self.depends_on.exists():
+            dependencies: typing.Sequence[ServiceDependency] = self.depends_on.all()
+            if all(dependency.is_short_form for dependency in dependencies):
+                configuration["depends_on"] = [dependency.name for dependency in dependencies]
+            else:
+                configuration["depends_on"] = {
+                    dependency.name: dependency.value
+                    for dependency in dependencies
+                }
+
+        if self.networks.exists():
+            configuration["networks"] = [network.name for network in self.networks.all()]
+
+        deploy = getattr(self, "deploy", None)
+        if deploy is not None:
+            configuration["deploy"] = deploy.value
+
+        return configuration
+
+    def __str__(self):
+        return self.name
+
 
 class ServiceDependencyCondition(models.TextChoices):
     service_started = "service_started"
@@ -99,10 +238,13 @@ class ServiceDependencyCondition(models.TextChoices):
     service_completed_successfully = "service_completed_successfully"
 
 
-class ServiceDependency(models.Model):
+class ServiceDependency(TrackedModel):
     """
     Describes how a service may be reliant on another service
     """
+    class Meta:
+        ordering = ["pk"]
+
     service: Service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='depends_on')
     name: str = models.CharField(max_length=255, help_text="The name of the service that this service depends on")
     restart: bool = models.BooleanField(
@@ -112,6 +254,7 @@ class ServiceDependency(models.Model):
                   "restart by the container runtime after the container dies."
     )
     condition: typing.Optional[str] = models.CharField(
+        max_length=30,
         default=None,
         choices=ServiceDependencyCondition,
         help_text="Sets the condition under which dependency is considered satisfied",
@@ -124,8 +267,26 @@ class ServiceDependency(models.Model):
     )
 
     @property
-    def value(self) -> typing.Union[str, typing.Dict[str, typing.Any]]:
-        pass
+    def is_short_form(self) -> bool:
+        """
+        Whether this dependency may be expressed by name alone
+        """
+        return self.condition is None and not self.restart and self.required
+
+    @property
+    @instrumented("dependency")
+    def value(self) -> typing.Dict[str, typing.Any]:
+        dependency: typing.Dict[str, typing.Any] = {
+            "condition": self.condition or ServiceDependencyCondition.service_started.value
+        }
+
+        if self.restart:
+            dependency["restart"] = self.restart
+
+        if not self.required:
+            dependency["required"] = self.required
+
+        return dependency
 
 
 class ServiceAnnotation(StringMap):
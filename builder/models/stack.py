@@ -0,0 +1,147 @@
+"""
+Models describing a full compose file
+"""
+from __future__ import annotations
+
+import typing
+
+from django.db import models
+
+from SwarmCompose import application_settings
+
+from builder import interpolation
+from builder import validation
+from builder.instrumentation import instrumented
+from builder.models.common import TrackedModel
+
+
+class StackQuerySet(models.QuerySet):
+    def alive(self) -> StackQuerySet:
+        """
+        Leave out stacks that have been marked for deletion
+        """
+        return self.filter(deleted_at__isnull=True)
+
+
+class Stack(TrackedModel):
+    """
+    A collection of services and networks that are rendered together as a single compose file
+    """
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["name"],
+                condition=models.Q(deleted_at__isnull=True),
+                name="unique_live_stack_name"
+            )
+        ]
+
+    objects = StackQuerySet.as_manager()
+
+    name: str = models.CharField(max_length=255, help_text="The name of the stack")
+    description: typing.Optional[str] = models.TextField(
+        blank=True,
+        null=True,
+        help_text="A description of what the stack is for"
+    )
+    deleted_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        db_index=True,
+        help_text="When the stack was marked for deletion. Marked stacks are purged in the background"
+    )
+    base: typing.Optional[Stack] = models.ForeignKey(
+        "self",
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name="overlays",
+        help_text="A stack whose services, networks, and secrets this stack is layered on top of, like a compose file "
+                  "given before this one on the command line"
+    )
+    revision: int = models.BigIntegerField(
+        default=0,
+        editable=False,
+        help_text="Changes whenever the stack or anything within it changes. Maintained by `builder.overlays`"
+    )
+
+    @property
+    @instrumented("stack", count_queries=True)
+    def value(self) -> typing.Dict[str, typing.Any]:
+        document: typing.Dict[str, typing.Any] = {
+            "services": {
+                service.name: service.value
+                for service in self.services.alive().for_rendering()
+            }
+        }
+
+        networks = {
+            network.name: network.value
+            for network in self.networks.alive().for_rendering()
+        }
+
+        if networks:
+            document["networks"] = networks
+
+        secrets = {
+            secret.name: secret.value
+            for secret in self.secrets.all()
+        }
+
+        if secrets:
+            document["secrets"] = secrets
+
+        return document
+
+    def render(self, validate: bool = None) -> typing.Dict[str, typing.Any]:
+        """
+        Build the compose document for this stack
+
+        :param validate: Whether to check the document against the compose specification. Defaults to the
+            `VALIDATE_RENDERED_OUTPUT` application setting
+        :return: The compose document, with the stack's base and the services that its services extend merged in.
+            Documents of stacks that are layered may be shared with later calls, so they must not be modified
+        """
+        from builder import overlays
+
+        document = overlays.resolve_stack(self)
+
+        if validate is None:
+            validate = application_settings.VALIDATE_RENDERED_OUTPUT
+
+        if validate:
+            validation.assert_valid(document)
+
+        return document
+
+    def preview(
+        self,
+        environments: typing.Mapping[str, typing.Mapping[str, str]],
+        validate: bool = None
+    ) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """
+        Resolve the templated values of this stack's compose document against several environments
+
+        The document is only rendered and compiled once no matter how many environments are given. Variables decide
+        what ends up in each document, so it is each resolved document, rather than the template, that gets validated
+
+        :param environments: Environment names mapped to their variables
+        :param validate: Whether to check each resolved document against the compose specification. Defaults to the
+            `VALIDATE_RENDERED_OUTPUT` application setting
+        :return: Environment names mapped to the resolved compose document
+        """
+        documents = interpolation.CompiledDocument(self.render(validate=False)).resolve_all(environments)
+
+        if validate is None:
+            validate = application_settings.VALIDATE_RENDERED_OUTPUT
+
+        if validate:
+            for name, document in documents.items():
+                problems = validation.validate_document(document)
+                if problems:
+                    raise validation.ComposeValidationError(problems, environment=name)
+
+        return documents
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,734 @@
+"""
+Layered stacks and services that extend other services, resolved with compose's merge rules
+
+A service may extend another service, possibly within another stack, and a stack may be layered on top of a base
+stack the way an override file is layered on top of a compose file. The effective configuration is found by merging
+each layer over the one below it:
+
+- mappings are merged key by key, with the upper layer winning
+- `command` and `entrypoint` are replaced rather than merged
+- labels, annotations, environment, and build arguments are merged as mappings, whether written as mappings or as
+  `KEY=VALUE` lists
+- networks, dependencies, secrets, configs, and volumes are merged by name (or target), whether written in their
+  short or long forms
+- other lists are appended, leaving out values that the lower layer already has
+
+Values are only rewritten into their long forms when two layers have to be merged.
+
+Every service and stack carries a revision that changes whenever it or anything within it changes. Resolved services
+and stacks are remembered by the revisions of every layer they were built from, so rendering many overlays of the same
+base only merges the shared layers once. Bulk operations that skip signals, like `bulk_create` and `QuerySet.update`,
+have to call `touch_services` or `touch_stacks` themselves.
+"""
+from __future__ import annotations
+
+import threading
+import time
+import typing
+
+from collections import OrderedDict
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db import models
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+
+from builder import changes
+from builder import instrumentation
+from builder.models import Network
+from builder.models import Service
+from builder.models import Stack
+
+RESOLUTION_CACHE_SIZE = 10000
+"""The maximum number of resolved services and stacks to remember"""
+
+REPLACED_PATHS: typing.FrozenSet[str] = frozenset({"command", "entrypoint", "healthcheck.test"})
+"""Paths within a service whose values are replaced by upper layers rather than merged"""
+
+MAPPING_PATHS: typing.FrozenSet[str] = frozenset({
+    "annotations",
+    "build.args",
+    "build.labels",
+    "deploy.labels",
+    "environment",
+    "extra_hosts",
+    "labels",
+    "sysctls",
+})
+"""Paths within a service whose values may be written either as mappings or as lists of `KEY=VALUE` strings"""
+
+LINEAGE_KEY = typing.Tuple[typing.Any, ...]
+"""The primary key and revision of a row followed by the key of the row it is layered on, if any"""
+
+
+def new_revision() -> int:
+    """
+    :return: A revision that no earlier change was given
+    """
+    return time.time_ns()
+
+
+def _as_mapping(value: typing.Any) -> typing.Dict[str, typing.Any]:
+    """
+    Example:
+        >>> _as_mapping(["DEBUG=1", "EMPTY"])
+        {'DEBUG': '1', 'EMPTY': None}
+    """
+    if isinstance(value, dict):
+        return value
+
+    mapping = {}
+    for entry in value:
+        key, separator, entry_value = str(entry).partition("=")
+        mapping[key] = entry_value if separator else None
+    return mapping
+
+
+class _NamedSequence:
+    """
+    Merge rules for a collection whose members are identified by a name, like a service's networks
+    """
+    def __init__(
+        self,
+        key: typing.Callable[[typing.Any], str],
+        expand: typing.Callable[[typing.Any], typing.Dict[str, typing.Any]],
+        as_mapping: bool
+    ):
+        """
+        :param key: Finds the name of a member written in either form
+        :param expand: Writes a member in its long form
+        :param as_mapping: Whether merged members are written as a mapping of names to members rather than a list
+        """
+        self.key = key
+        self.expand = expand
+        self.as_mapping = as_mapping
+
+    def _members(self, value: typing.Any) -> typing.Dict[str, typing.Any]:
+        if isinstance(value, dict):
+            return {name: {} if member is None else member for name, member in value.items()}
+        if self.as_mapping:
+            return {self.key(member): self.expand(member) for member in value}
+        return {self.key(member): member for member in value}
+
+    def merge(self, lower: typing.Any, upper: typing.Any) -> typing.Any:
+        """
+        :param lower: The members from the lower layer, in either form
+        :param upper: The members from the upper layer, in either form
+        :return: The members of both layers, with members of the same name merged
+        """
+        members = self._members(lower)
+
+        for name, member in self._members(upper).items():
+            if name not in members or members[name] == member:
+                members[name] = member
+            elif self.as_mapping:
+                members[name] = _merge_mappings(members[name], member, path=None)
+            else:
+                members[name] = _merge_mappings(self.expand(members[name]), self.expand(member), path=None)
+
+        return members if self.as_mapping else list(members.values())
+
+
+def _short_name(member: typing.Any) -> str:
+    return member if isinstance(member, str) else member["name"]
+
+
+def _secret_key(member: typing.Any) -> str:
+    if isinstance(member, str):
+        return member
+    return member.get("target") or member["source"]
+
+
+def _volume_key(member: typing.Any) -> str:
+    if isinstance(member, str):
+        parts = member.split(":")
+        return parts[1] if len(parts) > 1 else parts[0]
+    return member["target"]
+
+
+def _expand_volume(member: typing.Any) -> typing.Dict[str, typing.Any]:
+    if not isinstance(member, str):
+        return member
+
+    parts = member.split(":")
+    if len(parts) == 1:
+        return {"type": "volume", "target": parts[0]}
+
+    expanded = {
+        "type": "bind" if parts[0].startswith((".", "/", "~")) else "volume",
+        "source": parts[0],
+        "target": parts[1],
+    }
+    if len(parts) > 2 and "ro" in parts[2].split(","):
+        expanded["read_only"] = True
+    return expanded
+
+
+def _expand_secret(member: typing.Any) -> typing.Dict[str, typing.Any]:
+    return {"source": member} if isinstance(member, str) else member
+
+
+_SECRETS = _NamedSequence(key=_secret_key, expand=_expand_secret, as_mapping=False)
+
+NAMED_SEQUENCES: typing.Dict[str, _NamedSequence] = {
+    "networks": _NamedSequence(
+        key=_short_name,
+        expand=lambda member: {} if isinstance(member, str) else member,
+        as_mapping=True
+    ),
+    "depends_on": _NamedSequence(
+        key=_short_name,
+        expand=lambda member: {"condition": "service_started"} if isinstance(member, str) else member,
+        as_mapping=True
+    ),
+    "secrets": _SECRETS,
+    "configs": _SECRETS,
+    "build.secrets": _SECRETS,
+    "volumes": _NamedSequence(key=_volume_key, expand=_expand_volume, as_mapping=False),
+}
+"""Paths within a service whose members are merged by name"""
+
+
+def _append_unique(lower: typing.List[typing.Any], upper: typing.List[typing.Any]) -> typing.List[typing.Any]:
+    merged = list(lower)
+    merged.extend(member for member in upper if member not in lower)
+    return merged
+
+
+def _merge_values(lower: typing.Any, upper: typing.Any, path: typing.Optional[str]) -> typing.Any:
+    """
+    :param lower: The value from the lower layer
+    :param upper: The value from the upper layer
+    :param path: Where the values are within a service, like 'build.args'. None if they aren't within a service
+    :return: The merged value
+    """
+    if path is not None:
+        if path in REPLACED_PATHS:
+            return upper
+
+        if path in MAPPING_PATHS and isinstance(lower, (dict, list)) and isinstance(upper, (dict, list)):
+            return {**_as_mapping(lower), **_as_mapping(upper)}
+
+        if path in NAMED_SEQUENCES and isinstance(lower, (dict, list)) and isinstance(upper, (dict, list)):
+            return NAMED_SEQUENCES[path].merge(lower, upper)
+
+        if path == "build":
+            # A build given as a string is its context
+            lower = {"context": lower} if isinstance(lower, str) else lower
+            upper = {"context": upper} if isinstance(upper, str) else upper
+
+    if isinstance(lower, dict) and isinstance(upper, dict):
+        return _merge_mappings(lower, upper, path)
+
+    if isinstance(lower, list) and isinstance(upper, list):
+        return _append_unique(lower, upper)
+
+    return upper
+
+
+def _get_child_path(path: typing.Optional[str], key: str) -> typing.Optional[str]:
+    if path is None:
+        return None
+    return f"{path}.{key}" if path else key
+
+
+def _merge_mappings(
+    lower: typing.Mapping[str, typing.Any],
+    upper: typing.Mapping[str, typing.Any],
+    path: typing.Optional[str]
+) -> typing.Dict[str, typing.Any]:
+    merged = dict(lower)
+    for key, value in upper.items():
+        if key in merged:
+            merged[key] = _merge_values(merged[key], value, _get_child_path(path, key))
+        else:
+            merged[key] = value
+    return merged
+
+
+def merge_services(
+    lower: typing.Mapping[str, typing.Any],
+    upper: typing.Mapping[str, typing.Any]
+) -> typing.Dict[str, typing.Any]:
+    """
+    Layer one service's configuration over another's
+
+    Example:
+        >>> merge_services(
+        ...     {"command": "serve", "networks": ["backend"], "environment": ["DEBUG=0"]},
+        ...     {"command": "serve --reload", "networks": {"frontend": None}, "environment": {"DEBUG": "1"}}
+        ... )
+        {'command': 'serve --reload', 'networks': {'backend': {}, 'frontend': {}}, 'environment': {'DEBUG': '1'}}
+
+    :param lower: The configuration being built on
+    :param upper: The configuration that takes precedence
+    :return: The merged configuration. Neither configuration is modified
+    """
+    return _merge_mappings(lower, upper, path="")
+
+
+def merge_documents(
+    lower: typing.Mapping[str, typing.Any],
+    upper: typing.Mapping[str, typing.Any]
+) -> typing.Dict[str, typing.Any]:
+    """
+    Layer one compose document over another, like `docker compose -f lower.yaml -f upper.yaml`
+
+    :param lower: The document being built on
+    :param upper: The document that takes precedence
+    :return: The merged document. Neither document is modified
+    """
+    merged = dict(lower)
+
+    for section, members in upper.items():
+        if section not in merged or not isinstance(members, dict) or not isinstance(merged[section], dict):
+            merged[section] = members
+            continue
+
+        combined = dict(merged[section])
+        for name, member in members.items():
+            if name not in combined:
+                combined[name] = member
+            elif section == "services":
+                combined[name] = merge_services(combined[name], member)
+            else:
+                combined[name] = _merge_values(combined[name], member, path=None)
+        merged[section] = combined
+
+    return merged
+
+
+class OverlayError(ValueError):
+    """
+    Raised when services or stacks are layered in a way that can't be resolved, like a service that extends itself
+    """
+
+
+class ResolutionCache:
+    """
+    Remembers resolved services and stacks by the revisions of every layer they were built from
+    """
+    def __init__(self, cache_size: int = RESOLUTION_CACHE_SIZE):
+        """
+        :param cache_size: The maximum number of resolved values to remember
+        """
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._values: typing.OrderedDict[typing.Tuple[typing.Any, ...], typing.Dict[str, typing.Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """
+        Forget every resolved value
+        """
+        with self._lock:
+            self._values.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, key: typing.Tuple[typing.Any, ...]) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """
+        :param key: What the value was resolved from
+        :return: The remembered value. None if there isn't one
+        """
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self._values.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def put(self, key: typing.Tuple[typing.Any, ...], value: typing.Dict[str, typing.Any]):
+        """
+        :param key: What the value was resolved from
+        :param value: The resolved value
+        """
+        with self._lock:
+            self._values[key] = value
+            while len(self._values) > self.cache_size:
+                self._values.popitem(last=False)
+
+
+_resolution_cache = ResolutionCache()
+
+
+def _report_cache_usage() -> typing.Iterable[instrumentation.SAMPLE]:
+    labels = {"cache": "overlays"}
+    yield instrumentation.CACHE_HITS, labels, _resolution_cache.hits
+    yield instrumentation.CACHE_MISSES, labels, _resolution_cache.misses
+
+
+instrumentation.REGISTRY.register_collector(_report_cache_usage)
+
+
+def get_resolution_cache() -> ResolutionCache:
+    """
+    :return: The cache shared by every resolution within the process
+    """
+    return _resolution_cache
+
+
+_LINEAGE_ROWS = typing.Dict[int, typing.Tuple[int, typing.Optional[int]]]
+"""Primary keys mapped to their revision and the primary key of the row they are layered on"""
+
+_LIVE_CONDITIONS: typing.Mapping[typing.Type[models.Model], models.Q] = {
+    Service: models.Q(deleted_at__isnull=True, stack__deleted_at__isnull=True),
+    Stack: models.Q(deleted_at__isnull=True),
+}
+"""What a service or stack has to satisfy to be layered under another before it is purged"""
+
+
+def _load_lineage(
+    model: typing.Type[models.Model],
+    parent_field: str,
+    primary_keys: typing.Iterable[int],
+    using: str,
+    rows: _LINEAGE_ROWS = None,
+    include_deleted: bool = False
+) -> _LINEAGE_ROWS:
+    """
+    Load the revisions of rows and of every row that they are layered on, one query per layer
+
+    Rows that are marked for deletion are left out of the layers below the given rows, so that nothing is merged out of
+    them while they wait to be purged
+
+    :param model: Service or Stack
+    :param parent_field: The attribute holding the primary key of the row that a row is layered on
+    :param primary_keys: The rows to start from. These are loaded whether or not they are marked for deletion
+    :param using: The alias of the database to read from
+    :param rows: Rows that have already been loaded
+    :param include_deleted: Whether to follow the lineage through rows that are marked for deletion
+    :return: The revision and parent of every row in the lineage of the given rows
+    """
+    rows = dict(rows or {})
+    requested: typing.Set[int] = set(rows)
+    missing = set(primary_keys).difference(rows)
+    layer = model._base_manager.using(using)
+    parents = layer if include_deleted else layer.filter(_LIVE_CONDITIONS[model])
+
+    while True:
+        requested.update(missing)
+        for primary_key, revision, parent_id in layer.filter(pk__in=missing).values_list(
+            "pk",
+            "revision",
+            parent_field
+        ):
+            rows[primary_key] = (revision, parent_id)
+
+        layer = parents
+        missing = {parent_id for _, parent_id in rows.values() if parent_id is not None}.difference(requested)
+
+        if not missing:
+            return rows
+
+
+def _get_lineage_key(primary_key: int, rows: _LINEAGE_ROWS) -> LINEAGE_KEY:
+    """
+    :return: The primary key and revision of the row and of each row below it, starting with the row itself
+    """
+    lineage = []
+    seen: typing.Set[int] = set()
+    current = primary_key
+
+    while current is not None and current in rows:
+        if current in seen:
+            raise OverlayError(f"#{current} ends up layered on itself")
+        seen.add(current)
+        revision, parent_id = rows[current]
+        lineage.append((current, revision))
+        current = parent_id
+
+    return tuple(lineage)
+
+
+def _resolve_services(
+    primary_keys: typing.Iterable[int],
+    rows: _LINEAGE_ROWS,
+    own_values: typing.Mapping[int, typing.Dict[str, typing.Any]],
+    using: str
+) -> typing.Dict[int, typing.Dict[str, typing.Any]]:
+    """
+    :param primary_keys: The services to resolve
+    :param rows: The lineage of the services
+    :param own_values: The unmerged configuration of services that have already been rendered
+    :param using: The alias of the database to read from
+    :return: The effective configuration of each service
+    """
+    resolved: typing.Dict[LINEAGE_KEY, typing.Dict[str, typing.Any]] = {}
+    unresolved: typing.List[LINEAGE_KEY] = []
+
+    # Walk down from each service until a layer that was already resolved is found
+    for primary_key in primary_keys:
+        lineage = _get_lineage_key(primary_key, rows)
+        for depth in range(len(lineage)):
+            key = lineage[depth:]
+            if key in resolved or key in unresolved:
+                break
+            cached = _resolution_cache.get(("service", key))
+            if cached is not None:
+                resolved[key] = cached
+                break
+            unresolved.append(key)
+
+    to_render = {key[0][0] for key in unresolved}.difference(own_values)
+    rendered = {
+        service.pk: service.value
+        for service in Service.objects.using(using).for_rendering().filter(pk__in=to_render)
+    }
+
+    # The shortest lineages are the lowest layers, so resolving in that order always finds the layer below resolved
+    for key in sorted(unresolved, key=len):
+        primary_key = key[0][0]
+        own_value = own_values[primary_key] if primary_key in own_values else rendered[primary_key]
+        value = own_value if len(key) == 1 else merge_services(resolved[key[1:]], own_value)
+        resolved[key] = value
+        _resolution_cache.put(("service", key), value)
+
+    return {primary_key: resolved[_get_lineage_key(primary_key, rows)] for primary_key in primary_keys}
+
+
+def resolve_service(service: Service) -> typing.Dict[str, typing.Any]:
+    """
+    :param service: The service to resolve
+    :return: The configuration of the service merged over the configuration of every service it extends. May be shared
+        with later calls, so it must not be modified
+    """
+    using = service._state.db or DEFAULT_DB_ALIAS
+    rows = _load_lineage(Service, "extends_id", [service.pk], using)
+    return _resolve_services([service.pk], rows, {}, using)[service.pk]
+
+
+def resolve_stack(stack: Stack) -> typing.Dict[str, typing.Any]:
+    """
+    Build the effective compose document of a stack
+
+    :param stack: The stack to resolve
+    :return: The stack's document merged over its base's, with every service merged over the services it extends.
+        The documents of stacks that are layered may be shared with later calls, so they must not be modified
+    """
+    using = stack._state.db or DEFAULT_DB_ALIAS
+
+    if stack.base_id is None and not stack.services.alive().filter(extends__isnull=False).exists():
+        return stack.value
+
+    stack_lineage = _get_lineage_key(stack.pk, _load_lineage(Stack, "base_id", [stack.pk], using))
+    stack_ids = [primary_key for primary_key, _ in stack_lineage]
+
+    services = list(
+        Service.objects.using(using).alive().filter(stack_id__in=stack_ids).values_list(
+            "pk", "stack_id", "name", "revision", "extends_id"
+        )
+    )
+    service_rows = _load_lineage(
+        Service,
+        "extends_id",
+        (),
+        using,
+        rows={primary_key: (revision, extends_id) for primary_key, _, _, revision, extends_id in services}
+    )
+    service_keys = {
+        stack_id: tuple(sorted(
+            _get_lineage_key(primary_key, service_rows)
+            for primary_key, service_stack_id, *_ in services
+            if service_stack_id == stack_id
+        ))
+        for stack_id in stack_ids
+    }
+
+    def resolve_layer(depth: int) -> typing.Dict[str, typing.Any]:
+        layers = stack_lineage[depth:]
+        key = ("stack", layers, tuple(service_keys[primary_key] for primary_key, _ in layers))
+
+        cached = _resolution_cache.get(key)
+        if cached is not None:
+            return cached
+
+        layer = stack if depth == 0 else Stack.objects.using(using).get(pk=layers[0][0])
+        document = layer.value
+
+        extending = {
+            primary_key: name
+            for primary_key, stack_id, name, _, extends_id in services
+            if stack_id == layer.pk and extends_id is not None
+        }
+        if extending:
+            resolved = _resolve_services(
+                extending,
+                service_rows,
+                {primary_key: document["services"][name] for primary_key, name in extending.items()},
+                using
+            )
+            document["services"].update((extending[primary_key], value) for primary_key, value in resolved.items())
+
+        if len(layers) > 1:
+            document = merge_documents(resolve_layer(depth + 1), document)
+
+        _resolution_cache.put(key, document)
+        return document
+
+    return resolve_layer(0)
+
+
+def get_stack_lineages(
+    stack_ids: typing.Iterable[int],
+    using: str = DEFAULT_DB_ALIAS
+) -> typing.Dict[int, typing.List[int]]:
+    """
+    :param stack_ids: The primary keys of stacks
+    :param using: The alias of the database to read from
+    :return: The primary key of each stack followed by those of the stacks it is layered on, nearest first
+    """
+    stack_ids = list(stack_ids)
+    rows = _load_lineage(Stack, "base_id", stack_ids, using)
+    return {
+        stack_id: [primary_key for primary_key, _ in _get_lineage_key(stack_id, rows)]
+        for stack_id in stack_ids
+        if stack_id in rows
+    }
+
+
+def touch_stacks(stacks: models.QuerySet) -> int:
+    """
+    Give stacks new revisions after changing what is within them without sending signals
+
+    :param stacks: The stacks that changed
+    :return: The number of stacks that were given new revisions
+    """
+    return Stack._base_manager.using(stacks.db).filter(pk__in=stacks.values("pk")).update(revision=new_revision())
+
+
+def touch_services(services: models.QuerySet) -> int:
+    """
+    Give services, and the stacks they belong to, new revisions after changing them without sending signals
+
+    :param services: The services that changed
+    :return: The number of services that were given new revisions
+    """
+    revision = new_revision()
+    Stack._base_manager.using(services.db).filter(pk__in=services.values("stack_id")).update(revision=revision)
+    return Service._base_manager.using(services.db).filter(pk__in=services.values("pk")).update(revision=revision)
+
+
+def _check_lineage(instance: typing.Union[Service, Stack], parent_field: str, using: str):
+    """
+    Make sure that a service or stack that is about to be saved isn't layered on itself
+    """
+    parent_id = getattr(instance, parent_field)
+    if parent_id is None or instance.pk is None:
+        return
+
+    rows = _load_lineage(type(instance), parent_field, [parent_id], using, include_deleted=True)
+    rows[instance.pk] = (instance.revision, parent_id)
+    _get_lineage_key(instance.pk, rows)
+
+
+@receiver(pre_save, sender=Service)
+@receiver(pre_save, sender=Stack)
+def _layer_saving(sender, instance: typing.Union[Service, Stack], using: str, raw: bool = False, **kwargs):
+    if raw:
+        return
+
+    _check_lineage(instance, "extends_id" if sender is Service else "base_id", using)
+    instance.revision = new_revision()
+
+
+@receiver(post_save, sender=Service)
+@receiver(post_save, sender=Stack)
+def _layer_saved(
+    sender,
+    instance: typing.Union[Service, Stack],
+    using: str,
+    raw: bool = False,
+    update_fields=None,
+    **kwargs
+):
+    # Saves limited to some fields leave the new revision out, so it has to be written on its own
+    if not raw and update_fields is not None and "revision" not in update_fields:
+        sender._base_manager.using(using).filter(pk=instance.pk).update(revision=instance.revision)
+
+
+def _touch_owners(instance: models.Model, using: str):
+    """
+    Give the service and stack that a row belongs to new revisions
+    """
+    field = changes.get_parent_field(type(instance))
+    parent_id = getattr(instance, field.attname) if field is not None else None
+
+    if parent_id is None:
+        return
+
+    revision = new_revision()
+    parents = field.related_model._base_manager.using(using).filter(pk=parent_id)
+
+    owner_paths = (
+        (Service, _get_service_path(field.related_model)),
+        (Stack, changes.get_stack_path(field.related_model)),
+    )
+    for owner, path in owner_paths:
+        if path is not None:
+            owner._base_manager.using(using).filter(pk__in=parents.values(path)).update(revision=revision)
+
+
+def _get_service_path(model: typing.Type[models.Model]) -> typing.Optional[str]:
+    """
+    :return: The lookup that finds the primary key of the service a row belongs to. None if it doesn't belong to one
+    """
+    if model is Service:
+        return "pk"
+
+    field = changes.get_parent_field(model)
+
+    if field is None or field.related_model is Stack:
+        return None
+
+    if field.related_model is Service:
+        return field.attname
+
+    path = _get_service_path(field.related_model)
+    return None if path is None else f"{field.name}__{path}"
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def _row_changed(sender, instance: models.Model, using: str, raw: bool = False, **kwargs):
+    if raw or sender is Stack or not changes.is_tracked(sender):
+        return
+
+    _touch_owners(instance, using)
+
+    # Services list the names of their networks, so they change along with them
+    if sender is Network and not kwargs.get("created", True):
+        touch_services(Service._base_manager.using(using).filter(networks=instance))
+
+
+@receiver(pre_delete, sender=Network)
+def _network_deleting(sender, instance: Network, using: str, **kwargs):
+    # The services have to be found before the network is detached from them
+    touch_services(Service._base_manager.using(using).filter(networks=instance))
+
+
+@receiver(m2m_changed, sender=Service.networks.through)
+def _service_networks_changed(
+    sender,
+    instance: typing.Union[Service, Network],
+    action: str,
+    reverse: bool,
+    pk_set: typing.Optional[typing.Set[int]],
+    using: str,
+    **kwargs
+):
+    services = Service._base_manager.using(using)
+
+    if not reverse and action in ("post_add", "post_remove", "post_clear"):
+        touch_services(services.filter(pk=instance.pk))
+    elif reverse and action in ("post_add", "post_remove"):
+        touch_services(services.filter(pk__in=pk_set))
+    elif reverse and action == "pre_clear":
+        touch_services(services.filter(networks=instance))
@@ -0,0 +1,669 @@
+"""
+Full text search over services along with their builds, labels, and annotations
+
+Each service has a `SearchDocument` holding its searchable text. The documents are indexed by SQLite's FTS5 extension
+on SQLite and by a GIN index over a weighted `tsvector` on Postgres, so lookups don't have to scan every service.
+Other databases fall back to scanning the documents.
+
+Documents are kept up to date by signal handlers that gather changed services during a transaction and reindex them
+all at once after it commits. Bulk operations that skip signals, like `QuerySet.update` and `bulk_create`, have to call
+`schedule_indexing` themselves.
+"""
+from __future__ import annotations
+
+import abc
+import functools
+import re
+import threading
+import typing
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.db import models
+from django.db import transaction
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_migrate
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from SwarmCompose import application_settings
+
+from builder import transactions
+from builder.models import BuildArg
+from builder.models import BuildConfiguration
+from builder.models import Deploy
+from builder.models import DeployLabel
+from builder.models import ImageLabel
+from builder.models import ImageTags
+from builder.models import SearchDocument
+from builder.models import Service
+from builder.models import ServiceAnnotation
+from builder.models import Stack
+
+SEARCH_FIELDS: typing.Sequence[str] = ("name", "command", "build", "labels")
+"""The fields of a search document, in the order that they are indexed"""
+
+FIELD_WEIGHTS: typing.Mapping[str, float] = {"name": 10.0, "command": 2.0, "build": 4.0, "labels": 4.0}
+"""How much a match within each field counts towards a result's rank on SQLite"""
+
+POSTGRES_FIELD_WEIGHTS: typing.Mapping[str, str] = {"name": "A", "command": "C", "build": "B", "labels": "B"}
+"""The `tsvector` weight class of each field on Postgres"""
+
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+BATCH_SIZE = 500
+"""The maximum number of services to reindex at once"""
+
+REBUILD_JOB = "rebuild_search_index"
+
+_CONFIGURATION_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_.]*$")
+
+
+class SearchResult:
+    """
+    A service that matched a search
+    """
+    def __init__(self, service_id: int, service_name: str, stack_id: int, stack_name: str, rank: float):
+        """
+        :param service_id: The primary key of the matching service
+        :param service_name: The name of the matching service
+        :param stack_id: The primary key of the stack that the service belongs to
+        :param stack_name: The name of the stack that the service belongs to
+        :param rank: How well the service matched. Higher is better
+        """
+        self.service_id = service_id
+        self.service_name = service_name
+        self.stack_id = stack_id
+        self.stack_name = stack_name
+        self.rank = rank
+
+    @property
+    def value(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "service": self.service_id,
+            "name": self.service_name,
+            "stack": self.stack_id,
+            "stack_name": self.stack_name,
+            "rank": self.rank,
+        }
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.stack_name}/{self.service_name}, rank={self.rank})"
+
+
+class SearchPage:
+    """
+    One page of ranked search results
+    """
+    def __init__(self, query: str, page: int, page_size: int, count: int, results: typing.Sequence[SearchResult]):
+        """
+        :param query: What was searched for
+        :param page: The number of this page, starting at 1
+        :param page_size: The most results that a page may hold
+        :param count: The number of results across every page
+        :param results: The results on this page, best first
+        """
+        self.query = query
+        self.page = page
+        self.page_size = page_size
+        self.count = count
+        self.results = list(results)
+
+    @property
+    def pages(self) -> int:
+        return max(1, -(-self.count // self.page_size))
+
+    @property
+    def value(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "query": self.query,
+            "page": self.page,
+            "page_size": self.page_size,
+            "pages": self.pages,
+            "count": self.count,
+            "results": [result.value for result in self.results],
+        }
+
+
+def _join(parts: typing.Iterable[typing.Optional[str]]) -> str:
+    return " ".join(str(part) for part in parts if part)
+
+
+def get_document_fields(service: Service) -> typing.Dict[str, str]:
+    """
+    :param service: A service, ideally loaded with `Service.objects.for_search()`
+    :return: The searchable text of the service for each search field
+    """
+    builds = list(service.buildconfiguration_set.all())
+    deploy = getattr(service, "deploy", None)
+    labels = [label for build in builds for label in build.labels.all()]
+    labels.extend(service.annotations.all())
+    if deploy is not None:
+        labels.extend(deploy.labels.all())
+
+    return {
+        "name": _join(dict.fromkeys([service.name, service.container_name])),
+        "command": service.command or "",
+        "build": _join(
+            part
+            for build in builds
+            for part in [build.context, build.dockerfile, build.target]
+            + [f"{argument.key}={argument.value}" for argument in build.args.all()]
+            + [tag.value for tag in build.tags.all()]
+        ),
+        "labels": _join(f"{label.key}={label.value}" for label in labels),
+    }
+
+
+def index_services(service_ids: typing.Iterable[int], using: str = DEFAULT_DB_ALIAS) -> int:
+    """
+    Bring the search documents of services up to date
+
+    :param service_ids: The primary keys of the services to reindex. Services that no longer exist are skipped
+    :param using: The alias of the database to index
+    :return: The number of documents that were created or changed
+    """
+    service_ids = sorted(set(service_ids))
+    changed = 0
+
+    for start in range(0, len(service_ids), BATCH_SIZE):
+        batch = service_ids[start:start + BATCH_SIZE]
+
+        with transaction.atomic(using=using):
+            existing = {
+                document.service_id: document
+                for document in SearchDocument.objects.using(using).filter(service_id__in=batch)
+            }
+            new_documents: typing.List[SearchDocument] = []
+            updated_documents: typing.List[SearchDocument] = []
+
+            for service in Service.objects.using(using).filter(pk__in=batch).for_search():
+                fields = get_document_fields(service)
+                document = existing.get(service.pk)
+
+                if document is None:
+                    new_documents.append(SearchDocument(service_id=service.pk, **fields))
+                elif document.value != fields:
+                    for field, text in fields.items():
+                        setattr(document, field, text)
+                    updated_documents.append(document)
+
+            SearchDocument.objects.using(using).bulk_create(new_documents, batch_size=BATCH_SIZE)
+            SearchDocument.objects.using(using).bulk_update(updated_documents, SEARCH_FIELDS, batch_size=BATCH_SIZE)
+            changed += len(new_documents) + len(updated_documents)
+
+    return changed
+
+
+class _PendingChanges(transactions.TransactionListener, threading.local):
+    """
+    Primary keys of rows, per database, that changed in a way that affects a search document since the last commit
+    """
+    def __init__(self):
+        self.changes: typing.Dict[str, typing.Dict[typing.Type[models.Model], typing.Set[int]]] = {}
+        self.scheduled: typing.Set[str] = set()
+
+    def add(self, model: typing.Type[models.Model], primary_keys: typing.Iterable[int], using: str):
+        """
+        :param model: Service, BuildConfiguration, or Deploy
+        :param primary_keys: The rows that changed
+        :param using: The alias of the database that changed
+        """
+        self.changes.setdefault(using, {}).setdefault(model, set()).update(primary_keys)
+        connection = connections[using]
+
+        if not connection.in_atomic_block:
+            self.flush(using)
+            return
+
+        # One flush per transaction is enough. Changes made within a transaction that is rolled back are picked up,
+        # harmlessly, by the next flush
+        if using not in self.scheduled:
+            transactions.watch(connection)
+            self.scheduled.add(using)
+            transaction.on_commit(functools.partial(self.flush, using), using=using)
+
+    def flush(self, using: str):
+        """
+        Reindex every service affected by changes to the given database
+        """
+        self.scheduled.discard(using)
+        changes = self.changes.pop(using, None)
+        if not changes:
+            return
+
+        service_ids = set(changes.get(Service, ()))
+        for model in (BuildConfiguration, Deploy):
+            if changes.get(model):
+                service_ids.update(
+                    model.objects.using(using).filter(pk__in=changes[model]).values_list("service_id", flat=True)
+                )
+
+        index_services(service_ids, using=using)
+
+    def ended(self, connection: BaseDatabaseWrapper):
+        # Commit hooks are thrown away when a transaction rolls back
+        self.scheduled.discard(connection.alias)
+
+    def savepoint_rolled_back(self, connection: BaseDatabaseWrapper, savepoint_id: str):
+        # The flush may have been scheduled within the savepoint, which throws it away. If it wasn't, the next change
+        # schedules a second flush, which finds nothing left to do
+        self.scheduled.discard(connection.alias)
+
+
+_pending_changes = transactions.add_listener(_PendingChanges())
+
+
+def schedule_indexing(service_ids: typing.Iterable[int], using: str = DEFAULT_DB_ALIAS):
+    """
+    Reindex services once the current transaction commits, or right away outside of a transaction
+
+    :param service_ids: The primary keys of the services to reindex
+    :param using: The alias of the database that the services were changed in
+    """
+    _pending_changes.add(Service, service_ids, using)
+
+
+@receiver(post_save, sender=Service)
+def _service_saved(sender, instance: Service, using: str, raw: bool = False, **kwargs):
+    if not raw:
+        _pending_changes.add(Service, [instance.pk], using)
+
+
+@receiver([post_save, post_delete], sender=BuildConfiguration)
+@receiver([post_save, post_delete], sender=Deploy)
+@receiver([post_save, post_delete], sender=ServiceAnnotation)
+def _service_part_changed(sender, instance: models.Model, using: str, raw: bool = False, **kwargs):
+    if not raw:
+        _pending_changes.add(Service, [instance.service_id], using)
+
+
+@receiver([post_save, post_delete], sender=BuildArg)
+@receiver([post_save, post_delete], sender=ImageLabel)
+@receiver([post_save, post_delete], sender=ImageTags)
+def _build_part_changed(sender, instance: models.Model, using: str, raw: bool = False, **kwargs):
+    if not raw:
+        _pending_changes.add(BuildConfiguration, [instance.build_configuration_id], using)
+
+
+@receiver([post_save, post_delete], sender=DeployLabel)
+def _deploy_part_changed(sender, instance: DeployLabel, using: str, raw: bool = False, **kwargs):
+    if not raw:
+        _pending_changes.add(Deploy, [instance.deploy_id], using)
+
+
+class SearchBackend(abc.ABC):
+    """
+    Finds services through a database's search features
+    """
+    def __init__(self, using: str):
+        """
+        :param using: The alias of the database to search
+        """
+        self.using = using
+        self.connection = connections[using]
+        quote = self.connection.ops.quote_name
+        self.document_table = quote(SearchDocument._meta.db_table)
+        self.service_table = quote(Service._meta.db_table)
+        self.stack_table = quote(Stack._meta.db_table)
+
+    def install(self):
+        """
+        Create whatever the database needs to search documents quickly
+        """
+        pass
+
+    def optimize(self):
+        """
+        Compact the index after a large number of changes
+        """
+        pass
+
+    @abc.abstractmethod
+    def search(self, query: str, stack_id: int = None, limit: int = DEFAULT_PAGE_SIZE, offset: int = 0):
+        """
+        :param query: Terms that must all appear within matching services
+        :param stack_id: Only find services within this stack
+        :param limit: The most results to return
+        :param offset: The number of results to skip
+        :return: The matching services, best first
+        """
+
+    @abc.abstractmethod
+    def count(self, query: str, stack_id: int = None) -> int:
+        """
+        :param query: Terms that must all appear within matching services
+        :param stack_id: Only count services within this stack
+        :return: The number of services that match
+        """
+
+    def _run(
+        self,
+        match: str,
+        parameters: typing.Sequence[typing.Any],
+        stack_id: typing.Optional[int],
+        select: str,
+        suffix: str = "",
+        suffix_parameters: typing.Sequence[typing.Any] = ()
+    ) -> typing.List[typing.Tuple]:
+        """
+        Run a query over the search documents of live services
+
+        :param match: Table expressions and conditions that pick matching documents, aliased as 'document'
+        :param parameters: Parameters for the match
+        :param stack_id: Only include services within this stack
+        :param select: What to select
+        :param suffix: Clauses, like ORDER BY, to add at the end
+        :param suffix_parameters: Parameters for the suffix
+        :return: The selected rows
+        """
+        stack_filter = " AND service.stack_id = %s" if stack_id is not None else ""
+        statement = (
+            f"SELECT {select} FROM {match}"
+            f" JOIN {self.service_table} service ON service.id = document.service_id"
+            f" JOIN {self.stack_table} stack ON stack.id = service.stack_id"
+            f" WHERE service.deleted_at IS NULL AND stack.deleted_at IS NULL{stack_filter}"
+            f" {suffix}"
+        )
+        arguments = list(parameters) + ([stack_id] if stack_id is not None else []) + list(suffix_parameters)
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(statement, arguments)
+            return cursor.fetchall()
+
+
+class ScanningSearchBackend(SearchBackend):
+    """
+    Searches by scanning every document. Used on databases without a supported full text index
+    """
+    def _matching(self, query: str, stack_id: typing.Optional[int]) -> models.QuerySet:
+        services = Service.objects.using(self.using).alive().filter(stack__deleted_at__isnull=True)
+        if stack_id is not None:
+            services = services.filter(stack_id=stack_id)
+
+        for term in query.split():
+            term = term.rstrip("*")
+            services = services.filter(
+                functools.reduce(
+                    lambda condition, field: condition | models.Q(**{f"search_document__{field}__icontains": term}),
+                    SEARCH_FIELDS,
+                    models.Q()
+                )
+            )
+
+        return services
+
+    def search(self, query: str, stack_id: int = None, limit: int = DEFAULT_PAGE_SIZE, offset: int = 0):
+        services = self._matching(query, stack_id).order_by("name", "pk").values_list(
+            "pk", "name", "stack_id", "stack__name"
+        )
+        return [SearchResult(*row, rank=0.0) for row in services[offset:offset + limit]]
+
+    def count(self, query: str, stack_id: int = None) -> int:
+        return self._matching(query, stack_id).count()
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """
+    Searches through an FTS5 table that mirrors the search documents through triggers
+    """
+    def __init__(self, using: str):
+        super().__init__(using)
+        self.index_table = self.connection.ops.quote_name(f"{SearchDocument._meta.db_table}_fts")
+
+    def install(self):
+        raw_index_table = f"{SearchDocument._meta.db_table}_fts"
+        columns = ", ".join(SEARCH_FIELDS)
+        new_columns = ", ".join(f"new.{field}" for field in SEARCH_FIELDS)
+        old_columns = ", ".join(f"old.{field}" for field in SEARCH_FIELDS)
+        insert = f"INSERT INTO {self.index_table} (rowid, {columns}) VALUES (new.id, {new_columns});"
+        remove = (
+            f"INSERT INTO {self.index_table} ({self.index_table}, rowid, {columns}) "
+            f"VALUES ('delete', old.id, {old_columns});"
+        )
+
+        with self.connection.cursor() as cursor:
+            already_installed = raw_index_table in self.connection.introspection.table_names(cursor)
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.index_table} USING fts5("
+                f"{columns}, content={self.document_table}, content_rowid='id', "
+                f"tokenize='unicode61 remove_diacritics 2')"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {raw_index_table}_insert AFTER INSERT ON {self.document_table} "
+                f"BEGIN {insert} END"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {raw_index_table}_delete AFTER DELETE ON {self.document_table} "
+                f"BEGIN {remove} END"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {raw_index_table}_update AFTER UPDATE ON {self.document_table} "
+                f"BEGIN {remove} {insert} END"
+            )
+
+            if not already_installed:
+                cursor.execute(f"INSERT INTO {self.index_table} ({self.index_table}) VALUES ('rebuild')")
+
+    def optimize(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {self.index_table} ({self.index_table}) VALUES ('optimize')")
+
+    @staticmethod
+    def get_match_expression(query: str) -> str:
+        """
+        Convert a search into an FTS5 query where every term must appear
+
+        Each term is quoted so that characters like '-' and ':' are read as part of the term rather than as FTS5
+        syntax. A term ending with '*' matches any word that starts with it.
+
+        :param query: The terms to search for, separated by whitespace
+        :return: An FTS5 query
+        """
+        terms = []
+        for term in query.split():
+            prefix = term.endswith("*") and len(term) > 1
+            if prefix:
+                term = term[:-1]
+            terms.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+        return " ".join(terms)
+
+    def _match(self) -> str:
+        return (
+            f"{self.index_table} JOIN {self.document_table} document ON document.id = {self.index_table}.rowid"
+        )
+
+    def search(self, query: str, stack_id: int = None, limit: int = DEFAULT_PAGE_SIZE, offset: int = 0):
+        weights = ", ".join(str(FIELD_WEIGHTS[field]) for field in SEARCH_FIELDS)
+        rows = self._run(
+            f"{self._match()} AND {self.index_table} MATCH %s",
+            [self.get_match_expression(query)],
+            stack_id,
+            select=f"service.id, service.name, stack.id, stack.name, bm25({self.index_table}, {weights}) AS score",
+            suffix="ORDER BY score, service.id LIMIT %s OFFSET %s",
+            suffix_parameters=[limit, offset]
+        )
+        # bm25 scores better matches with lower numbers
+        return [SearchResult(*row[:4], rank=-row[4]) for row in rows]
+
+    def count(self, query: str, stack_id: int = None) -> int:
+        rows = self._run(
+            f"{self._match()} AND {self.index_table} MATCH %s",
+            [self.get_match_expression(query)],
+            stack_id,
+            select="COUNT(*)"
+        )
+        return rows[0][0]
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    Searches through a GIN index over a weighted `tsvector` of each search document
+    """
+    def __init__(self, using: str):
+        super().__init__(using)
+        configuration = application_settings.SEARCH_TEXT_CONFIG
+
+        # The configuration is part of the indexed expression, so it can't be passed as a query parameter
+        if not _CONFIGURATION_PATTERN.match(configuration):
+            raise ImproperlyConfigured(f"'{configuration}' is not a valid text search configuration name")
+
+        self.configuration = f"'{configuration}'::regconfig"
+        self.vector = " || ".join(
+            f"setweight(to_tsvector({self.configuration}, document.{field}), '{POSTGRES_FIELD_WEIGHTS[field]}')"
+            for field in SEARCH_FIELDS
+        )
+
+    def install(self):
+        index_name = self.connection.ops.quote_name(f"{SearchDocument._meta.db_table}_vector_idx")
+        # An index expression can't refer to a table alias, so the alias is taken back out
+        vector = self.vector.replace("document.", "")
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {self.document_table} USING GIN (({vector}))")
+
+    def _match(self) -> str:
+        return (
+            f"{self.document_table} document JOIN plainto_tsquery({self.configuration}, %s) search_query "
+            f"ON ({self.vector}) @@ search_query"
+        )
+
+    def search(self, query: str, stack_id: int = None, limit: int = DEFAULT_PAGE_SIZE, offset: int = 0):
+        rows = self._run(
+            self._match(),
+            [query],
+            stack_id,
+            select=f"service.id, service.name, stack.id, stack.name, ts_rank({self.vector}, search_query) AS score",
+            suffix="ORDER BY score DESC, service.id LIMIT %s OFFSET %s",
+            suffix_parameters=[limit, offset]
+        )
+        return [SearchResult(*row) for row in rows]
+
+    def count(self, query: str, stack_id: int = None) -> int:
+        return self._run(self._match(), [query], stack_id, select="COUNT(*)")[0][0]
+
+
+@functools.lru_cache(maxsize=None)
+def _has_fts5(using: str) -> bool:
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def _get_backend(using: str) -> SearchBackend:
+    vendor = connections[using].vendor
+
+    if vendor == "sqlite" and _has_fts5(using):
+        return SQLiteSearchBackend(using)
+
+    if vendor == "postgresql":
+        return PostgresSearchBackend(using)
+
+    return ScanningSearchBackend(using)
+
+
+_installed_indexes: typing.Set[typing.Tuple[str, str]] = set()
+"""The aliases and names of the databases that are known to have their search index installed in this process"""
+
+
+def install_index(using: str = DEFAULT_DB_ALIAS) -> bool:
+    """
+    Create the search index, and whatever keeps it up to date, if the database doesn't have it yet
+
+    The index is installed after every `migrate`, but databases whose tables were created some other way are caught
+    here, the first time they are searched within a process. Documents written before the index was installed are
+    indexed along with it.
+
+    :param using: The alias of the database to install the index in
+    :return: False if the database doesn't have a table of search documents to index yet
+    """
+    connection = connections[using]
+    key = (using, str(connection.settings_dict["NAME"]))
+
+    if key in _installed_indexes:
+        return True
+
+    if SearchDocument._meta.db_table not in connection.introspection.table_names():
+        return False
+
+    _get_backend(using).install()
+
+    # An index created within a transaction that is rolled back goes with it, so it is only remembered once it commits
+    transaction.on_commit(functools.partial(_installed_indexes.add, key), using=using)
+    return True
+
+
+def get_backend(using: str = DEFAULT_DB_ALIAS) -> SearchBackend:
+    """
+    :param using: The alias of the database to search
+    :return: The fastest way to search the given database
+    """
+    install_index(using)
+    return _get_backend(using)
+
+
+@receiver(post_migrate)
+def _install_index(sender, using: str = DEFAULT_DB_ALIAS, **kwargs):
+    if getattr(sender, "name", None) == "builder":
+        install_index(using)
+
+
+def search(
+    query: str,
+    page: int = 1,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    stack_id: int = None,
+    using: str = DEFAULT_DB_ALIAS
+) -> SearchPage:
+    """
+    Find live services whose names, commands, builds, labels, or annotations contain every given term
+
+    Example:
+        >>> search("team-payments Dockerfile-dev").results
+        [SearchResult(payments/api, rank=12.4), SearchResult(payments/worker, rank=9.8)]
+
+    :param query: The terms to search for, separated by whitespace
+    :param page: Which page of results to return, starting at 1
+    :param page_size: The number of results per page. No more than `MAX_PAGE_SIZE`
+    :param stack_id: Only find services within this stack
+    :param using: The alias of the database to search
+    :return: The requested page of results, best first
+    """
+    query = query.strip()
+    if not query:
+        raise ValueError("A search needs at least one term")
+
+    if page < 1:
+        raise ValueError("Pages are numbered starting at 1")
+
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    backend = get_backend(using)
+
+    return SearchPage(
+        query=query,
+        page=page,
+        page_size=page_size,
+        count=backend.count(query, stack_id=stack_id),
+        results=backend.search(query, stack_id=stack_id, limit=page_size, offset=(page - 1) * page_size)
+    )
+
+
+def rebuild_index(using: str = DEFAULT_DB_ALIAS) -> int:
+    """
+    Regenerate the search document of every service
+
+    :param using: The alias of the database to reindex
+    :return: The number of documents that were written
+    """
+    backend = get_backend(using)
+    backend.install()
+    SearchDocument.objects.using(using).all().delete()
+
+    service_ids = Service.objects.using(using).order_by("pk").values_list("pk", flat=True)
+    written = index_services(service_ids.iterator(chunk_size=BATCH_SIZE), using=using)
+
+    backend.optimize()
+    return written
@@ -0,0 +1,259 @@
+"""
+A reverse index from each secret's name to everything that uses it
+
+Every row that uses a secret is mirrored by a `SecretUsage` row, so finding what is affected by rotating a secret, or
+which secrets are declared but never used, takes a single indexed query rather than a scan of every secret table.
+
+Usages are kept up to date by signal handlers, including when a service moves to another stack or a build moves to
+another service. Bulk operations that skip signals, like `bulk_create` and `QuerySet.update`, have to call
+`index_build_secrets`, `index_build_configurations`, or `index_services` themselves.
+
+A secret counts as declared within a stack when the stack or any stack that it is layered on declares it, since
+layered stacks inherit the declarations of their bases.
+"""
+from __future__ import annotations
+
+import typing
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db import models
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+
+from builder import overlays
+from builder.models import BuildConfiguration
+from builder.models import BuildSecret
+from builder.models import Secret
+from builder.models import SecretConsumer
+from builder.models import SecretUsage
+from builder.models import Service
+
+BATCH_SIZE = 500
+"""The maximum number of usages to write with a single statement"""
+
+
+class UndeclaredSecret(typing.NamedTuple):
+    """
+    A secret that is used within a stack that doesn't declare it
+    """
+    stack_id: int
+    stack_name: str
+    source: str
+
+    @property
+    def value(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "stack": self.stack_id,
+            "stack_name": self.stack_name,
+            "secret": self.source,
+        }
+
+
+def _usage_for_build_secret(secret: BuildSecret) -> SecretUsage:
+    """
+    :param secret: A build secret loaded along with its build configuration
+    :return: An unsaved usage describing the build secret
+    """
+    return SecretUsage(
+        source=secret.source,
+        consumer=SecretConsumer.build,
+        stack_id=secret.build_configuration.service.stack_id,
+        service_id=secret.build_configuration.service_id,
+        build_configuration_id=secret.build_configuration_id,
+        build_secret_id=secret.pk,
+        target=secret.target,
+        uid=secret.uid,
+        gid=secret.gid,
+        mode=secret.mode,
+    )
+
+
+def index_build_secrets(build_secret_ids: typing.Iterable[int], using: str = DEFAULT_DB_ALIAS) -> int:
+    """
+    Bring the usages of build secrets up to date
+
+    :param build_secret_ids: The primary keys of the build secrets to reindex
+    :param using: The alias of the database that the build secrets are in
+    :return: The number of usages that were written
+    """
+    build_secret_ids = list(build_secret_ids)
+
+    with transaction.atomic(using=using):
+        SecretUsage.objects.using(using).filter(build_secret_id__in=build_secret_ids).delete()
+
+        usages = [
+            _usage_for_build_secret(secret)
+            for secret in BuildSecret.objects.using(using).filter(pk__in=build_secret_ids).select_related(
+                "build_configuration__service"
+            )
+        ]
+        SecretUsage.objects.using(using).bulk_create(usages, batch_size=BATCH_SIZE)
+
+    return len(usages)
+
+
+@transaction.atomic
+def rebuild_index() -> int:
+    """
+    Regenerate every secret usage
+
+    :return: The number of usages that were written
+    """
+    SecretUsage.objects.all().delete()
+    written = 0
+
+    secrets = BuildSecret.objects.select_related("build_configuration__service").order_by("pk")
+    batch: typing.List[SecretUsage] = []
+
+    for secret in secrets.iterator(chunk_size=BATCH_SIZE):
+        batch.append(_usage_for_build_secret(secret))
+        if len(batch) >= BATCH_SIZE:
+            SecretUsage.objects.bulk_create(batch)
+            written += len(batch)
+            batch = []
+
+    SecretUsage.objects.bulk_create(batch)
+    return written + len(batch)
+
+
+def index_build_configurations(build_configuration_ids: typing.Iterable[int], using: str = DEFAULT_DB_ALIAS) -> int:
+    """
+    Bring the services and stacks of usages up to date after their build configurations moved to other services
+
+    :param build_configuration_ids: The primary keys of the build configurations that moved
+    :param using: The alias of the database that the build configurations are in
+    :return: The number of usages that were updated
+    """
+    builds = BuildConfiguration.objects.using(using).filter(pk=models.OuterRef("build_configuration_id"))
+    return SecretUsage.objects.using(using).filter(build_configuration_id__in=list(build_configuration_ids)).update(
+        service_id=models.Subquery(builds.values("service_id")),
+        stack_id=models.Subquery(builds.values("service__stack_id"))
+    )
+
+
+def index_services(service_ids: typing.Iterable[int], using: str = DEFAULT_DB_ALIAS) -> int:
+    """
+    Bring the stacks of usages up to date after their services moved to other stacks
+
+    :param service_ids: The primary keys of the services that moved
+    :param using: The alias of the database that the services are in
+    :return: The number of usages that were updated
+    """
+    services = Service.objects.using(using).filter(pk=models.OuterRef("service_id"))
+    return SecretUsage.objects.using(using).filter(service_id__in=list(service_ids)).update(
+        stack_id=models.Subquery(services.values("stack_id"))
+    )
+
+
+def _may_have_moved(
+    instance: models.Model,
+    field_name: str,
+    update_fields: typing.Optional[typing.Iterable[str]]
+) -> bool:
+    """
+    :param instance: A row that is about to be saved
+    :param field_name: The name of the foreign key that says where the row belongs
+    :param update_fields: The fields that the save is limited to, if any
+    :return: Whether the save may change the foreign key
+    """
+    field = instance._meta.get_field(field_name)
+
+    if instance._state.adding:
+        return False
+
+    if update_fields is not None:
+        return field.name in update_fields or field.attname in update_fields
+
+    stored = instance.get_stored_values()
+    return field.attname not in stored or stored[field.attname] != getattr(instance, field.attname)
+
+
+@receiver(pre_save, sender=Service)
+def _service_saving(sender, instance: Service, raw: bool = False, update_fields=None, **kwargs):
+    instance._secret_usage_moved = not raw and _may_have_moved(instance, "stack", update_fields)
+
+
+@receiver(pre_save, sender=BuildConfiguration)
+def _build_configuration_saving(sender, instance: BuildConfiguration, raw: bool = False, update_fields=None, **kwargs):
+    instance._secret_usage_moved = not raw and _may_have_moved(instance, "service", update_fields)
+
+
+@receiver(post_save, sender=Service)
+def _service_saved(sender, instance: Service, using: str, **kwargs):
+    if instance.__dict__.pop("_secret_usage_moved", False):
+        index_services([instance.pk], using=using)
+
+
+@receiver(post_save, sender=BuildConfiguration)
+def _build_configuration_saved(sender, instance: BuildConfiguration, using: str, **kwargs):
+    if instance.__dict__.pop("_secret_usage_moved", False):
+        index_build_configurations([instance.pk], using=using)
+
+
+@receiver(post_save, sender=BuildSecret)
+def _build_secret_saved(sender, instance: BuildSecret, using: str, raw: bool = False, **kwargs):
+    # Usages are removed along with their build secret through their foreign key, so only saves need handling
+    if not raw:
+        index_build_secrets([instance.pk], using=using)
+
+
+def _live_usages(stack_id: int = None) -> models.QuerySet:
+    usages = SecretUsage.objects.filter(service__deleted_at__isnull=True, stack__deleted_at__isnull=True)
+    if stack_id is not None:
+        usages = usages.filter(stack_id=stack_id)
+    return usages
+
+
+def find_consumers(source: str, stack_id: int = None) -> models.QuerySet:
+    """
+    Find everything that would be affected by rotating a secret
+
+    :param source: The name of the secret
+    :param stack_id: Only look within this stack
+    :return: Every live use of the secret, with its stack and service loaded
+    """
+    return _live_usages(stack_id).filter(source=source).select_related("stack", "service").order_by(
+        "stack__name", "service__name", "pk"
+    )
+
+
+def find_unused_secrets(stack_id: int = None) -> models.QuerySet:
+    """
+    :param stack_id: Only look within this stack
+    :return: Secrets that are declared by a live stack but never used within it
+    """
+    secrets = Secret.objects.filter(stack__deleted_at__isnull=True)
+    if stack_id is not None:
+        secrets = secrets.filter(stack_id=stack_id)
+
+    used = _live_usages().filter(stack_id=models.OuterRef("stack_id"), source=models.OuterRef("name"))
+    return secrets.filter(~models.Exists(used)).select_related("stack").order_by("stack__name", "name")
+
+
+def find_undeclared_secrets(stack_id: int = None) -> typing.List[UndeclaredSecret]:
+    """
+    :param stack_id: Only look within this stack
+    :return: Secrets that are used within a live stack that neither it nor any stack it is layered on declares
+    """
+    declared = Secret.objects.filter(stack_id=models.OuterRef("stack_id"), name=models.OuterRef("source"))
+    usages = _live_usages(stack_id).filter(~models.Exists(declared))
+    rows = [
+        UndeclaredSecret(*row)
+        for row in usages.values_list("stack_id", "stack__name", "source").distinct().order_by("stack__name", "source")
+    ]
+
+    if not rows:
+        return rows
+
+    # Only secrets that aren't declared by their own stack are left, so the bases of those stacks are all that is read
+    lineages = overlays.get_stack_lineages({row.stack_id for row in rows})
+    base_ids = {base_id for lineage in lineages.values() for base_id in lineage[1:]}
+    inherited = set(Secret.objects.filter(stack_id__in=base_ids).values_list("stack_id", "name"))
+
+    return [
+        row
+        for row in rows
+        if not any((base_id, row.source) in inherited for base_id in lineages.get(row.stack_id, [])[1:])
+    ]
@@ -0,0 +1,373 @@
+"""
+Canonical, byte stable serialization of compose documents
+
+Documents are first put into a canonical form: mapping keys are sorted, tuples become lists, whole numbers stored as
+floats become integers, and values JSON can't hold become strings. Lists keep their order; the models that render
+lists order their rows so that list order is already stable. The canonical form is then written by an encoder.
+
+Encoders are pluggable. Several may write the same format, like the pure Python and libyaml backed YAML emitters, but
+only each format's reference encoder, the standard library for JSON and PyYAML's `SafeDumper` for YAML, is guaranteed to
+write the same bytes for the same document wherever it runs, so exports are written by the reference encoders.
+`SWARM_COMPOSE_JSON_ENCODER` and `SWARM_COMPOSE_YAML_ENCODER` may name a faster encoder to use instead, or 'auto' to use
+the fastest installed encoder whose output matches the reference encoder's on a probe document. Agreeing on the probe
+doesn't mean agreeing on everything, so those should only be used where export bytes are never compared.
+
+Digests are the SHA-256 of a value's canonical JSON, which is always written by the standard library with sorted keys
+and no whitespace. Encoders only write response bodies, so a digest never depends on which encoder was chosen or on
+what is installed.
+"""
+from __future__ import annotations
+
+import abc
+import datetime
+import decimal
+import functools
+import hashlib
+import importlib.util
+import json
+import math
+import threading
+import time
+import typing
+
+from SwarmCompose import application_settings
+
+from builder import instrumentation
+
+FRAGMENT_SECTIONS: typing.Sequence[str] = ("services", "networks", "volumes", "secrets", "configs")
+"""Top level sections of a compose document whose members are digested on their own"""
+
+SELECTION_REPEAT = 5
+"""How many times each candidate encoder writes the probe document when choosing the fastest"""
+
+_MAXIMUM_SAFE_INTEGER = 2 ** 53
+
+
+def canonicalize(value: typing.Any) -> typing.Any:
+    """
+    Put a value into the form that every encoder writes
+
+    Example:
+        >>> canonicalize({"b": (1, 2.0), "a": {"d": None, "c": True}})
+        {'a': {'c': True, 'd': None}, 'b': [1, 2]}
+
+    :param value: A document or part of a document
+    :return: An equivalent value made only of sorted dicts, lists, strings, integers, floats, booleans, and None
+    """
+    if isinstance(value, dict):
+        return {str(key): canonicalize(value[key]) for key in sorted(value, key=str)}
+
+    if isinstance(value, (list, tuple)):
+        return [canonicalize(member) for member in value]
+
+    if value is None or isinstance(value, (str, bool, int)):
+        return value
+
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise ValueError(f"{value} can't be written to a compose document")
+        if value.is_integer() and abs(value) < _MAXIMUM_SAFE_INTEGER:
+            return int(value)
+        return value
+
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+
+    if isinstance(value, decimal.Decimal):
+        return canonicalize(float(value))
+
+    return str(value)
+
+
+class Encoder(abc.ABC):
+    """
+    Writes canonical documents in a single format
+    """
+    name: str = None
+    """What the encoder is called in settings and reports"""
+
+    format: str = None
+    """The format that the encoder writes, like 'json' or 'yaml'"""
+
+    content_type: str = None
+    """The media type of what the encoder writes"""
+
+    def is_available(self) -> bool:
+        """
+        :return: Whether everything the encoder relies on is installed
+        """
+        return True
+
+    @abc.abstractmethod
+    def encode(self, document: typing.Any) -> bytes:
+        """
+        :param document: A canonical document
+        :return: The encoded document
+        """
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.name})"
+
+
+class JsonEncoder(Encoder):
+    """
+    Writes JSON with the standard library. The reference encoder for JSON
+    """
+    name = "json"
+    format = "json"
+    content_type = "application/json"
+
+    def encode(self, document: typing.Any) -> bytes:
+        return (json.dumps(document, indent=2, ensure_ascii=False) + "\n").encode()
+
+
+class OrjsonEncoder(Encoder):
+    """
+    Writes JSON with orjson, if it is installed
+
+    orjson writes floats that need an exponent differently than the standard library ('1e-7' rather than '1e-07'),
+    which only changes how such values are spelled in response bodies. Documents that orjson can't write, like those
+    holding integers that don't fit in 64 bits, are written by the standard library instead
+    """
+    name = "orjson"
+    format = "json"
+    content_type = "application/json"
+
+    def is_available(self) -> bool:
+        return importlib.util.find_spec("orjson") is not None
+
+    def encode(self, document: typing.Any) -> bytes:
+        import orjson
+
+        try:
+            return orjson.dumps(document, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            return _encoders[_reference_encoders[self.format]].encode(document)
+
+
+class YamlEncoder(Encoder):
+    """
+    Writes YAML with PyYAML's pure Python emitter. The reference encoder for YAML
+    """
+    name = "yaml"
+    format = "yaml"
+    content_type = "application/yaml"
+    dumper_name = "SafeDumper"
+
+    def is_available(self) -> bool:
+        if importlib.util.find_spec("yaml") is None:
+            return False
+
+        import yaml
+
+        return hasattr(yaml, self.dumper_name)
+
+    def encode(self, document: typing.Any) -> bytes:
+        import yaml
+
+        return yaml.dump(
+            document,
+            Dumper=getattr(yaml, self.dumper_name),
+            sort_keys=False,
+            default_flow_style=False,
+            allow_unicode=True,
+            # Long strings would otherwise be folded onto several lines at points that differ between emitters
+            width=2 ** 31 - 1,
+        ).encode()
+
+
+class CYamlEncoder(YamlEncoder):
+    """
+    Writes YAML with PyYAML's bindings to libyaml, if PyYAML was built with them
+    """
+    name = "yaml-c"
+    dumper_name = "CSafeDumper"
+
+
+_encoders: typing.Dict[str, Encoder] = {}
+_reference_encoders: typing.Dict[str, str] = {}
+_selection_lock = threading.Lock()
+
+
+def register_encoder(encoder: Encoder, reference: bool = False):
+    """
+    Make an encoder available for selection
+
+    :param encoder: The encoder to add
+    :param reference: Whether the encoder's output is what every other encoder of the same format must match
+    """
+    _encoders[encoder.name] = encoder
+    if reference or encoder.format not in _reference_encoders:
+        _reference_encoders[encoder.format] = encoder.name
+    select_encoder.cache_clear()
+
+
+def get_formats() -> typing.List[str]:
+    """
+    :return: Every format that documents may be written in
+    """
+    return sorted(_reference_encoders)
+
+
+def get_encoders(format: str = None) -> typing.List[Encoder]:
+    """
+    :param format: Only include encoders that write this format
+    :return: Every registered encoder, installed or not
+    """
+    return [encoder for encoder in _encoders.values() if format is None or encoder.format == format]
+
+
+def _build_probe_document() -> typing.Dict[str, typing.Any]:
+    """
+    :return: A canonical document that uses the sorts of values that compose documents hold, including strings that
+        YAML emitters have to quote
+    """
+    services = {}
+    for index in range(25):
+        services[f"service-{index}"] = {
+            "build": {
+                "args": {"VERSION": f"1.{index}", "ENABLED": "yes", "EMPTY": ""},
+                "context": ".",
+                "dockerfile": "Dockerfile-dev",
+                "secrets": ["token", {"source": "key", "target": "key.pem", "mode": "0440"}],
+                "tags": [f"registry.example.com/app:{index}", "latest"],
+            },
+            "command": "python -m app --port ${PORT:-80} # not a comment",
+            "container_name": f"service-{index}",
+            "cpu_percent": 12.5 + index,
+            "cpu_count": index,
+            "depends_on": {f"service-{index - 1}": {"condition": "service_healthy", "required": True}} if index else [],
+            "annotations": {"description": "Ünïcödé: naïve café", "on": "off", "null": "~", "number": "0123"},
+            "attach": index % 2 == 0,
+            "networks": ["backend", "frontend"],
+        }
+
+    return canonicalize({
+        "services": services,
+        "networks": {
+            "backend": {"driver": "overlay", "attachable": True, "ipam": {"driver": "default", "config": []}},
+            "frontend": {"labels": {"com.example.team": "payments: web"}},
+        },
+        "secrets": {"token": {"file": "./token.txt"}, "key": {"external": True, "name": None}},
+    })
+
+
+def _time_encoder(encoder: Encoder, document: typing.Any) -> float:
+    """
+    :return: The fastest time, in seconds, that the encoder took to write the document
+    """
+    timings = []
+    for _ in range(SELECTION_REPEAT):
+        start = time.perf_counter()
+        encoder.encode(document)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def compare_encoders(format: str, document: typing.Any = None) -> typing.List[typing.Tuple[Encoder, bool, float]]:
+    """
+    Check every installed encoder of a format against the format's reference encoder
+
+    :param format: The format to compare encoders for
+    :param document: The canonical document to write. The probe document if None
+    :return: Each installed encoder, whether its output matched the reference encoder's, and how long it took
+    """
+    if format not in _reference_encoders:
+        raise KeyError(f"There are no encoders for '{format}'")
+
+    if document is None:
+        document = _build_probe_document()
+
+    expected = _encoders[_reference_encoders[format]].encode(document)
+    outcomes = []
+
+    for encoder in get_encoders(format):
+        if not encoder.is_available():
+            continue
+        matches = encoder.encode(document) == expected
+        outcomes.append((encoder, matches, _time_encoder(encoder, document)))
+
+    return outcomes
+
+
+def _get_configured_encoder_name(format: str) -> str:
+    configured = {
+        "json": application_settings.JSON_ENCODER,
+        "yaml": application_settings.YAML_ENCODER,
+    }
+    return configured.get(format) or _reference_encoders[format]
+
+
+@functools.lru_cache(maxsize=None)
+def select_encoder(format: str) -> Encoder:
+    """
+    Decide which encoder writes a format for the rest of the process
+
+    :param format: The format to write, like 'json' or 'yaml'
+    :return: The configured encoder, which is the reference encoder unless a setting says otherwise. With 'auto', the
+        fastest installed encoder whose output matches the reference encoder's on the probe document
+    """
+    name = _get_configured_encoder_name(format)
+
+    if name != "auto":
+        encoder = _encoders.get(name)
+        if encoder is None or encoder.format != format:
+            raise KeyError(f"There is no {format} encoder named '{name}'")
+        if not encoder.is_available():
+            raise ValueError(f"The '{name}' encoder was requested but what it relies on isn't installed")
+        return encoder
+
+    with _selection_lock:
+        candidates = [(timing, encoder) for encoder, matches, timing in compare_encoders(format) if matches]
+
+    return min(candidates, key=lambda candidate: candidate[0])[1]
+
+
+register_encoder(JsonEncoder(), reference=True)
+register_encoder(OrjsonEncoder())
+register_encoder(YamlEncoder(), reference=True)
+register_encoder(CYamlEncoder())
+
+
+@instrumentation.instrumented("serialization")
+def encode(document: typing.Any, format: str = "yaml") -> bytes:
+    """
+    :param document: A compose document, or part of one
+    :param format: What to write the document as, like 'json' or 'yaml'
+    :return: The canonical encoding of the document
+    """
+    return select_encoder(format).encode(canonicalize(document))
+
+
+def get_content_type(format: str) -> str:
+    """
+    :param format: A format that documents may be written in
+    :return: The media type of documents written in that format
+    """
+    return select_encoder(format).content_type
+
+
+@instrumentation.instrumented("serialization")
+def get_digest(value: typing.Any) -> str:
+    """
+    :param value: A compose document, or part of one
+    :return: The SHA-256 of the value's canonical JSON, which is the same for any value with the same content
+    """
+    canonical_json = json.dumps(canonicalize(value), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical_json.encode()).hexdigest()
+
+
+def get_digests(document: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    """
+    :param document: A compose document
+    :return: The digest of the whole document and of each member of each of its sections, like each service
+    """
+    fragments = {
+        section: {name: get_digest(fragment) for name, fragment in document[section].items()}
+        for section in FRAGMENT_SECTIONS
+        if isinstance(document.get(section), dict)
+    }
+    return {
+        "document": get_digest(document),
+        "fragments": fragments,
+    }
@@ -0,0 +1,77 @@
+"""
+Job types that may be performed by the local background job queue
+"""
+from __future__ import annotations
+
+import typing
+
+from datetime import timedelta
+
+from builder import jobs
+from builder import search
+from builder import teardown
+from builder import validation
+from builder.models import Job
+from builder.models import Stack
+
+
+@jobs.job_type("validate_stacks", concurrency=2)
+def validate_stacks(job: Job, stack_ids: typing.Sequence[int] = None) -> typing.Dict[str, typing.Any]:
+    """
+    Render stacks and check each one against the compose specification
+
+    :param job: The job that is being performed
+    :param stack_ids: The ids of the stacks to validate. Every stack if None
+    :return: Whether each stack was valid and what was wrong with the ones that weren't
+    """
+    stacks = Stack.objects.alive().order_by("pk")
+
+    if stack_ids is not None:
+        stacks = stacks.filter(pk__in=stack_ids)
+
+    total = stacks.count()
+    outcomes: typing.Dict[str, typing.Any] = {}
+
+    for index, stack in enumerate(stacks.iterator(), start=1):
+        problems = validation.validate_document(stack.render(validate=False))
+        outcomes[str(stack.pk)] = {
+            "name": stack.name,
+            "valid": not problems,
+            "problems": [problem.value for problem in problems],
+        }
+        job.report_progress(index / total, f"Validated '{stack.name}'")
+
+    return {
+        "valid": all(outcome["valid"] for outcome in outcomes.values()),
+        "stacks": outcomes,
+    }
+
+
+@jobs.job_type(teardown.PURGE_JOB, concurrency=1, max_attempts=3, retry_delay=30)
+def purge_deleted(job: Job, older_than: float = None) -> typing.Dict[str, typing.Any]:
+    """
+    Permanently delete stacks, services, and networks that were marked for deletion
+
+    :param job: The job that is being performed
+    :param older_than: Only purge rows that were marked at least this many seconds ago. Defaults to the
+        `SOFT_DELETE_RETENTION` application setting
+    :return: How many rows were deleted
+    """
+    total, counts = teardown.purge_deleted(None if older_than is None else timedelta(seconds=older_than))
+    return {
+        "deleted": total,
+        "models": counts,
+    }
+
+
+@jobs.job_type(search.REBUILD_JOB, concurrency=1)
+def rebuild_search_index(job: Job) -> typing.Dict[str, typing.Any]:
+    """
+    Regenerate the search document of every service
+
+    :param job: The job that is being performed
+    :return: How many documents were written
+    """
+    return {
+        "documents": search.rebuild_index(),
+    }
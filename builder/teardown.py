@@ -0,0 +1,261 @@
+"""
+Set based deletion of stacks, services, and networks
+
+Django's cascade collector loads every dependent row into memory before deleting anything. These functions instead
+delete from the bottom of the hierarchy up with `DELETE ... WHERE parent_id IN (subquery)` statements within a single
+transaction, so memory use stays the same no matter how much is deleted. No model signals are sent for the deleted rows;
+the change feed records the deletion of each stack, service, network, and secret, but not of everything within them.
+Services that extend deleted services and stacks layered on deleted stacks are detached from them, like
+`on_delete=SET_NULL` would.
+
+Querysets passed to these functions must only filter on the rows being deleted or their parents (like
+`Service.objects.filter(stack=stack)`), never on their children, since children are deleted first.
+
+Rows may also be soft deleted: they are marked with `deleted_at`, hidden from rendering, and purged later by the
+`purge_deleted` background job. Services and stacks layered on soft deleted rows stop inheriting from them right away.
+"""
+from __future__ import annotations
+
+import typing
+
+from datetime import timedelta
+
+from django.db import models
+from django.db import transaction
+from django.utils import timezone
+
+from SwarmCompose import application_settings
+
+from builder import changes
+from builder import jobs
+from builder import overlays
+from builder.models import BuildArg
+from builder.models import BuildConfiguration
+from builder.models import BuildSecret
+from builder.models import ChangeAction
+from builder.models import Deploy
+from builder.models import DeployLabel
+from builder.models import IPAddressManagementConfig
+from builder.models import IPAMAuxilaryAddresses
+from builder.models import ImageLabel
+from builder.models import ImageTags
+from builder.models import Job
+from builder.models import JobStatus
+from builder.models import Network
+from builder.models import NetworkDriverOptions
+from builder.models import NetworkLabel
+from builder.models import SearchDocument
+from builder.models import Secret
+from builder.models import SecretUsage
+from builder.models import Service
+from builder.models import ServiceAnnotation
+from builder.models import ServiceDependency
+from builder.models import Stack
+
+DELETION_COUNTS = typing.Tuple[int, typing.Dict[str, int]]
+"""The total number of deleted rows and the number deleted from each model, like `QuerySet.delete`"""
+
+PURGE_JOB = "purge_deleted"
+
+
+class _DeletionTally:
+    """
+    Keeps track of how many rows were deleted from each model
+    """
+    def __init__(self):
+        self.counts: typing.Dict[str, int] = {}
+
+    def delete(self, queryset: models.QuerySet):
+        """
+        Delete every row matched by a queryset with a single statement
+
+        :param queryset: The rows to delete
+        """
+        deleted = queryset._raw_delete(queryset.db)
+        if deleted:
+            label = queryset.model._meta.label
+            self.counts[label] = self.counts.get(label, 0) + deleted
+
+    @property
+    def value(self) -> DELETION_COUNTS:
+        return sum(self.counts.values()), self.counts
+
+
+def _touch(queryset: models.QuerySet):
+    """
+    Give what is affected by changing stacks, services, or networks new revisions
+
+    :param queryset: The stacks, services, or networks that are about to change
+    """
+    if queryset.model is Stack:
+        overlays.touch_stacks(queryset)
+    elif queryset.model is Service:
+        overlays.touch_services(queryset)
+    else:
+        overlays.touch_services(Service.objects.filter(networks__in=queryset.values("pk")))
+        overlays.touch_stacks(Stack.objects.filter(pk__in=queryset.values("stack_id")))
+
+
+def _delete_services(services: models.QuerySet, tally: _DeletionTally):
+    service_ids = services.values("pk")
+    build_ids = BuildConfiguration.objects.filter(service_id__in=service_ids).values("pk")
+    deploy_ids = Deploy.objects.filter(service_id__in=service_ids).values("pk")
+
+    extending = Service.objects.filter(extends_id__in=service_ids).exclude(pk__in=service_ids)
+    changes.record_queryset(extending, ChangeAction.updated, ["extends"])
+    _touch(extending)
+    extending.update(extends=None)
+
+    changes.record_queryset(Service.objects.filter(pk__in=service_ids), ChangeAction.deleted)
+    _touch(Service.objects.filter(pk__in=service_ids))
+    tally.delete(SecretUsage.objects.filter(service_id__in=service_ids))
+
+    for model in (BuildArg, ImageLabel, BuildSecret, ImageTags):
+        tally.delete(model.objects.filter(build_configuration_id__in=build_ids))
+
+    tally.delete(BuildConfiguration.objects.filter(service_id__in=service_ids))
+    tally.delete(DeployLabel.objects.filter(deploy_id__in=deploy_ids))
+    tally.delete(Deploy.objects.filter(service_id__in=service_ids))
+    tally.delete(ServiceAnnotation.objects.filter(service_id__in=service_ids))
+    tally.delete(ServiceDependency.objects.filter(service_id__in=service_ids))
+    tally.delete(Service.networks.through.objects.filter(service_id__in=service_ids))
+    tally.delete(SearchDocument.objects.filter(service_id__in=service_ids))
+    tally.delete(Service.objects.filter(pk__in=service_ids))
+
+
+def _delete_networks(networks: models.QuerySet, tally: _DeletionTally):
+    network_ids = networks.values("pk")
+    ipam_ids = IPAddressManagementConfig.objects.filter(network_id__in=network_ids).values("pk")
+
+    changes.record_queryset(Network.objects.filter(pk__in=network_ids), ChangeAction.deleted)
+    _touch(Network.objects.filter(pk__in=network_ids))
+    tally.delete(IPAMAuxilaryAddresses.objects.filter(ipam_id__in=ipam_ids))
+    tally.delete(IPAddressManagementConfig.objects.filter(network_id__in=network_ids))
+    tally.delete(NetworkLabel.objects.filter(network_id__in=network_ids))
+    tally.delete(NetworkDriverOptions.objects.filter(network_id__in=network_ids))
+    tally.delete(Service.networks.through.objects.filter(network_id__in=network_ids))
+    tally.delete(Network.objects.filter(pk__in=network_ids))
+
+
+def _schedule_purge():
+    """
+    Make sure that a purge will run once the rows that were just marked for deletion are old enough
+    """
+    def enqueue_purge():
+        retention = application_settings.SOFT_DELETE_RETENTION
+        already_scheduled = Job.objects.filter(
+            job_type=PURGE_JOB,
+            status=JobStatus.queued,
+            run_after__gte=timezone.now() + timedelta(seconds=retention)
+        ).exists()
+
+        if not already_scheduled:
+            jobs.enqueue(PURGE_JOB, delay=retention)
+
+    transaction.on_commit(enqueue_purge)
+
+
+def _should_soft_delete(soft: typing.Optional[bool]) -> bool:
+    return application_settings.SOFT_DELETE if soft is None else soft
+
+
+def _mark_deleted(queryset: models.QuerySet) -> int:
+    """
+    Mark rows for deletion and schedule their purge
+
+    :param queryset: The rows to mark
+    :return: The number of rows that were marked
+    """
+    unmarked = queryset.filter(deleted_at__isnull=True)
+    changes.record_queryset(unmarked, ChangeAction.updated, ["deleted_at"])
+    _touch(unmarked)
+    marked = unmarked.update(deleted_at=timezone.now())
+    _schedule_purge()
+    return marked
+
+
+@transaction.atomic
+def delete_services(services: models.QuerySet, soft: bool = None) -> DELETION_COUNTS:
+    """
+    Delete services along with everything that belongs to them
+
+    :param services: The services to delete
+    :param soft: Whether to only mark the services for deletion. Defaults to the `SOFT_DELETE` application setting
+    :return: The total number of affected rows and the number affected for each model
+    """
+    if _should_soft_delete(soft):
+        marked = _mark_deleted(services)
+        return marked, {Service._meta.label: marked}
+
+    tally = _DeletionTally()
+    _delete_services(services, tally)
+    return tally.value
+
+
+@transaction.atomic
+def delete_networks(networks: models.QuerySet, soft: bool = None) -> DELETION_COUNTS:
+    """
+    Delete networks along with everything that belongs to them and detach services from them
+
+    :param networks: The networks to delete
+    :param soft: Whether to only mark the networks for deletion. Defaults to the `SOFT_DELETE` application setting
+    :return: The total number of affected rows and the number affected for each model
+    """
+    if _should_soft_delete(soft):
+        marked = _mark_deleted(networks)
+        return marked, {Network._meta.label: marked}
+
+    tally = _DeletionTally()
+    _delete_networks(networks, tally)
+    return tally.value
+
+
+@transaction.atomic
+def delete_stacks(stacks: models.QuerySet, soft: bool = None) -> DELETION_COUNTS:
+    """
+    Delete stacks along with every service and network within them
+
+    :param stacks: The stacks to delete
+    :param soft: Whether to only mark the stacks for deletion. Defaults to the `SOFT_DELETE` application setting
+    :return: The total number of affected rows and the number affected for each model
+    """
+    if _should_soft_delete(soft):
+        marked = _mark_deleted(stacks)
+        return marked, {Stack._meta.label: marked}
+
+    stack_ids = stacks.values("pk")
+    tally = _DeletionTally()
+    _delete_services(Service.objects.filter(stack_id__in=stack_ids), tally)
+    _delete_networks(Network.objects.filter(stack_id__in=stack_ids), tally)
+    changes.record_queryset(Secret.objects.filter(stack_id__in=stack_ids), ChangeAction.deleted)
+    changes.record_queryset(Stack.objects.filter(pk__in=stack_ids), ChangeAction.deleted)
+
+    layered = Stack.objects.filter(base_id__in=stack_ids).exclude(pk__in=stack_ids)
+    changes.record_queryset(layered, ChangeAction.updated, ["base"])
+    layered.update(base=None, revision=overlays.new_revision())
+
+    tally.delete(Secret.objects.filter(stack_id__in=stack_ids))
+    tally.delete(Stack.objects.filter(pk__in=stack_ids))
+    return tally.value
+
+
+def purge_deleted(older_than: timedelta = None) -> DELETION_COUNTS:
+    """
+    Permanently delete everything that was marked for deletion
+
+    :param older_than: Only purge rows that were marked at least this long ago. Defaults to the
+        `SOFT_DELETE_RETENTION` application setting
+    :return: The total number of deleted rows and the number deleted from each model
+    """
+    if older_than is None:
+        older_than = timedelta(seconds=application_settings.SOFT_DELETE_RETENTION)
+
+    cutoff = timezone.now() - older_than
+    counts: typing.Dict[str, int] = {}
+
+    for delete, model in ((delete_stacks, Stack), (delete_services, Service), (delete_networks, Network)):
+        _, deleted = delete(model.objects.filter(deleted_at__lte=cutoff), soft=False)
+        for label, count in deleted.items():
+            counts[label] = counts.get(label, 0) + count
+
+    return sum(counts.values()), counts
@@ -1,3 +1,1388 @@
+"""
+Behavior tests for the builder app
+
+The app doesn't ship migrations, so the builder tables of the test database are created directly before any test runs
+"""
+from __future__ import annotations
+
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import unittest
+
+from unittest import mock
+
+from datetime import timedelta
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db import connections
+from django.db import transaction
+from django.test import Client
+from django.test import SimpleTestCase
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from SwarmCompose import application_settings
+from SwarmCompose.backends.sqlite3 import base as sqlite_backend
+
+from benchmarks import fixtures
+
+from builder import changes
+from builder import cloning
+from builder import instrumentation
+from builder import interpolation
+from builder import jobs
+from builder import overlays
+from builder import search
+from builder import secret_usage
+from builder import serialization
+from builder import teardown
+from builder import validation
+from builder.models import BuildArg
+from builder.models import BuildConfiguration
+from builder.models import BuildSecret
+from builder.models import ChangeAction
+from builder.models import ChangeEvent
+from builder.models import Deploy
+from builder.models import DeployLabel
+from builder.models import Job
+from builder.models import JobStatus
+from builder.models import Network
+from builder.models import NetworkLabel
+from builder.models import Secret
+from builder.models import SearchDocument
+from builder.models import SecretUsage
+from builder.models import Service
+from builder.models import ServiceAnnotation
+from builder.models import ServiceDependency
+from builder.models import Stack
+
+UNUSED_PROCESS_ID = 2 ** 22 + 1
+"""A process id above the largest that Linux hands out, so that no process can have it"""
+
+
+def setUpModule():
+    existing_tables = set(connection.introspection.table_names())
+    with connection.schema_editor() as editor:
+        for model in apps.get_app_config("builder").get_models():
+            if model._meta.db_table not in existing_tables:
+                editor.create_model(model)
+
+    # Migrations would install the search index after creating the tables
+    search.install_index()
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        jobs.job_type("test_limited", concurrency=1)(self._handle)
+        jobs.job_type("test_unlimited")(self._handle)
+        self.addCleanup(jobs._JOB_TYPES.pop, "test_limited")
+        self.addCleanup(jobs._JOB_TYPES.pop, "test_unlimited")
+
+    @staticmethod
+    def _handle(job: Job, stack_id: int, dry_run: bool = False):
+        return {"stack_id": stack_id, "dry_run": dry_run}
+
+    def test_enqueue_checks_arguments_against_the_handler(self):
+        jobs.enqueue("test_limited", stack_id=1, dry_run=True)
+
+        with self.assertRaises(TypeError):
+            jobs.enqueue("test_limited", stack=1)
+
+        with self.assertRaises(TypeError):
+            jobs.enqueue("test_limited")
+
+        self.assertEqual(Job.objects.count(), 1)
+
+    def _post_job(self, job_type: str, **headers):
+        return self.client.post(
+            reverse("builder:jobs"),
+            data=json.dumps({"job_type": job_type, "arguments": {"stack_id": 1}}),
+            content_type="application/json",
+            headers=headers
+        )
+
+    @mock.patch.object(application_settings, "API_TOKEN", "test-token")
+    @mock.patch.object(application_settings, "WEB_JOB_TYPES", ["test_limited"])
+    def test_enqueue_view_rejects_bad_arguments(self):
+        response = self.client.post(
+            reverse("builder:jobs"),
+            data=json.dumps({"job_type": "test_limited", "arguments": {"unexpected": 1}}),
+            content_type="application/json",
+            headers={"Authorization": "Bearer test-token"}
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("test_limited", response.json()["error"])
+        self.assertFalse(Job.objects.exists())
+
+    @mock.patch.object(application_settings, "API_TOKEN", "test-token")
+    @mock.patch.object(application_settings, "WEB_JOB_TYPES", ["test_limited"])
+    def test_only_staff_and_api_clients_may_enqueue_jobs(self):
+        self.assertEqual(self._post_job("test_limited").status_code, 401)
+        self.assertEqual(self._post_job("test_limited", Authorization="Bearer wrong-token").status_code, 401)
+
+        user = get_user_model().objects.create_user("viewer")
+        self.client.force_login(user)
+        self.assertEqual(self._post_job("test_limited").status_code, 403)
+
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self._post_job("test_limited").status_code, 202)
+
+        self.client.logout()
+        self.assertEqual(self._post_job("test_limited", Authorization="Bearer test-token").status_code, 202)
+        self.assertEqual(Job.objects.count(), 2)
+
+    @mock.patch.object(application_settings, "WEB_JOB_TYPES", ["test_limited"])
+    def test_staff_sessions_have_to_pass_the_csrf_check(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(get_user_model().objects.create_user("operator", is_staff=True))
+
+        response = client.post(
+            reverse("builder:jobs"),
+            data=json.dumps({"job_type": "test_limited", "arguments": {"stack_id": 1}}),
+            content_type="application/json"
+        )
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Job.objects.exists())
+
+    @mock.patch.object(application_settings, "API_TOKEN", "test-token")
+    @mock.patch.object(application_settings, "WEB_JOB_TYPES", ["test_limited"])
+    def test_only_allowed_job_types_may_be_enqueued_through_the_api(self):
+        response = self._post_job("test_unlimited", Authorization="Bearer test-token")
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Job.objects.exists())
+
+    @mock.patch.object(application_settings, "API_TOKEN", "test-token")
+    def test_only_staff_and_api_clients_may_cancel_jobs(self):
+        job = jobs.enqueue("test_limited", stack_id=1)
+        url = reverse("builder:job-cancel", args=[job.pk])
+
+        self.assertEqual(self.client.post(url).status_code, 401)
+        self.assertEqual(self.client.post(url, headers={"Authorization": "Bearer test-token"}).status_code, 200)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, JobStatus.cancelled)
+
+    def test_claims_respect_concurrency_limits(self):
+        first = jobs.enqueue("test_limited", stack_id=1)
+        second = jobs.enqueue("test_limited", stack_id=2)
+        unlimited = jobs.enqueue("test_unlimited", stack_id=3)
+
+        claimed = [jobs.claim_next_job("worker-a"), jobs.claim_next_job("worker-b"), jobs.claim_next_job("worker-c")]
+
+        self.assertEqual([job.pk for job in claimed if job], [first.pk, unlimited.pk])
+        second.refresh_from_db()
+        self.assertEqual(second.status, JobStatus.queued)
+
+    def test_claim_checks_the_limit_when_taking_the_job(self):
+        queued = jobs.enqueue("test_limited", stack_id=1)
+        # Another worker claimed a job of the same type after this worker picked its candidates
+        Job.objects.create(job_type="test_limited", status=JobStatus.running, worker="worker-b")
+
+        self.assertFalse(jobs._claim(queued.pk, "test_limited", "worker-a"))
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, JobStatus.queued)
+
+    def test_finished_jobs_free_their_slot(self):
+        jobs.enqueue("test_limited", stack_id=1)
+        jobs.enqueue("test_limited", stack_id=2)
+
+        job = jobs.claim_next_job("worker-a")
+        jobs.run_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, JobStatus.succeeded)
+        self.assertEqual(job.result, {"stack_id": 1, "dry_run": False})
+        self.assertIsNotNone(jobs.claim_next_job("worker-a"))
+
+    def test_requeue_only_takes_back_jobs_of_stopped_pools_on_this_host(self):
+        host = socket.gethostname()
+        abandoned = Job.objects.create(
+            job_type="test_limited",
+            status=JobStatus.running,
+            worker=f"{host}:{UNUSED_PROCESS_ID}:0"
+        )
+        live = Job.objects.create(job_type="test_limited", status=JobStatus.running, worker=f"{host}:{os.getpid()}:0")
+        elsewhere = Job.objects.create(
+            job_type="test_limited",
+            status=JobStatus.running,
+            worker=f"not-{host}:{UNUSED_PROCESS_ID}:0"
+        )
+
+        self.assertEqual(jobs.requeue_running_jobs(), 1)
+
+        statuses = dict(Job.objects.values_list("pk", "status"))
+        self.assertEqual(statuses[abandoned.pk], JobStatus.queued)
+        self.assertEqual(statuses[live.pk], JobStatus.running)
+        self.assertEqual(statuses[elsewhere.pk], JobStatus.running)
+
+
+class InterpolationTests(TestCase):
+    environment = {"SET": "value", "EMPTY": ""}
+
+    def assertInterpolates(self, template: str, expected: str):
+        self.assertEqual(interpolation.interpolate(template, self.environment), expected, template)
+
+    def test_plain_variables(self):
+        self.assertInterpolates("$SET/${SET}", "value/value")
+        self.assertInterpolates("${UNSET}|${EMPTY}", "|")
+        self.assertInterpolates("$$SET costs $$5", "$SET costs $5")
+        self.assertInterpolates("no variables", "no variables")
+
+    def test_defaults(self):
+        self.assertInterpolates("${SET:-default} ${EMPTY:-default} ${UNSET:-default}", "value default default")
+        self.assertInterpolates("${SET-default} ${EMPTY-default} ${UNSET-default}", "value  default")
+        self.assertInterpolates("${UNSET:-${SET}-${ALSO_UNSET:-nested}}", "value-nested")
+
+    def test_alternatives(self):
+        self.assertInterpolates("${SET:+alt}|${EMPTY:+alt}|${UNSET:+alt}", "alt||")
+        self.assertInterpolates("${SET+alt}|${EMPTY+alt}|${UNSET+alt}", "alt|alt|")
+
+    def test_required_variables(self):
+        self.assertInterpolates("${SET:?missing} ${EMPTY?missing}", "value ")
+
+        with self.assertRaisesMessage(interpolation.InterpolationError, "EMPTY must be set"):
+            interpolation.interpolate("${EMPTY:?EMPTY must be set}", self.environment)
+
+        with self.assertRaisesMessage(interpolation.InterpolationError, "required variable UNSET is missing a value"):
+            interpolation.interpolate("${UNSET?}", self.environment)
+
+    def test_malformed_templates(self):
+        for template in ("${SET", "${}", "${1ABC}", "${SET:x}"):
+            with self.subTest(template=template), self.assertRaises(interpolation.InterpolationError):
+                interpolation.interpolate(template, self.environment)
+
+    def test_compiled_documents_report_where_and_against_what_they_failed(self):
+        document = interpolation.CompiledDocument({
+            "services": {"api": {"image": "app:${TAG:?a tag is needed}", "command": ["run", "--port", "${PORT:-80}"]}},
+            "untouched": {"key": "value"},
+        })
+
+        self.assertEqual(document.variable_names, {"TAG", "PORT"})
+
+        resolved = document.resolve_all({"production": {"TAG": "1.0", "PORT": "443"}, "test": {"TAG": "dev"}})
+        self.assertEqual(resolved["production"]["services"]["api"]["image"], "app:1.0")
+        self.assertEqual(resolved["test"]["services"]["api"]["command"], ["run", "--port", "80"])
+        self.assertIs(resolved["test"]["untouched"], document.document["untouched"])
+
+        with self.assertRaises(interpolation.InterpolationError) as raised:
+            document.resolve_all({"broken": {}})
+
+        self.assertEqual(raised.exception.environment, "broken")
+        self.assertEqual(raised.exception.path, ("services", "api", "image"))
+
+    def test_previews_validate_each_resolved_document(self):
+        stack = Stack.objects.create(name="preview")
+        api = Service.objects.create(stack=stack, name="api", command="python -m api")
+        Service.objects.create(stack=stack, name="database", command="postgres")
+        ServiceDependency.objects.create(service=api, name="database", condition="${CONDITION:-service_started}")
+
+        documents = stack.preview({"default": {}, "healthy": {"CONDITION": "service_healthy"}}, validate=True)
+        self.assertEqual(
+            documents["healthy"]["services"]["api"]["depends_on"]["database"]["condition"],
+            "service_healthy"
+        )
+
+        with self.assertRaises(validation.ComposeValidationError) as raised:
+            stack.preview({"default": {}, "broken": {"CONDITION": "whenever"}}, validate=True)
+
+        self.assertEqual(raised.exception.environment, "broken")
+
+
+class CloningTests(TestCase):
+    def setUp(self):
+        self.stack = Stack.objects.create(name="original")
+        backend = Network.objects.create(stack=self.stack, name="backend")
+        self.api = Service.objects.create(stack=self.stack, name="api", command="python -m api")
+        self.api.networks.add(backend)
+        build = BuildConfiguration.objects.create(service=self.api, context="./api")
+        BuildArg.objects.create(build_configuration=build, key="VERSION", value="1")
+        self.worker = Service.objects.create(
+            stack=self.stack,
+            name="worker",
+            command="python -m worker",
+            extends=self.api
+        )
+
+    def test_clones_extend_the_copies_of_their_parents(self):
+        clone = cloning.clone_stack(self.stack, name="copy", prefix="c-")
+        services = {service.name: service for service in clone.services.all()}
+
+        self.assertEqual(services["c-worker"].extends_id, services["c-api"].pk)
+
+        worker = clone.render(validate=False)["services"]["c-worker"]
+        self.assertEqual(worker["networks"], ["c-backend"])
+        self.assertEqual(worker["build"]["context"], "./api")
+        self.assertEqual(worker["command"], "python -m worker")
+
+        # The original is untouched
+        self.worker.refresh_from_db()
+        self.assertEqual(self.worker.extends_id, self.api.pk)
+
+    @staticmethod
+    def _create_stack(name: str, size: int) -> Stack:
+        """
+        :return: A stack of services that each have a build with a secret, a deploy, annotations, and a dependency,
+            where every other service extends the one before it
+        """
+        stack = Stack.objects.create(name=name)
+        Secret.objects.create(stack=stack, name="token", file="./token.txt")
+        network = Network.objects.create(stack=stack, name="backend")
+        NetworkLabel.objects.create(network=network, key="team", label="payments")
+        previous = None
+
+        for index in range(size):
+            service = Service.objects.create(
+                stack=stack,
+                name=f"service-{index}",
+                command="serve",
+                extends=previous if index % 2 else None
+            )
+            service.networks.add(network)
+            ServiceAnnotation.objects.create(service=service, key="index", value=str(index))
+            if previous is not None:
+                ServiceDependency.objects.create(service=service, name=previous.name)
+            deploy = Deploy.objects.create(service=service)
+            DeployLabel.objects.create(deploy=deploy, key="tier", value="web")
+            build = BuildConfiguration.objects.create(service=service, context=f"./service-{index}")
+            BuildArg.objects.create(build_configuration=build, key="VERSION", value="1")
+            BuildSecret.objects.create(build_configuration=build, source="token")
+            previous = service
+
+        return stack
+
+    def _count_clone_queries(self, stack: Stack) -> int:
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            cloning.clone_stack(stack, name=f"{stack.name}-copy", prefix="copy-")
+        return len(queries)
+
+    def test_cloning_takes_the_same_number_of_queries_whatever_the_size_of_the_stack(self):
+        small = self._create_stack("small", size=4)
+        large = self._create_stack("large", size=60)
+
+        small_queries = self._count_clone_queries(small)
+        large_queries = self._count_clone_queries(large)
+
+        self.assertEqual(large_queries, small_queries)
+        self.assertLessEqual(large_queries, 60)
+
+        clone = Stack.objects.get(name="large-copy")
+        services = {service.name: service for service in clone.services.all()}
+        self.assertEqual(len(services), 60)
+        self.assertEqual(services["copy-service-1"].extends_id, services["copy-service-0"].pk)
+        self.assertIsNone(services["copy-service-2"].extends_id)
+        self.assertEqual(
+            SecretUsage.objects.filter(stack=clone, source="token").count(),
+            SecretUsage.objects.filter(stack=large, source="token").count()
+        )
+        self.assertEqual(
+            set(SecretUsage.objects.filter(stack=clone).values_list("service_id", flat=True)),
+            {service.pk for service in services.values()}
+        )
+
+    def test_clones_of_some_services_keep_parents_that_were_not_copied(self):
+        clone = cloning.clone_service(self.worker, name="worker-2")
+
+        self.assertEqual(clone.extends_id, self.api.pk)
+        self.assertEqual(self.stack.render(validate=False)["services"]["worker-2"]["networks"], ["backend"])
+
+    def test_clones_start_live_with_their_own_revision(self):
+        Stack.objects.filter(pk=self.stack.pk).update(deleted_at=timezone.now())
+        self.stack.refresh_from_db()
+        original_revision = Service.objects.get(pk=self.api.pk).revision
+
+        clone = cloning.clone_stack(self.stack, name="copy", prefix="c-")
+
+        self.assertIsNone(clone.deleted_at)
+        self.assertIsNone(Stack.objects.get(pk=clone.pk).deleted_at)
+        self.assertNotEqual(clone.services.get(name="c-api").revision, original_revision)
+
+    def test_soft_deleted_stacks_and_services_cant_be_cloned_through_the_api(self):
+        Service.objects.filter(pk=self.worker.pk).update(deleted_at=timezone.now())
+        Stack.objects.filter(pk=self.stack.pk).update(deleted_at=timezone.now())
+        self.client.force_login(get_user_model().objects.create_user("operator", is_staff=True))
+
+        stack_response = self.client.post(
+            reverse("builder:stack-clone", args=[self.stack.pk]),
+            data=json.dumps({"name": "copy"}),
+            content_type="application/json"
+        )
+        service_response = self.client.post(
+            reverse("builder:service-clone", args=[self.worker.pk]),
+            data=json.dumps({"name": "worker-2"}),
+            content_type="application/json"
+        )
+
+        self.assertEqual(stack_response.status_code, 404)
+        self.assertEqual(service_response.status_code, 404)
+        self.assertEqual(Stack.objects.count(), 1)
+
+    def test_cloning_through_the_api_needs_write_access(self):
+        response = self.client.post(
+            reverse("builder:stack-clone", args=[self.stack.pk]),
+            data=json.dumps({"name": "copy"}),
+            content_type="application/json"
+        )
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(Stack.objects.count(), 1)
+
+
+class StackApiTests(TestCase):
+    def setUp(self):
+        self.stack = Stack.objects.create(name="payments", description="Takes payments")
+        self.network = Network.objects.create(stack=self.stack, name="backend")
+        Secret.objects.create(stack=self.stack, name="token", file="./token.txt")
+        self.api = Service.objects.create(stack=self.stack, name="api", command="python -m api")
+        self.worker = Service.objects.create(stack=self.stack, name="worker", command="python -m worker")
+        self.overlay = Stack.objects.create(name="overlay", base=self.stack)
+        Stack.objects.create(name="archived", deleted_at=timezone.now())
+
+    def _sign_in(self):
+        self.client.force_login(get_user_model().objects.create_user("operator", is_staff=True))
+
+    def _patch(self, service: Service, payload, **headers):
+        return self.client.patch(
+            reverse("builder:service", args=[service.pk]),
+            data=json.dumps(payload),
+            content_type="application/json",
+            headers=headers
+        )
+
+    def test_stack_list_pages_through_live_stacks_by_name(self):
+        first = self.client.get(reverse("builder:stacks"), {"page_size": 1}).json()
+        second = self.client.get(reverse("builder:stacks"), {"page": 2, "page_size": 1}).json()
+
+        self.assertEqual(first["total"], 2)
+        self.assertEqual(second["total"], 2)
+        self.assertEqual(first["stacks"], [{
+            "id": self.overlay.pk,
+            "name": "overlay",
+            "description": self.overlay.description,
+            "base": self.stack.pk,
+            "services": 0,
+        }])
+        self.assertEqual(second["stacks"][0]["id"], self.stack.pk)
+        self.assertEqual(second["stacks"][0]["services"], 2)
+
+    def test_stack_list_rejects_bad_pages(self):
+        for parameters in ({"page": "first"}, {"page": 0}, {"page_size": 0}, {"page_size": 10 ** 6}):
+            with self.subTest(**parameters):
+                self.assertEqual(self.client.get(reverse("builder:stacks"), parameters).status_code, 400)
+
+    def test_stack_detail_lists_what_is_within_the_stack(self):
+        Service.objects.filter(pk=self.worker.pk).update(deleted_at=timezone.now())
+
+        response = self.client.get(reverse("builder:stack", args=[self.stack.pk]))
+
+        self.assertEqual(response.json(), {
+            "id": self.stack.pk,
+            "name": "payments",
+            "description": "Takes payments",
+            "base": None,
+            "services": [{"id": self.api.pk, "name": "api"}],
+            "networks": [{"id": self.network.pk, "name": "backend"}],
+            "secrets": ["token"],
+        })
+        archived = Stack.objects.get(name="archived")
+        self.assertEqual(self.client.get(reverse("builder:stack", args=[archived.pk])).status_code, 404)
+
+    @mock.patch.object(application_settings, "API_TOKEN", "test-token")
+    def test_deleting_a_stack_needs_write_access(self):
+        url = reverse("builder:stack", args=[self.stack.pk])
+
+        self.assertEqual(self.client.delete(url).status_code, 401)
+        self.assertTrue(Stack.objects.alive().filter(pk=self.stack.pk).exists())
+
+        response = self.client.delete(f"{url}?soft=true", headers={"Authorization": "Bearer test-token"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Stack.objects.alive().filter(pk=self.stack.pk).exists())
+
+    def test_deleting_services_and_networks_needs_write_access(self):
+        service_url = reverse("builder:service", args=[self.api.pk])
+        network_url = reverse("builder:network", args=[self.network.pk])
+
+        self.assertEqual(self.client.delete(service_url).status_code, 401)
+        self.assertEqual(self.client.delete(network_url).status_code, 401)
+
+        self.client.force_login(get_user_model().objects.create_user("viewer"))
+        self.assertEqual(self.client.delete(service_url).status_code, 403)
+        self.assertEqual(self.client.delete(network_url).status_code, 403)
+        self.assertTrue(Service.objects.alive().filter(pk=self.api.pk).exists())
+        self.assertTrue(Network.objects.alive().filter(pk=self.network.pk).exists())
+
+        self._sign_in()
+        self.assertEqual(self.client.delete(service_url).status_code, 200)
+        self.assertEqual(self.client.delete(network_url).status_code, 200)
+        self.assertFalse(Service.objects.alive().filter(pk=self.api.pk).exists())
+        self.assertFalse(Network.objects.alive().filter(pk=self.network.pk).exists())
+
+    @mock.patch.object(application_settings, "API_TOKEN", "test-token")
+    def test_editing_a_service_needs_write_access(self):
+        self.assertEqual(self._patch(self.api, {"command": "serve"}).status_code, 401)
+        self.assertEqual(Service.objects.get(pk=self.api.pk).command, "python -m api")
+
+        response = self._patch(self.api, {"command": "serve"}, Authorization="Bearer test-token")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Service.objects.get(pk=self.api.pk).command, "serve")
+
+    def test_only_editable_fields_of_a_service_may_be_changed(self):
+        self._sign_in()
+
+        for payload in ({"unknown": 1}, {"stack": self.overlay.pk}, {"revision": 5}, {"deleted_at": None}, {"id": 1}):
+            with self.subTest(payload=payload):
+                response = self._patch(self.api, {"command": "serve", **payload})
+
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(next(iter(payload)), response.json()["error"])
+
+        self.assertEqual(self._patch(self.api, {}).status_code, 400)
+        self.assertEqual(self._patch(self.api, ["command"]).status_code, 400)
+
+        service = Service.objects.get(pk=self.api.pk)
+        self.assertEqual(service.command, "python -m api")
+        self.assertEqual(service.stack_id, self.stack.pk)
+
+    def test_edits_to_a_service_are_validated(self):
+        self._sign_in()
+
+        invalid = self._patch(self.api, {"cpu_count": -1})
+        duplicate = self._patch(self.api, {"name": "worker"})
+        renamed = self._patch(self.api, {"name": "gateway", "cpu_count": 2})
+
+        self.assertEqual(invalid.status_code, 400)
+        self.assertIn("cpu_count", invalid.json()["error"])
+        self.assertEqual(duplicate.status_code, 409)
+        self.assertEqual(renamed.status_code, 200)
+        self.assertEqual(renamed.json(), {"id": self.api.pk, "name": "gateway", "stack": self.stack.pk})
+
+        service = Service.objects.get(pk=self.api.pk)
+        self.assertEqual((service.name, service.cpu_count, service.command), ("gateway", 2, "python -m api"))
+
+
+class TeardownTests(TestCase):
+    def setUp(self):
+        self.stack = Stack.objects.create(name="doomed")
+        Secret.objects.create(stack=self.stack, name="token", file="./token.txt")
+        network = Network.objects.create(stack=self.stack, name="backend")
+        NetworkLabel.objects.create(network=network, key="tier", label="back")
+        self.services = []
+
+        for name in ("api", "worker"):
+            service = Service.objects.create(stack=self.stack, name=name, command=f"python -m {name}")
+            service.networks.add(network)
+            build = BuildConfiguration.objects.create(service=service, context=f"./{name}")
+            BuildArg.objects.create(build_configuration=build, key="VERSION", value="1")
+            BuildArg.objects.create(build_configuration=build, key="DEBUG", value="0")
+            self.services.append(service)
+
+    def test_hard_deletion_counts_every_row(self):
+        total, counts = teardown.delete_stacks(Stack.objects.filter(pk=self.stack.pk), soft=False)
+
+        self.assertEqual(counts["builder.Stack"], 1)
+        self.assertEqual(counts["builder.Service"], 2)
+        self.assertEqual(counts["builder.BuildConfiguration"], 2)
+        self.assertEqual(counts["builder.BuildArg"], 4)
+        self.assertEqual(counts["builder.Network"], 1)
+        self.assertEqual(counts["builder.NetworkLabel"], 1)
+        self.assertEqual(counts["builder.Secret"], 1)
+        self.assertEqual(counts["builder.Service_networks"], 2)
+        self.assertEqual(total, sum(counts.values()))
+        self.assertFalse(Service.objects.exists())
+        self.assertFalse(BuildArg.objects.exists())
+
+    def _count_deletion_queries(self, stack: Stack) -> int:
+        # Write the events that creating the stacks buffered, so they aren't counted against the first deletion
+        changes.record_queryset(Stack.objects.filter(name=""), ChangeAction.deleted)
+
+        with CaptureQueriesContext(connection) as queries:
+            teardown.delete_stacks(Stack.objects.filter(pk=stack.pk), soft=False)
+        return len(queries)
+
+    def test_hard_deletion_takes_the_same_number_of_queries_whatever_the_size_of_the_stack(self):
+        small = CloningTests._create_stack("small", size=4)
+        large = CloningTests._create_stack("large", size=60)
+        service_ids = list(large.services.values_list("pk", flat=True))
+
+        small_queries = self._count_deletion_queries(small)
+        large_queries = self._count_deletion_queries(large)
+
+        self.assertEqual(large_queries, small_queries)
+        events = ChangeEvent.objects.filter(model="builder.Service", action=ChangeAction.deleted, stack_id=large.pk)
+        self.assertCountEqual(events.values_list("object_id", flat=True), service_ids)
+        self.assertEqual({tuple(fields) for fields in events.values_list("changed_fields", flat=True)}, {()})
+
+    def test_soft_deletion_only_counts_newly_marked_rows(self):
+        services = Service.objects.filter(stack=self.stack)
+
+        self.assertEqual(teardown.delete_services(services, soft=True), (2, {"builder.Service": 2}))
+        self.assertEqual(teardown.delete_services(services, soft=True), (0, {"builder.Service": 0}))
+        self.assertEqual(Service.objects.alive().count(), 0)
+        self.assertEqual(BuildArg.objects.count(), 4)
+
+        total, counts = teardown.purge_deleted(older_than=timedelta(0))
+
+        self.assertEqual(counts["builder.Service"], 2)
+        self.assertEqual(counts["builder.BuildArg"], 4)
+        self.assertFalse(Service.objects.exists())
+        self.assertTrue(Stack.objects.filter(pk=self.stack.pk).exists())
+
+    def test_services_stop_extending_soft_deleted_services(self):
+        api, worker = self.services
+        Service.objects.filter(pk=worker.pk).update(extends=api)
+        other_stack = Stack.objects.create(name="elsewhere")
+        consumer = Service.objects.create(stack=other_stack, name="consumer", extends=api)
+
+        self.assertEqual(other_stack.render(validate=False)["services"]["consumer"]["build"]["context"], "./api")
+
+        teardown.delete_services(Service.objects.filter(pk=api.pk), soft=True)
+
+        self.assertNotIn("build", other_stack.render(validate=False)["services"]["consumer"])
+        self.assertEqual(self.stack.render(validate=False)["services"]["worker"]["build"]["context"], "./worker")
+        consumer.refresh_from_db()
+        self.assertEqual(consumer.extends_id, api.pk)
+
+    def test_stacks_stop_layering_on_soft_deleted_stacks(self):
+        overlay = Stack.objects.create(name="overlay", base=self.stack)
+        self.assertEqual(set(overlay.render(validate=False)["services"]), {"api", "worker"})
+
+        teardown.delete_stacks(Stack.objects.filter(pk=self.stack.pk), soft=True)
+
+        self.assertFalse(overlay.render(validate=False).get("services"))
+
+
+class SecretUsageTests(TestCase):
+    def setUp(self):
+        self.stack = Stack.objects.create(name="payments")
+        self.layered = Stack.objects.create(name="payments-eu", base=self.stack)
+        Secret.objects.create(stack=self.stack, name="token", file="./token.txt")
+        Secret.objects.create(stack=self.stack, name="spare", file="./spare.txt")
+
+        self.api = self._add_secrets(self.stack, "api", "token")
+        self.worker = self._add_secrets(self.stack, "worker", "missing")
+        self.eu_api = self._add_secrets(self.layered, "eu-api", "token", "eu-only")
+
+    @staticmethod
+    def _add_secrets(stack: Stack, name: str, *sources: str) -> Service:
+        service = Service.objects.create(stack=stack, name=name)
+        build = BuildConfiguration.objects.create(service=service, context=f"./{name}")
+        for source in sources:
+            BuildSecret.objects.create(build_configuration=build, source=source, target=f"/run/{source}", mode="0400")
+        return service
+
+    def _consumers(self, source: str, stack_id: int = None):
+        return [(usage.stack_id, usage.service_id) for usage in secret_usage.find_consumers(source, stack_id=stack_id)]
+
+    def test_consumers_are_every_live_use_of_a_secret(self):
+        self.assertEqual(self._consumers("token"), [
+            (self.stack.pk, self.api.pk),
+            (self.layered.pk, self.eu_api.pk),
+        ])
+        self.assertEqual(self._consumers("token", stack_id=self.layered.pk), [(self.layered.pk, self.eu_api.pk)])
+
+        teardown.delete_services(Service.objects.filter(pk=self.api.pk), soft=True)
+
+        self.assertEqual(self._consumers("token"), [(self.layered.pk, self.eu_api.pk)])
+
+    def test_unused_secrets_are_declared_but_never_used(self):
+        unused = [(secret.stack_id, secret.name) for secret in secret_usage.find_unused_secrets()]
+
+        self.assertEqual(unused, [(self.stack.pk, "spare")])
+
+    def test_secrets_declared_by_a_base_stack_are_not_undeclared(self):
+        undeclared = [(secret.stack_id, secret.source) for secret in secret_usage.find_undeclared_secrets()]
+
+        self.assertEqual(undeclared, [(self.stack.pk, "missing"), (self.layered.pk, "eu-only")])
+
+        Stack.objects.filter(pk=self.stack.pk).update(deleted_at=timezone.now())
+
+        undeclared = secret_usage.find_undeclared_secrets(stack_id=self.layered.pk)
+        self.assertEqual([secret.source for secret in undeclared], ["eu-only", "token"])
+
+    def test_usages_follow_services_and_builds_that_move(self):
+        other_stack = Stack.objects.create(name="reports")
+        self.worker.stack = other_stack
+        self.worker.save()
+
+        self.assertEqual(self._consumers("missing"), [(other_stack.pk, self.worker.pk)])
+
+        build = self.api.buildconfiguration_set.get()
+        build.service = self.worker
+        build.save()
+
+        self.assertEqual(self._consumers("token", stack_id=other_stack.pk), [(other_stack.pk, self.worker.pk)])
+
+        secret = build.secrets.get()
+        secret.source = "rotated"
+        secret.save()
+
+        self.assertEqual(self._consumers("token", stack_id=other_stack.pk), [])
+        self.assertEqual(self._consumers("rotated"), [(other_stack.pk, self.worker.pk)])
+
+    def test_bulk_updates_are_picked_up_once_reindexed(self):
+        secret_ids = list(BuildSecret.objects.filter(source="eu-only").values_list("pk", flat=True))
+        BuildSecret.objects.filter(pk__in=secret_ids).update(source="eu-token")
+        secret_usage.index_build_secrets(secret_ids)
+
+        Service.objects.filter(pk=self.eu_api.pk).update(stack=self.stack)
+        secret_usage.index_services([self.eu_api.pk])
+
+        self.assertEqual(self._consumers("eu-only"), [])
+        self.assertEqual(self._consumers("eu-token"), [(self.stack.pk, self.eu_api.pk)])
+
+    def test_views_report_consumers_and_unused_and_undeclared_secrets(self):
+        consumers = self.client.get(reverse("builder:secret-consumers", args=["token"]), {"stack": self.stack.pk})
+        unused = self.client.get(reverse("builder:unused-secrets"))
+        undeclared = self.client.get(reverse("builder:undeclared-secrets"), {"stack": self.layered.pk})
+        invalid = self.client.get(reverse("builder:unused-secrets"), {"stack": "payments"})
+
+        self.assertEqual(consumers.status_code, 200)
+        self.assertEqual(
+            [(usage["service_name"], usage["target"], usage["mode"]) for usage in consumers.json()["consumers"]],
+            [("api", "/run/token", "0400")]
+        )
+        self.assertEqual(unused.json(), {
+            "secrets": [{"stack": self.stack.pk, "stack_name": "payments", "secret": "spare"}]
+        })
+        self.assertEqual(undeclared.json(), {
+            "secrets": [{"stack": self.layered.pk, "stack_name": "payments-eu", "secret": "eu-only"}]
+        })
+        self.assertEqual(invalid.status_code, 400)
+
+    def test_command_reports_consumers_and_unused_and_undeclared_secrets(self):
+        SecretUsage.objects.all().delete()
+        output = io.StringIO()
+
+        call_command("secret_usage", "token", "--rebuild", "--unused", "--undeclared", stdout=output)
+
+        self.assertEqual(output.getvalue().splitlines(), [
+            "Indexed 4 secret usage(s)",
+            "token: used 2 time(s)",
+            "    payments/api (build): target=/run/token, mode=0400",
+            "    payments-eu/eu-api (build): target=/run/token, mode=0400",
+            "Unused secrets: 1",
+            "    payments/spare",
+            "Undeclared secrets: 2",
+            "    payments/missing",
+            "    payments-eu/eu-only",
+        ])
+
+        with self.assertRaises(CommandError):
+            call_command("secret_usage", stdout=io.StringIO())
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.stack = Stack.objects.create(name="payments")
+            self.other_stack = Stack.objects.create(name="reports")
+            self.api = Service.objects.create(stack=self.stack, name="payments-api", command="gunicorn api:app")
+            self.worker = Service.objects.create(stack=self.stack, name="payments-worker", command="celery worker")
+            self.report = Service.objects.create(stack=self.other_stack, name="payments-report", command="cron")
+
+    def _find(self, query: str, **kwargs):
+        return [result.service_id for result in search.search(query, **kwargs).results]
+
+    def test_services_are_searched_through_the_full_text_index(self):
+        self.assertIsInstance(search.get_backend(), search.SQLiteSearchBackend)
+
+    def test_every_term_must_appear(self):
+        self.assertCountEqual(self._find("payments"), [self.api.pk, self.worker.pk, self.report.pk])
+        self.assertEqual(self._find("payments celery"), [self.worker.pk])
+        self.assertEqual(self._find("payments celery gunicorn"), [])
+
+    def test_terms_ending_with_a_star_match_prefixes(self):
+        self.assertEqual(self._find("gunicorn"), [self.api.pk])
+        self.assertEqual(self._find("gunic*"), [self.api.pk])
+        self.assertEqual(self._find("gunic"), [])
+
+    def test_searches_can_be_limited_to_a_stack(self):
+        self.assertCountEqual(self._find("payments", stack_id=self.stack.pk), [self.api.pk, self.worker.pk])
+        self.assertEqual(self._find("payments", stack_id=self.other_stack.pk), [self.report.pk])
+
+    def test_soft_deleted_services_and_stacks_are_not_found(self):
+        Service.objects.filter(pk=self.api.pk).update(deleted_at=timezone.now())
+        Stack.objects.filter(pk=self.other_stack.pk).update(deleted_at=timezone.now())
+
+        self.assertEqual(self._find("payments"), [self.worker.pk])
+
+    def test_pages_share_the_total_count(self):
+        pages = [search.search("payments", page=page, page_size=2) for page in (1, 2)]
+
+        self.assertEqual([page.count for page in pages], [3, 3])
+        self.assertEqual([page.pages for page in pages], [2, 2])
+        self.assertCountEqual(
+            [result.service_id for page in pages for result in page.results],
+            [self.api.pk, self.worker.pk, self.report.pk]
+        )
+
+    def test_changes_are_indexed_once_their_transaction_commits(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            for index in range(3):
+                Service.objects.create(stack=self.stack, name=f"ledger-{index}")
+            self.assertEqual(self._find("ledger*"), [])
+
+        flushes = [
+            callback for callback in callbacks if getattr(callback, "func", None) == search._pending_changes.flush
+        ]
+        self.assertEqual(len(flushes), 1)
+        self.assertEqual(len(self._find("ledger*")), 3)
+
+
+class SerializationTests(SimpleTestCase):
+    document = {
+        "services": {
+            "api": {"command": "python -m api", "cpu_percent": 1e-7, "labels": {"b": "2", "a": "ü"}},
+            "worker": {"cpu_count": 2.0, "ulimits": {"nofile": 2 ** 64}},
+        },
+    }
+
+    def test_digests_are_the_sha256_of_compact_standard_library_json(self):
+        expected = json.dumps(serialization.canonicalize(self.document), sort_keys=True, separators=(",", ":"))
+
+        self.assertEqual(serialization.get_digest(self.document), hashlib.sha256(expected.encode()).hexdigest())
+
+    def test_digests_only_depend_on_content(self):
+        reordered = {
+            "services": {
+                "worker": {"ulimits": {"nofile": 2 ** 64}, "cpu_count": 2},
+                "api": {"labels": {"a": "ü", "b": "2"}, "cpu_percent": 1e-7, "command": "python -m api"},
+            },
+        }
+
+        self.assertEqual(serialization.get_digest(reordered), serialization.get_digest(self.document))
+        self.assertNotEqual(serialization.get_digest({"value": 1e-7}), serialization.get_digest({"value": 1e-6}))
+
+    def test_every_installed_json_encoder_matches_the_reference_encoder(self):
+        for encoder, matches, _ in serialization.compare_encoders("json"):
+            with self.subTest(encoder=encoder.name):
+                self.assertTrue(matches)
+
+    def test_exports_are_written_by_the_reference_encoders_unless_configured_otherwise(self):
+        self.addCleanup(serialization.select_encoder.cache_clear)
+        document = {"small": 1e-7, "large": 1e16, "text": "naïve"}
+        expected = serialization.JsonEncoder().encode(serialization.canonicalize(document))
+
+        for format in serialization.get_formats():
+            serialization.select_encoder.cache_clear()
+            with self.subTest(format=format):
+                self.assertEqual(serialization.select_encoder(format).name, format)
+
+        self.assertEqual(serialization.encode(document, format="json"), expected)
+        self.assertIn(b'"small": 1e-07', expected)
+
+        with mock.patch.object(application_settings, "JSON_ENCODER", "auto"):
+            serialization.select_encoder.cache_clear()
+            self.assertIn(serialization.select_encoder("json").name, ["json", "orjson"])
+
+    @unittest.skipUnless(importlib.util.find_spec("orjson"), "orjson is not installed")
+    def test_orjson_falls_back_to_the_standard_library_for_what_it_cant_write(self):
+        document = serialization.canonicalize(self.document)
+        document["services"]["api"].pop("cpu_percent")
+
+        self.assertEqual(serialization.OrjsonEncoder().encode(document), serialization.JsonEncoder().encode(document))
+
+
+class ChangeFeedTests(TransactionTestCase):
+    def setUp(self):
+        self.stack = Stack.objects.create(name="payments")
+        self.other_stack = Stack.objects.create(name="reports")
+        self.services = [Service.objects.create(stack=self.stack, name=f"service-{index}") for index in range(5)]
+        self.report = Service.objects.create(stack=self.other_stack, name="report")
+        self.start = ChangeEvent.objects.order_by("pk").first().pk - 1
+
+    def _read_all(self, limit: int, **kwargs):
+        cursor = self.start
+        pages = []
+        while True:
+            events = changes.get_events(after=cursor, limit=limit, **kwargs)
+            if not events:
+                return pages
+            pages.append([(event.model, event.object_id) for event in events])
+            cursor = events[-1].pk
+
+    def test_events_are_written_when_their_transaction_commits(self):
+        with transaction.atomic():
+            service = Service.objects.create(stack=self.stack, name="ledger")
+            self.assertFalse(ChangeEvent.objects.filter(model="builder.Service", object_id=service.pk).exists())
+
+        event = ChangeEvent.objects.get(model="builder.Service", object_id=service.pk)
+        self.assertEqual(event.action, ChangeAction.created)
+        self.assertEqual(event.stack_id, self.stack.pk)
+
+    def test_a_transaction_writes_its_events_with_one_insert(self):
+        services = list(Service.objects.filter(stack=self.stack))
+        table = ChangeEvent._meta.db_table
+
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                for service in services:
+                    service.command = f"serve {service.name}"
+                    service.save()
+
+        inserts = [query for query in queries if query["sql"].startswith(f'INSERT INTO "{table}"')]
+        # Reading a service back to compare it with what was saved would look it up by its key alone
+        lookup = f'FROM "{Service._meta.db_table}" WHERE "{Service._meta.db_table}"."id" = '
+        reads = [query for query in queries if query["sql"].startswith("SELECT") and lookup in query["sql"]]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(reads, [])
+        self.assertEqual(ChangeEvent.objects.filter(action=ChangeAction.updated).count(), len(services))
+        self.assertEqual(
+            list(ChangeEvent.objects.filter(action=ChangeAction.updated).values_list("changed_fields", flat=True)),
+            [["command"]] * len(services)
+        )
+
+    def test_updates_compare_against_what_was_last_saved(self):
+        service = Service.objects.get(pk=self.report.pk)
+        service.command = "report --daily"
+        service.save()
+        service.name = "daily-report"
+        service.save()
+
+        events = ChangeEvent.objects.filter(model="builder.Service", object_id=service.pk, action=ChangeAction.updated)
+        self.assertEqual([event.changed_fields for event in events], [["command"], ["name"]])
+
+    def test_rolled_back_savepoints_take_only_their_own_events(self):
+        cursor = ChangeEvent.objects.order_by("pk").last().pk
+
+        with transaction.atomic():
+            kept = Service.objects.create(stack=self.stack, name="kept")
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                Service.objects.create(stack=self.stack, name="dropped")
+                raise RuntimeError()
+            with transaction.atomic():
+                released = Service.objects.create(stack=self.stack, name="released")
+
+        events = changes.get_events(after=cursor)
+        self.assertEqual([(event.model, event.object_id) for event in events], [
+            ("builder.Service", kept.pk),
+            ("builder.Service", released.pk),
+        ])
+
+    def test_rolled_back_changes_leave_no_events(self):
+        count = ChangeEvent.objects.count()
+
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                Service.objects.create(stack=self.stack, name="ledger")
+                self.report.command = "rolled back"
+                self.report.save()
+                raise RuntimeError()
+
+        self.assertEqual(ChangeEvent.objects.count(), count)
+
+    def test_cursors_page_through_every_event_in_order(self):
+        expected = [("builder.Stack", self.stack.pk), ("builder.Stack", self.other_stack.pk)]
+        expected += [("builder.Service", service.pk) for service in self.services]
+        expected += [("builder.Service", self.report.pk)]
+
+        pages = self._read_all(limit=3)
+
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual([event for page in pages for event in page], expected)
+
+    def test_cursors_can_follow_a_single_stack_or_model(self):
+        stack_events = [event for page in self._read_all(limit=2, stack_id=self.other_stack.pk) for event in page]
+        service_events = [event for page in self._read_all(limit=4, model="builder.Service") for event in page]
+
+        self.assertEqual(stack_events, [("builder.Stack", self.other_stack.pk), ("builder.Service", self.report.pk)])
+        self.assertEqual(service_events, [("builder.Service", service.pk) for service in self.services + [self.report]])
+
+    def test_reads_reject_bad_limits_and_untracked_models(self):
+        for arguments in ({"limit": 0}, {"limit": changes.MAX_LIMIT + 1}, {"model": "builder.Job"}):
+            with self.subTest(**arguments), self.assertRaises(ValueError):
+                changes.get_events(**arguments)
+
+
+class OverlayTests(TestCase):
+    def test_replaced_paths_take_the_upper_value(self):
+        merged = overlays.merge_services(
+            {"command": ["serve", "--port", "80"], "entrypoint": "/init", "healthcheck": {"test": ["CMD", "true"]}},
+            {"command": ["serve"], "entrypoint": ["/bin/sh", "-c"], "healthcheck": {"test": "exit 0", "retries": 3}}
+        )
+
+        self.assertEqual(merged, {
+            "command": ["serve"],
+            "entrypoint": ["/bin/sh", "-c"],
+            "healthcheck": {"test": "exit 0", "retries": 3},
+        })
+
+    def test_mappings_merge_whether_written_as_mappings_or_lists(self):
+        merged = overlays.merge_services(
+            {"environment": ["DEBUG=0", "REGION=eu", "EMPTY"], "build": {"args": {"VERSION": "1"}}},
+            {"environment": {"DEBUG": "1"}, "build": {"args": ["VERSION=2", "TARGET=prod"]}}
+        )
+
+        self.assertEqual(merged["environment"], {"DEBUG": "1", "REGION": "eu", "EMPTY": None})
+        self.assertEqual(merged["build"], {"args": {"VERSION": "2", "TARGET": "prod"}})
+
+    def test_named_sequences_merge_by_name_in_either_form(self):
+        merged = overlays.merge_services(
+            {
+                "networks": ["backend"],
+                "depends_on": ["database"],
+                "secrets": ["token", {"source": "key", "target": "key.pem"}],
+                "volumes": ["data:/var/lib/data", "./config:/etc/app:ro"],
+            },
+            {
+                "networks": {"backend": {"aliases": ["api"]}, "frontend": None},
+                "depends_on": {"database": {"condition": "service_healthy"}},
+                "secrets": [{"source": "token", "mode": "0440"}, {"source": "other-key", "target": "key.pem"}],
+                "volumes": [{"type": "volume", "source": "archive", "target": "/var/lib/data"}],
+            }
+        )
+
+        self.assertEqual(merged["networks"], {"backend": {"aliases": ["api"]}, "frontend": {}})
+        self.assertEqual(merged["depends_on"], {"database": {"condition": "service_healthy"}})
+        self.assertEqual(merged["secrets"], [
+            {"source": "token", "mode": "0440"},
+            {"source": "other-key", "target": "key.pem"},
+        ])
+        self.assertEqual(merged["volumes"], [
+            {"type": "volume", "source": "archive", "target": "/var/lib/data"},
+            "./config:/etc/app:ro",
+        ])
+
+    def test_other_lists_are_appended_without_repeats_and_builds_may_be_contexts(self):
+        merged = overlays.merge_services(
+            {"dns": ["1.1.1.1", "8.8.8.8"], "build": "./app"},
+            {"dns": ["8.8.8.8", "9.9.9.9"], "build": {"dockerfile": "Dockerfile-dev"}}
+        )
+
+        self.assertEqual(merged["dns"], ["1.1.1.1", "8.8.8.8", "9.9.9.9"])
+        self.assertEqual(merged["build"], {"context": "./app", "dockerfile": "Dockerfile-dev"})
+
+    def test_documents_merge_services_with_service_rules_and_leave_their_inputs_alone(self):
+        lower = {
+            "services": {"api": {"command": "serve", "labels": ["tier=web"]}, "worker": {"command": "work"}},
+            "networks": {"backend": {"driver": "overlay", "labels": {"team": "payments"}}},
+            "x-note": "lower",
+        }
+        upper = {
+            "services": {
+                "api": {"command": "serve --reload", "labels": {"debug": "true"}},
+                "cron": {"command": "tick"},
+            },
+            "networks": {"backend": {"labels": {"owner": "ops"}}},
+            "x-note": ["upper"],
+        }
+
+        merged = overlays.merge_documents(lower, upper)
+
+        self.assertEqual(merged, {
+            "services": {
+                "api": {"command": "serve --reload", "labels": {"tier": "web", "debug": "true"}},
+                "worker": {"command": "work"},
+                "cron": {"command": "tick"},
+            },
+            "networks": {"backend": {"driver": "overlay", "labels": {"team": "payments", "owner": "ops"}}},
+            "x-note": ["upper"],
+        })
+        self.assertEqual(lower["services"]["api"], {"command": "serve", "labels": ["tier=web"]})
+        self.assertEqual(lower["networks"]["backend"]["labels"], {"team": "payments"})
+
+    def test_resolved_services_follow_changes_to_what_they_extend(self):
+        stack = Stack.objects.create(name="payments")
+        base = Service.objects.create(stack=stack, name="base", command="serve", container_name="base")
+        api = Service.objects.create(stack=stack, name="api", extends=base, cpu_count=2)
+
+        self.assertEqual(overlays.resolve_service(api)["command"], "serve")
+
+        base.command = "serve --workers 4"
+        base.save(update_fields=["command"])
+
+        self.assertEqual(Service.objects.get(pk=base.pk).revision, base.revision)
+        self.assertEqual(overlays.resolve_service(Service.objects.get(pk=api.pk))["command"], "serve --workers 4")
+
+    def test_services_cant_extend_themselves(self):
+        stack = Stack.objects.create(name="payments")
+        base = Service.objects.create(stack=stack, name="base")
+        api = Service.objects.create(stack=stack, name="api", extends=base)
+
+        base.extends = api
+        with self.assertRaises(overlays.OverlayError):
+            base.save()
+
+
+class ValidationTests(TestCase):
+    document = {
+        "services": {
+            "api": {"image": "registry.example.com/api:1", "command": "serve"},
+            "worker": {"image": "registry.example.com/worker:1", "unknown_key": 1},
+        },
+        "networks": {"backend": {"driver": "overlay"}},
+    }
+
+    def test_fragments_that_were_seen_before_are_not_validated_again(self):
+        validator = validation.FragmentValidator()
+
+        first = validator.validate(self.document)
+        self.assertEqual((validator.hits, validator.misses), (0, 3))
+
+        # Fragments are remembered by their content, so the same values in a different order are still hits
+        reordered = {
+            "networks": {"backend": {"driver": "overlay"}},
+            "services": {
+                "worker": {"unknown_key": 1, "image": "registry.example.com/worker:1"},
+                "api": {"command": "serve", "image": "registry.example.com/api:1"},
+            },
+        }
+        self.assertEqual(
+            [str(problem) for problem in validator.validate(reordered)],
+            [str(problem) for problem in first]
+        )
+        self.assertEqual((validator.hits, validator.misses), (3, 3))
+
+        changed = json.loads(json.dumps(self.document))
+        changed["services"]["api"]["command"] = "serve --reload"
+        validator.validate(changed)
+        self.assertEqual((validator.hits, validator.misses), (5, 4))
+
+    def test_the_least_recently_used_outcomes_are_forgotten(self):
+        validator = validation.FragmentValidator(cache_size=2)
+
+        for command in ("one", "two", "three", "one"):
+            validator.validate_fragment("service", {"image": "app", "command": command})
+
+        self.assertEqual((validator.hits, validator.misses), (0, 4))
+
+    def test_problems_point_at_the_offending_fragment(self):
+        problems = validation.validate_document(self.document)
+
+        self.assertEqual([problem.value["path"] for problem in problems], ["services.worker"])
+        self.assertIn("'unknown_key'", problems[0].message)
+        self.assertEqual(
+            [str(problem) for problem in problems],
+            [str(problem) for problem in validation.validate_document(self.document, use_cache=False)]
+        )
+
+        with self.assertRaises(validation.ComposeValidationError) as context:
+            validation.assert_valid(self.document)
+        self.assertIn("services.worker:", str(context.exception))
+
+    def test_the_shape_of_the_document_is_checked_without_its_fragments(self):
+        cases = {
+            "misspelled section": ({"servics": {}}, ""),
+            "badly named member": ({"services": {"bad name!": {"image": "app"}}}, "services"),
+            "section of the wrong type": ({"services": []}, "services"),
+        }
+
+        for case, (document, path) in cases.items():
+            with self.subTest(case):
+                problems = validation.FragmentValidator().validate(document)
+                self.assertEqual([problem.value["path"] for problem in problems], [path])
+                self.assertEqual(
+                    [str(problem) for problem in problems],
+                    [str(problem) for problem in validation.validate_document(document, use_cache=False)]
+                )
+
+    def test_soft_deleted_stacks_cant_be_validated_or_previewed(self):
+        stack = Stack.objects.create(name="payments", deleted_at=timezone.now())
+
+        for name in ("builder:stack-validation", "builder:stack-preview"):
+            with self.subTest(name):
+                self.assertEqual(self.client.get(reverse(name, args=[stack.pk])).status_code, 404)
+
+
+class InstrumentationTests(TestCase):
+    def test_histograms_report_cumulative_buckets(self):
+        histogram = instrumentation.Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+
+        self.assertEqual(list(histogram.samples("latency", (("span", "render"),))), [
+            'latency_bucket{span="render",le="0.1"} 2',
+            'latency_bucket{span="render",le="1.0"} 3',
+            'latency_bucket{span="render",le="+Inf"} 4',
+            'latency_sum{span="render"} 3.65',
+            'latency_count{span="render"} 4',
+        ])
+
+    def test_registries_render_the_prometheus_text_format(self):
+        registry = instrumentation.MetricsRegistry()
+        registry.describe("requests_total", "counter", "Requests handled")
+        registry.increment("requests_total", view="builder:stack")
+        registry.increment("requests_total", 2, view='quoted "view"\n')
+        registry.observe("duration_seconds", 0.2, span="stack")
+        registry.register_collector(lambda: [("cache_hits_total", {"cache": "fragments"}, 5)])
+
+        lines = registry.render().splitlines()
+
+        self.assertEqual(lines[:2], ["# TYPE cache_hits_total counter", 'cache_hits_total{cache="fragments"} 5'])
+        self.assertEqual(lines[2:6], [
+            "# HELP requests_total Requests handled",
+            "# TYPE requests_total counter",
+            'requests_total{view="builder:stack"} 1',
+            r'requests_total{view="quoted \"view\"\n"} 2',
+        ])
+        self.assertEqual(lines[6], "# TYPE duration_seconds histogram")
+        self.assertIn('duration_seconds_bucket{span="stack",le="0.25"} 1', lines)
+        self.assertEqual(lines[-1], 'duration_seconds_count{span="stack"} 1')
+
+        registry.reset()
+        self.assertEqual(registry.render().splitlines(), lines[:2])
+
+    def test_functions_are_returned_unchanged_while_instrumentation_is_off(self):
+        def render():
+            return Stack.objects.count()
+
+        with mock.patch.object(application_settings, "METRICS_ENABLED", False):
+            self.assertIs(instrumentation.instrumented("test")(render), render)
+            self.assertIs(instrumentation.span("test"), instrumentation.span("other"))
+
+        self.addCleanup(instrumentation.REGISTRY.reset)
+        with mock.patch.object(application_settings, "METRICS_ENABLED", True):
+            instrumented_render = instrumentation.instrumented("test_render", count_queries=True)(render)
+            self.assertIsNot(instrumented_render, render)
+            self.assertEqual(instrumented_render(), 0)
+
+        metrics = instrumentation.REGISTRY.render()
+        self.assertIn(f'{instrumentation.SPAN_DURATION}_count{{span="test_render"}} 1', metrics)
+        self.assertIn(f'{instrumentation.SPAN_QUERIES}{{span="test_render"}} 1', metrics)
+
+    def test_responses_report_their_query_counts_when_asked(self):
+        stack = Stack.objects.create(name="payments")
+
+        with mock.patch.object(application_settings, "QUERY_COUNT_HEADER", True):
+            response = Client().get(reverse("builder:stack", args=[stack.pk]))
+        self.assertGreater(int(response[instrumentation.QUERY_COUNT_HEADER]), 0)
+
+        with mock.patch.object(application_settings, "QUERY_COUNT_HEADER", False):
+            response = Client().get(reverse("builder:stack", args=[stack.pk]))
+        self.assertNotIn(instrumentation.QUERY_COUNT_HEADER, response)
+
+    def test_metrics_are_only_served_while_instrumentation_is_on(self):
+        self.addCleanup(instrumentation.REGISTRY.reset)
+
+        with mock.patch.object(application_settings, "METRICS_ENABLED", False):
+            self.assertEqual(Client().get(reverse("metrics")).status_code, 404)
+
+        with mock.patch.object(application_settings, "METRICS_ENABLED", True):
+            client = Client()
+            client.get(reverse("builder:stacks"))
+            response = client.get(reverse("metrics"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertIn(f'{instrumentation.REQUESTS}{{view="builder:stacks"}} 1', response.content.decode())
+
+
+class SQLiteBackendTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "tuned.sqlite3")
+
+    def _connect(self, **options) -> sqlite_backend.DatabaseWrapper:
+        settings = {**connection.settings_dict, "ENGINE": application_settings.TUNED_SQLITE_ENGINE}
+        settings.update(NAME=self.path, OPTIONS=options)
+        wrapper = sqlite_backend.DatabaseWrapper(settings, alias="tuned")
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def _read_pragma(self, wrapper: sqlite_backend.DatabaseWrapper, pragma: str):
+        with wrapper.cursor() as cursor:
+            cursor.execute(f"PRAGMA {pragma}")
+            return cursor.fetchone()[0]
+
+    def test_pragmas_are_set_on_every_new_connection(self):
+        wrapper = self._connect(pragmas={"journal_mode": "WAL", "busy_timeout": 1234, "cache_size": -2048})
+
+        for _ in range(2):
+            self.assertEqual(self._read_pragma(wrapper, "journal_mode"), "wal")
+            self.assertEqual(self._read_pragma(wrapper, "busy_timeout"), 1234)
+            self.assertEqual(self._read_pragma(wrapper, "cache_size"), -2048)
+            wrapper.close()
+
+    def test_immediate_transactions_take_the_write_lock_as_they_begin(self):
+        wrapper = self._connect(transaction_mode="immediate")
+        wrapper.ensure_connection()
+        other = sqlite3.connect(self.path, timeout=0)
+        self.addCleanup(other.close)
+
+        connections["tuned"] = wrapper
+        self.addCleanup(delattr, connections._connections, "tuned")
+
+        with CaptureQueriesContext(wrapper) as queries, transaction.atomic(using="tuned"):
+            with self.assertRaisesRegex(sqlite3.OperationalError, "locked"):
+                other.execute("BEGIN IMMEDIATE")
+
+        self.assertEqual([query["sql"] for query in queries], ["BEGIN IMMEDIATE", "COMMIT"])
+        other.execute("BEGIN IMMEDIATE")
+        other.rollback()
+
+    def test_long_lived_connections_are_optimized_on_an_interval(self):
+        wrapper = self._connect(optimize_interval=60)
+        wrapper.ensure_connection()
+        now = sqlite_backend.time.monotonic()
+
+        with mock.patch.object(wrapper, "optimize") as optimize, mock.patch.object(sqlite_backend, "time") as clock:
+            clock.monotonic.return_value = now + 30
+            wrapper.cursor().close()
+            optimize.assert_not_called()
+
+            clock.monotonic.return_value = now + 61
+            wrapper.cursor().close()
+            optimize.assert_called_once_with()
+
+    def test_bad_options_are_rejected(self):
+        bad_options = (
+            {"transaction_mode": "eventually"},
+            {"pragmas": {"journal_mode": "WAL; DROP TABLE builder_stack"}},
+            {"pragmas": {"busy_timeout": "5000\n"}},
+            {"pragmas": {"busy_timeout": True}},
+            {"pragmas": {"journal_mode = WAL; --": "WAL"}},
+        )
+
+        for options in bad_options:
+            with self.subTest(**options), self.assertRaises(ImproperlyConfigured):
+                self._connect(**options)
+
+
+
+class FixtureTests(TransactionTestCase):
+    def setUp(self):
+        # Start from a database that is missing some of the builder's tables and the search index
+        self.addCleanup(setUpModule)
+        patcher = mock.patch.object(search, "_installed_indexes", set())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.index_table = f"{SearchDocument._meta.db_table}_fts"
+        with connection.cursor() as cursor:
+            for trigger in ("insert", "delete", "update"):
+                cursor.execute(f"DROP TRIGGER IF EXISTS {self.index_table}_{trigger}")
+            cursor.execute(f"DROP TABLE IF EXISTS {self.index_table}")
+
+        with connection.schema_editor() as editor:
+            editor.delete_model(ServiceAnnotation)
+
+    def test_fixtures_create_missing_tables_and_install_the_search_index(self):
+        stack_ids = fixtures.load_stacks(stacks=2, services=5)
+
+        tables = connection.introspection.table_names()
+        self.assertIn(ServiceAnnotation._meta.db_table, tables)
+        self.assertIn(self.index_table, tables)
 
-# Create your tests here.
+        names = Stack.objects.filter(pk__in=stack_ids).values_list("name", flat=True)
+        self.assertCountEqual(names, ["stack-0", "stack-1"])
+        for stack_id in stack_ids:
+            self.assertEqual(Service.objects.filter(stack_id=stack_id).count(), 5)
+            self.assertEqual(search.search("service", stack_id=stack_id).count, 5)
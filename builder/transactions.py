@@ -0,0 +1,150 @@
+"""
+Hooks for the moments in a transaction's life that `transaction.on_commit` doesn't reach
+
+Django can only run code after a transaction commits. The change feed has to write its events just before a
+transaction commits, and anything that gathers work within a transaction has to forget what was gathered within a
+savepoint that is rolled back. Listeners added here hear about both. Every connection's `commit`, `rollback`, `close`,
+`savepoint`, `savepoint_commit`, and `savepoint_rollback` methods, which `transaction.atomic` goes through, are wrapped
+as the connection is opened so that listeners are called along with them.
+"""
+from __future__ import annotations
+
+import functools
+import typing
+
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+class TransactionListener:
+    """
+    Follows the transactions of every connection. Each method does nothing unless it is overridden
+    """
+    def committing(self, connection: BaseDatabaseWrapper):
+        """
+        Called just before a transaction commits, while more can still be written within it
+
+        :param connection: The connection whose transaction is about to commit
+        """
+        pass
+
+    def ended(self, connection: BaseDatabaseWrapper):
+        """
+        Called once a transaction has committed or rolled back, or its connection was closed
+
+        :param connection: The connection whose transaction ended
+        """
+        pass
+
+    def savepoint_created(self, connection: BaseDatabaseWrapper, savepoint_id: str):
+        """
+        :param connection: The connection that created the savepoint
+        :param savepoint_id: The name of the new savepoint
+        """
+        pass
+
+    def savepoint_released(self, connection: BaseDatabaseWrapper, savepoint_id: str):
+        """
+        Called once a savepoint is released, which keeps whatever was done since it was created
+
+        :param connection: The connection that released the savepoint
+        :param savepoint_id: The name of the released savepoint
+        """
+        pass
+
+    def savepoint_rolled_back(self, connection: BaseDatabaseWrapper, savepoint_id: str):
+        """
+        Called once everything done since a savepoint was created has been undone
+
+        :param connection: The connection that rolled back to the savepoint
+        :param savepoint_id: The name of the savepoint that was rolled back to
+        """
+        pass
+
+
+_listeners: typing.List[TransactionListener] = []
+
+
+def add_listener(listener: TransactionListener) -> TransactionListener:
+    """
+    :param listener: Something to call for the transactions of every connection
+    :return: The listener
+    """
+    _listeners.append(listener)
+    return listener
+
+
+def _notify(method: str, connection: BaseDatabaseWrapper, *args):
+    for listener in _listeners:
+        getattr(listener, method)(connection, *args)
+
+
+def watch(connection: BaseDatabaseWrapper):
+    """
+    Call listeners along with the transactions of a connection. Connections are watched as they are opened, so this
+    only has to be called for a connection that may have been opened before this module was imported
+
+    :param connection: The connection to follow. Watching it again does nothing
+    """
+    if getattr(connection, "_transaction_listeners_installed", False):
+        return
+
+    connection._transaction_listeners_installed = True
+    commit = connection.commit
+    rollback = connection.rollback
+    close = connection.close
+    savepoint = connection.savepoint
+    savepoint_commit = connection.savepoint_commit
+    savepoint_rollback = connection.savepoint_rollback
+
+    @functools.wraps(commit)
+    def _commit():
+        try:
+            _notify("committing", connection)
+            commit()
+        finally:
+            _notify("ended", connection)
+
+    @functools.wraps(rollback)
+    def _rollback():
+        try:
+            rollback()
+        finally:
+            _notify("ended", connection)
+
+    @functools.wraps(close)
+    def _close():
+        try:
+            close()
+        finally:
+            _notify("ended", connection)
+
+    @functools.wraps(savepoint)
+    def _savepoint():
+        savepoint_id = savepoint()
+        if savepoint_id is not None:
+            _notify("savepoint_created", connection, savepoint_id)
+        return savepoint_id
+
+    @functools.wraps(savepoint_commit)
+    def _savepoint_commit(savepoint_id: str):
+        savepoint_commit(savepoint_id)
+        _notify("savepoint_released", connection, savepoint_id)
+
+    @functools.wraps(savepoint_rollback)
+    def _savepoint_rollback(savepoint_id: str):
+        savepoint_rollback(savepoint_id)
+        _notify("savepoint_rolled_back", connection, savepoint_id)
+
+    connection.commit = _commit
+    connection.rollback = _rollback
+    connection.close = _close
+    connection.savepoint = _savepoint
+    connection.savepoint_commit = _savepoint_commit
+    connection.savepoint_rollback = _savepoint_rollback
+
+
+@receiver(connection_created)
+def _connection_created(sender, connection: BaseDatabaseWrapper, **kwargs):
+    watch(connection)
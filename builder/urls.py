@@ -0,0 +1,32 @@
+"""
+URL configuration for the builder application
+"""
+from django.urls import path
+
+from builder import views
+
+app_name = "builder"
+
+urlpatterns = [
+    path('jobs/', views.enqueue_job, name="jobs"),
+    path('jobs/<int:job_id>/', views.job_detail, name="job"),
+    path('jobs/<int:job_id>/progress/', views.job_progress, name="job-progress"),
+    path('jobs/<int:job_id>/cancel/', views.cancel_job, name="job-cancel"),
+    path('stacks/', views.stack_list, name="stacks"),
+    path('stacks/<int:stack_id>/', views.stack_detail, name="stack"),
+    path('stacks/<int:stack_id>/validation/', views.validate_stack, name="stack-validation"),
+    path('stacks/<int:stack_id>/preview/', views.preview_stack, name="stack-preview"),
+    path('stacks/<int:stack_id>/clone/', views.clone_stack, name="stack-clone"),
+    path('stacks/<int:stack_id>/export/', views.export_stack, name="stack-export"),
+    path('stacks/<int:stack_id>/digests/', views.stack_digests, name="stack-digests"),
+    path('services/<int:service_id>/', views.service_detail, name="service"),
+    path('services/<int:service_id>/resolved/', views.resolved_service, name="service-resolved"),
+    path('services/<int:service_id>/clone/', views.clone_service, name="service-clone"),
+    path('networks/<int:network_id>/', views.network_detail, name="network"),
+    path('changes/', views.change_events, name="changes"),
+    path('changes/stream/', views.change_stream, name="change-stream"),
+    path('search/', views.search_services, name="search"),
+    path('secrets/unused/', views.unused_secrets, name="unused-secrets"),
+    path('secrets/undeclared/', views.undeclared_secrets, name="undeclared-secrets"),
+    path('secrets/<str:source>/consumers/', views.secret_consumers, name="secret-consumers"),
+]
@@ -0,0 +1,285 @@
+"""
+Checks rendered compose documents against a bundled copy of the compose specification's JSON schema
+
+Validators are compiled once per process. Documents are split into fragments (each service, network, volume, secret,
+and config) and the outcome of validating each fragment is cached by the fragment's content, so re-validating a
+document only does real work for the fragments that changed.
+"""
+from __future__ import annotations
+
+import functools
+import json
+import re
+import threading
+import typing
+
+from collections import OrderedDict
+from pathlib import Path
+
+import jsonschema
+
+from builder import instrumentation
+from builder import serialization
+
+SCHEMA_PATH = Path(__file__).resolve().parent / "schemas" / "compose-spec.json"
+"""Where the bundled copy of the compose specification's schema lives"""
+
+FRAGMENT_DEFINITIONS: typing.Mapping[str, str] = {
+    "services": "service",
+    "networks": "network",
+    "volumes": "volume",
+    "secrets": "secret",
+    "configs": "config",
+}
+"""Top level sections of a compose document mapped to the schema definition for each of their members"""
+
+FRAGMENT_CACHE_SIZE = 10000
+"""The maximum number of fragment outcomes to remember"""
+
+
+class ValidationProblem:
+    """
+    A single way in which a compose document breaks the compose specification
+    """
+    def __init__(self, path: typing.Sequence[typing.Union[str, int]], message: str):
+        """
+        :param path: The keys leading to the offending value
+        :param message: A description of what is wrong
+        """
+        self.path = tuple(path)
+        self.message = message
+
+    def relative_to(self, *prefix: typing.Union[str, int]) -> ValidationProblem:
+        """
+        :param prefix: Keys to place in front of this problem's path
+        :return: A copy of this problem whose path starts with the given prefix
+        """
+        return ValidationProblem(path=prefix + self.path, message=self.message)
+
+    @property
+    def value(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "path": ".".join(str(key) for key in self.path),
+            "message": self.message,
+        }
+
+    def __str__(self):
+        location = ".".join(str(key) for key in self.path) or "<document>"
+        return f"{location}: {self.message}"
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self})"
+
+
+class ComposeValidationError(ValueError):
+    """
+    Raised when a rendered compose document does not follow the compose specification
+    """
+    def __init__(self, problems: typing.Sequence[ValidationProblem], environment: typing.Optional[str] = None):
+        """
+        :param problems: Everything that is wrong with the document
+        :param environment: The name of the environment that the document was resolved against, if any
+        """
+        self.problems = list(problems)
+        self.environment = environment
+        if environment:
+            subject = f"The compose document resolved against '{environment}'"
+        else:
+            subject = "The rendered compose document"
+        super().__init__(f"{subject} is not valid:\n" + "\n".join(f"    {problem}" for problem in self.problems))
+
+
+@functools.lru_cache(maxsize=None)
+def get_schema() -> typing.Dict[str, typing.Any]:
+    """
+    :return: The bundled compose specification schema
+    """
+    with SCHEMA_PATH.open() as schema_file:
+        schema = json.load(schema_file)
+
+    jsonschema.validators.validator_for(schema).check_schema(schema)
+    return schema
+
+
+@functools.lru_cache(maxsize=None)
+def get_validator(definition: str = None) -> jsonschema.protocols.Validator:
+    """
+    Get a compiled validator for either a whole document or for one of the schema's definitions
+
+    :param definition: The name of the definition to validate against, like 'service'. The whole document if None
+    :return: A validator that is shared for the life of the process
+    """
+    schema = get_schema()
+    validator_class = jsonschema.validators.validator_for(schema)
+
+    if definition is not None:
+        if definition not in schema["definitions"]:
+            raise KeyError(f"The compose specification has no definition named '{definition}'")
+
+        schema = {
+            "$schema": schema["$schema"],
+            "$ref": f"#/definitions/{definition}",
+            "definitions": schema["definitions"],
+        }
+
+    return validator_class(schema)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_name_patterns(section: str) -> typing.Tuple[re.Pattern, ...]:
+    """
+    :param section: A top level section of a compose document, like 'services'
+    :return: The patterns that the names of the section's members are checked against
+    """
+    return tuple(
+        re.compile(pattern)
+        for pattern in get_schema()["properties"][section].get("patternProperties", {})
+    )
+
+
+def _collect_problems(
+    validator: jsonschema.protocols.Validator,
+    instance: typing.Any
+) -> typing.Tuple[ValidationProblem, ...]:
+    return tuple(
+        ValidationProblem(path=error.absolute_path, message=error.message)
+        for error in sorted(validator.iter_errors(instance), key=lambda error: list(map(str, error.absolute_path)))
+    )
+
+
+def get_fragment_digest(fragment: typing.Any) -> str:
+    """
+    :param fragment: A JSON serializable portion of a compose document
+    :return: A value that will be the same for any fragment with the same content
+    """
+    return serialization.get_digest(fragment)
+
+
+class FragmentValidator:
+    """
+    Validates compose documents one fragment at a time, remembering the outcome for fragments that have been seen
+    """
+    def __init__(self, cache_size: int = FRAGMENT_CACHE_SIZE):
+        """
+        :param cache_size: The maximum number of fragment outcomes to remember
+        """
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._outcomes: typing.OrderedDict[typing.Tuple[str, str], typing.Tuple[ValidationProblem, ...]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """
+        Forget every remembered outcome
+        """
+        with self._lock:
+            self._outcomes.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def validate_fragment(self, definition: str, fragment: typing.Any) -> typing.Tuple[ValidationProblem, ...]:
+        """
+        :param definition: The name of the schema definition that the fragment must follow, like 'service'
+        :param fragment: The fragment to validate
+        :return: Every problem found within the fragment, with paths relative to the fragment
+        """
+        key = (definition, get_fragment_digest(fragment))
+
+        with self._lock:
+            if key in self._outcomes:
+                self._outcomes.move_to_end(key)
+                self.hits += 1
+                return self._outcomes[key]
+
+        problems = _collect_problems(get_validator(definition), fragment)
+
+        with self._lock:
+            self.misses += 1
+            self._outcomes[key] = problems
+            while len(self._outcomes) > self.cache_size:
+                self._outcomes.popitem(last=False)
+
+        return problems
+
+    def validate(self, document: typing.Dict[str, typing.Any]) -> typing.List[ValidationProblem]:
+        """
+        :param document: A full compose document
+        :return: Every problem found within the document
+        """
+        if not isinstance(document, dict):
+            return list(_collect_problems(get_validator(), document))
+
+        # Fragments are validated on their own, so the document's overall shape is checked without them. Members
+        # whose names don't fit the specification are kept so that the badly named members are still reported
+        skeleton = dict(document)
+        fragments: typing.List[typing.Tuple[str, str, str, typing.Any]] = []
+
+        for section, definition in FRAGMENT_DEFINITIONS.items():
+            members = document.get(section)
+            if isinstance(members, dict):
+                name_patterns = _get_name_patterns(section)
+                skeleton[section] = {
+                    name: None
+                    for name in members
+                    if not any(pattern.search(name) for pattern in name_patterns)
+                }
+                fragments.extend((section, definition, name, fragment) for name, fragment in members.items())
+
+        problems = list(_collect_problems(get_validator(), skeleton))
+
+        for section, definition, name, fragment in fragments:
+            problems.extend(
+                problem.relative_to(section, name)
+                for problem in self.validate_fragment(definition, fragment)
+            )
+
+        return problems
+
+
+_fragment_validator = FragmentValidator()
+
+
+def _report_cache_usage() -> typing.Iterable[instrumentation.SAMPLE]:
+    labels = {"cache": "validation_fragments"}
+    yield instrumentation.CACHE_HITS, labels, _fragment_validator.hits
+    yield instrumentation.CACHE_MISSES, labels, _fragment_validator.misses
+
+
+instrumentation.REGISTRY.register_collector(_report_cache_usage)
+
+
+def get_fragment_validator() -> FragmentValidator:
+    """
+    :return: The fragment validator shared by the whole process
+    """
+    return _fragment_validator
+
+
+@instrumentation.instrumented("validation")
+def validate_document(document: typing.Dict[str, typing.Any], use_cache: bool = True) -> typing.List[ValidationProblem]:
+    """
+    Find every way that a compose document breaks the compose specification
+
+    :param document: The compose document to check
+    :param use_cache: Whether to reuse the outcome of validating fragments that have been seen before
+    :return: Every problem found within the document
+    """
+    if use_cache:
+        return _fragment_validator.validate(document)
+
+    return list(_collect_problems(get_validator(), document))
+
+
+def assert_valid(document: typing.Dict[str, typing.Any], use_cache: bool = True):
+    """
+    Ensure that a compose document follows the compose specification
+
+    :param document: The compose document to check
+    :param use_cache: Whether to reuse the outcome of validating fragments that have been seen before
+    :raises ComposeValidationError: if the document is not valid
+    """
+    problems = validate_document(document, use_cache=use_cache)
+
+    if problems:
+        raise ComposeValidationError(problems)
@@ -1,3 +1,670 @@
-from django.shortcuts import render
+"""
+HTTP endpoints for the builder application
+"""
+from __future__ import annotations
 
-# Create your views here.
+import functools
+import hmac
+import json
+import time
+import typing
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import Q
+from django.http import Http404
+from django.http import HttpRequest
+from django.http import HttpResponse
+from django.http import HttpResponseNotModified
+from django.http import JsonResponse
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.http import require_GET
+from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_http_methods
+
+import utils
+
+from SwarmCompose import application_settings
+
+from builder import changes
+from builder import cloning
+from builder import instrumentation
+from builder import interpolation
+from builder import jobs
+from builder import overlays
+from builder import search
+from builder import secret_usage
+from builder import serialization
+from builder import teardown
+from builder import validation
+from builder.models import EnvironmentProfile
+from builder.models import Job
+from builder.models import Network
+from builder.models import Service
+from builder.models import Stack
+
+DEFAULT_PAGE_SIZE = 25
+"""The number of rows on a page of a listing that doesn't ask for a specific number"""
+
+MAX_PAGE_SIZE = 100
+"""The largest number of rows that may be on a page of a listing"""
+
+
+SAFE_METHODS: typing.FrozenSet[str] = frozenset({"GET", "HEAD", "OPTIONS"})
+"""HTTP methods that never change data"""
+
+
+def _has_api_token(request: HttpRequest) -> bool:
+    """
+    :param request: A request that may carry an `Authorization` header
+    :return: Whether the request carries the `API_TOKEN` application setting as a bearer token
+    """
+    if not application_settings.API_TOKEN:
+        return False
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(
+        token.strip().encode(),
+        application_settings.API_TOKEN.encode()
+    )
+
+
+def write_access_required(view: typing.Callable[..., HttpResponse]) -> typing.Callable[..., HttpResponse]:
+    """
+    Only let requests that may change data through to a view. Requests with safe methods, like GET, always get through
+
+    Requests may either carry the API token, which browsers never send on their own and so skips the CSRF check, or
+    come from the session of a signed in staff member, which has to pass the CSRF check
+
+    :param view: The view to protect
+    :return: The protected view
+    """
+    protected_view = csrf_protect(view)
+
+    @functools.wraps(view)
+    def wrapper(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        if request.method in SAFE_METHODS or _has_api_token(request):
+            return view(request, *args, **kwargs)
+
+        user = getattr(request, "user", None)
+        if user is None or not user.is_authenticated:
+            return JsonResponse({"error": "Sign in or send an API token to change data"}, status=401)
+
+        if not user.is_staff:
+            return JsonResponse({"error": "Only staff members may change data"}, status=403)
+
+        return protected_view(request, *args, **kwargs)
+
+    return csrf_exempt(wrapper)
+
+
+def _get_soft_delete(request: HttpRequest) -> typing.Optional[bool]:
+    """
+    :param request: A request that may carry a `soft` query parameter
+    :return: Whether the request asked for a soft delete. None if it didn't say
+    """
+    if "soft" not in request.GET:
+        return None
+    return utils.is_true(request.GET["soft"])
+
+
+def _deletion_response(counts: teardown.DELETION_COUNTS) -> JsonResponse:
+    total, models = counts
+    return JsonResponse({"deleted": total, "models": models})
+
+
+def _read_json(request: HttpRequest) -> typing.Dict[str, typing.Any]:
+    """
+    Read the body of a request as a JSON object
+
+    :param request: The request whose body to read
+    :return: The parsed body. An empty dictionary if there was no body
+    """
+    if not request.body:
+        return {}
+
+    payload = json.loads(request.body)
+
+    if not isinstance(payload, dict):
+        raise ValueError("The body of the request must be a JSON object")
+
+    return payload
+
+
+@write_access_required
+@require_POST
+def enqueue_job(request: HttpRequest) -> JsonResponse:
+    """
+    Add a job to the background queue and return immediately with where to check on it
+
+    Only the job types named by the `WEB_JOB_TYPES` application setting may be enqueued this way
+    """
+    try:
+        payload = _read_json(request)
+        job_type = payload["job_type"]
+
+        if job_type not in application_settings.WEB_JOB_TYPES:
+            return JsonResponse({"error": f"Jobs of type '{job_type}' can't be enqueued through the API"}, status=403)
+
+        job = jobs.enqueue(
+            job_type,
+            delay=float(payload.get("delay", 0.0)),
+            **payload.get("arguments", {})
+        )
+    except jobs.UnknownJobType as error:
+        return JsonResponse({"error": error.args[0]}, status=400)
+    except KeyError as error:
+        return JsonResponse({"error": f"'{error.args[0]}' is required"}, status=400)
+    except (TypeError, ValueError) as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    response = job.value
+    response["status_url"] = reverse("builder:job", args=[job.pk])
+    response["progress_url"] = reverse("builder:job-progress", args=[job.pk])
+    return JsonResponse(response, status=202)
+
+
+@require_GET
+def job_detail(request: HttpRequest, job_id: int) -> JsonResponse:
+    """
+    Get the status, and result if finished, of a job
+    """
+    job = get_object_or_404(Job, pk=job_id)
+    return JsonResponse(job.value)
+
+
+@require_GET
+def job_progress(request: HttpRequest, job_id: int) -> JsonResponse:
+    """
+    Get a lightweight description of how far along a job is
+    """
+    job = get_object_or_404(Job.objects.only("status", "progress", "progress_message"), pk=job_id)
+    return JsonResponse(job.progress_value)
+
+
+@write_access_required
+@require_POST
+def cancel_job(request: HttpRequest, job_id: int) -> JsonResponse:
+    """
+    Cancel a job that has not been started yet
+    """
+    job = get_object_or_404(Job, pk=job_id)
+
+    if not jobs.cancel_job(job):
+        return JsonResponse({"error": f"Job {job.pk} is {job.status} and can no longer be cancelled"}, status=409)
+
+    return JsonResponse(job.value)
+
+
+@require_GET
+def validate_stack(request: HttpRequest, stack_id: int) -> JsonResponse:
+    """
+    Check the rendered compose document for a stack against the compose specification
+    """
+    stack = get_object_or_404(Stack.objects.alive(), pk=stack_id)
+    problems = validation.validate_document(stack.render(validate=False))
+    return JsonResponse({
+        "valid": not problems,
+        "problems": [problem.value for problem in problems],
+    })
+
+
+@require_GET
+def metrics(request: HttpRequest) -> HttpResponse:
+    """
+    Report every recorded metric in the Prometheus text format
+    """
+    if not instrumentation.is_enabled():
+        raise Http404("Metrics are not enabled")
+
+    return HttpResponse(instrumentation.REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@require_GET
+def preview_stack(request: HttpRequest, stack_id: int) -> JsonResponse:
+    """
+    Show the compose document for a stack resolved against one or more environment profiles
+
+    Profiles are chosen with repeated `environment` query parameters. Every profile is used if none are given.
+    """
+    stack = get_object_or_404(Stack.objects.alive(), pk=stack_id)
+    requested_names = request.GET.getlist("environment")
+
+    profiles = EnvironmentProfile.objects.prefetch_related("variables").order_by("name")
+    if requested_names:
+        profiles = profiles.filter(name__in=requested_names)
+
+    environments = {profile.name: profile.value for profile in profiles}
+
+    missing_names = sorted(set(requested_names).difference(environments))
+    if missing_names:
+        return JsonResponse({"error": f"Unknown environment profiles: {', '.join(missing_names)}"}, status=404)
+
+    try:
+        documents = stack.preview(environments)
+    except interpolation.InterpolationError as error:
+        return JsonResponse(
+            {"error": error.message, "environment": error.environment, "path": ".".join(map(str, error.path))},
+            status=400
+        )
+    except validation.ComposeValidationError as error:
+        return JsonResponse({"error": str(error), "environment": error.environment}, status=400)
+
+    return JsonResponse({"environments": documents})
+
+
+@write_access_required
+@require_POST
+def clone_stack(request: HttpRequest, stack_id: int) -> JsonResponse:
+    """
+    Copy a stack along with everything that belongs to it
+    """
+    stack = get_object_or_404(Stack.objects.alive(), pk=stack_id)
+
+    try:
+        payload = _read_json(request)
+        new_stack = cloning.clone_stack(stack, name=payload["name"], prefix=payload.get("prefix", ""))
+    except KeyError as error:
+        return JsonResponse({"error": f"'{error.args[0]}' is required"}, status=400)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+    except IntegrityError:
+        return JsonResponse({"error": f"A stack named '{payload['name']}' already exists"}, status=409)
+
+    return JsonResponse({"id": new_stack.pk, "name": new_stack.name}, status=201)
+
+
+@write_access_required
+@require_POST
+def clone_service(request: HttpRequest, service_id: int) -> JsonResponse:
+    """
+    Copy a service along with everything that belongs to it, optionally into another stack
+    """
+    service = get_object_or_404(Service.objects.alive(), pk=service_id)
+
+    try:
+        payload = _read_json(request)
+        stack = get_object_or_404(Stack.objects.alive(), pk=payload["stack"]) if "stack" in payload else None
+        new_service = cloning.clone_service(
+            service,
+            name=payload.get("name"),
+            prefix=payload.get("prefix", ""),
+            stack=stack
+        )
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+    except IntegrityError:
+        return JsonResponse({"error": "A service with that name already exists in the stack"}, status=409)
+
+    return JsonResponse({"id": new_service.pk, "name": new_service.name, "stack": new_service.stack_id}, status=201)
+
+
+@require_GET
+def stack_list(request: HttpRequest) -> JsonResponse:
+    """
+    List live stacks by name, split into pages with the `page` and `page_size` query parameters
+    """
+    try:
+        page = int(request.GET.get("page", 1))
+        page_size = int(request.GET.get("page_size", DEFAULT_PAGE_SIZE))
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    if page < 1 or not 1 <= page_size <= MAX_PAGE_SIZE:
+        return JsonResponse(
+            {"error": f"page must be at least 1 and page_size must be between 1 and {MAX_PAGE_SIZE}"},
+            status=400
+        )
+
+    stacks = Stack.objects.alive().order_by("name", "pk").annotate(
+        service_count=Count("services", filter=Q(services__deleted_at__isnull=True))
+    )
+    total = stacks.count()
+    offset = (page - 1) * page_size
+
+    return JsonResponse({
+        "page": page,
+        "page_size": page_size,
+        "total": total,
+        "stacks": [
+            {
+                "id": stack.pk,
+                "name": stack.name,
+                "description": stack.description,
+                "base": stack.base_id,
+                "services": stack.service_count,
+            }
+            for stack in stacks[offset:offset + page_size]
+        ],
+    })
+
+
+@write_access_required
+@require_http_methods(["GET", "DELETE"])
+def stack_detail(request: HttpRequest, stack_id: int) -> JsonResponse:
+    """
+    Describe a stack and list what is within it, or delete it along with everything within it. Pass `?soft=true` to
+    only mark it for deletion
+    """
+    stack = get_object_or_404(Stack.objects.alive(), pk=stack_id)
+
+    if request.method == "DELETE":
+        return _deletion_response(
+            teardown.delete_stacks(Stack.objects.filter(pk=stack.pk), soft=_get_soft_delete(request))
+        )
+
+    return JsonResponse({
+        "id": stack.pk,
+        "name": stack.name,
+        "description": stack.description,
+        "base": stack.base_id,
+        "services": [
+            {"id": primary_key, "name": name}
+            for primary_key, name in stack.services.alive().order_by("name").values_list("pk", "name")
+        ],
+        "networks": [
+            {"id": primary_key, "name": name}
+            for primary_key, name in stack.networks.alive().values_list("pk", "name")
+        ],
+        "secrets": list(stack.secrets.order_by("name").values_list("name", flat=True)),
+    })
+
+
+def _edit_service(request: HttpRequest, service: Service) -> JsonResponse:
+    """
+    Change the fields of a service named in the body of a request
+    """
+    try:
+        payload = _read_json(request)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    editable = {
+        field.name
+        for field in Service._meta.concrete_fields
+        if field.editable and not field.is_relation and not field.primary_key and field.name != "deleted_at"
+    }
+    unknown = sorted(set(payload).difference(editable))
+
+    if unknown:
+        return JsonResponse({"error": f"These fields can't be edited: {', '.join(unknown)}"}, status=400)
+
+    if not payload:
+        return JsonResponse({"error": "Name at least one field to change"}, status=400)
+
+    for name, value in payload.items():
+        setattr(service, name, value)
+
+    try:
+        service.clean_fields(exclude=[field.name for field in Service._meta.fields if field.name not in payload])
+        # A clash with another service's name has to leave any transaction that the request runs within usable
+        with transaction.atomic():
+            service.save(update_fields=list(payload))
+    except ValidationError as error:
+        return JsonResponse({"error": error.message_dict}, status=400)
+    except IntegrityError:
+        return JsonResponse({"error": "A service with that name already exists in the stack"}, status=409)
+
+    return JsonResponse({"id": service.pk, "name": service.name, "stack": service.stack_id})
+
+
+@write_access_required
+@require_http_methods(["GET", "PATCH", "DELETE"])
+def service_detail(request: HttpRequest, service_id: int) -> JsonResponse:
+    """
+    Show a service's configuration, change some of its fields, or delete it along with everything that belongs to it.
+    Pass `?soft=true` when deleting to only mark it for deletion
+    """
+    if request.method == "DELETE":
+        service = get_object_or_404(Service.objects.alive(), pk=service_id)
+        return _deletion_response(
+            teardown.delete_services(Service.objects.filter(pk=service.pk), soft=_get_soft_delete(request))
+        )
+
+    if request.method == "PATCH":
+        return _edit_service(request, get_object_or_404(Service.objects.alive(), pk=service_id))
+
+    service = get_object_or_404(Service.objects.alive().for_rendering(), pk=service_id)
+    return JsonResponse({
+        "id": service.pk,
+        "name": service.name,
+        "stack": service.stack_id,
+        "extends": service.extends_id,
+        "configuration": service.value,
+    })
+
+
+@write_access_required
+@require_http_methods(["DELETE"])
+def network_detail(request: HttpRequest, network_id: int) -> JsonResponse:
+    """
+    Delete a network and everything that belongs to it. Pass `?soft=true` to only mark it for deletion
+    """
+    network = get_object_or_404(Network.objects.alive(), pk=network_id)
+    return _deletion_response(
+        teardown.delete_networks(Network.objects.filter(pk=network.pk), soft=_get_soft_delete(request))
+    )
+
+
+@require_GET
+def resolved_service(request: HttpRequest, service_id: int) -> JsonResponse:
+    """
+    Show the effective configuration of a service, merged over the configuration of every service it extends
+    """
+    service = get_object_or_404(Service.objects.alive(), pk=service_id)
+
+    try:
+        configuration = overlays.resolve_service(service)
+    except overlays.OverlayError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    return JsonResponse({"service": service.name, "configuration": configuration})
+
+
+@require_GET
+def search_services(request: HttpRequest) -> JsonResponse:
+    """
+    Find services whose names, commands, builds, labels, or annotations contain every term in `q`
+
+    Results are ranked best first and split into pages with the `page` and `page_size` query parameters. Pass `stack`
+    to only search within one stack.
+    """
+    try:
+        page = int(request.GET.get("page", 1))
+        page_size = int(request.GET.get("page_size", search.DEFAULT_PAGE_SIZE))
+        stack_id = _get_stack_filter(request)
+        results = search.search(request.GET.get("q", ""), page=page, page_size=page_size, stack_id=stack_id)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    return JsonResponse(results.value)
+
+
+def _get_stack_filter(request: HttpRequest) -> typing.Optional[int]:
+    """
+    :param request: A request that may carry a `stack` query parameter
+    :return: The primary key of the stack to limit results to. None if every stack should be included
+    """
+    return int(request.GET["stack"]) if "stack" in request.GET else None
+
+
+@require_GET
+def secret_consumers(request: HttpRequest, source: str) -> JsonResponse:
+    """
+    List every service and build that uses a secret, like before rotating it. Pass `stack` to only look in one stack
+    """
+    try:
+        stack_id = _get_stack_filter(request)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    return JsonResponse({
+        "secret": source,
+        "consumers": [usage.value for usage in secret_usage.find_consumers(source, stack_id=stack_id)],
+    })
+
+
+@require_GET
+def unused_secrets(request: HttpRequest) -> JsonResponse:
+    """
+    List secrets that are declared by a stack but never used within it. Pass `stack` to only look in one stack
+    """
+    try:
+        stack_id = _get_stack_filter(request)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    return JsonResponse({
+        "secrets": [
+            {"stack": secret.stack_id, "stack_name": secret.stack.name, "secret": secret.name}
+            for secret in secret_usage.find_unused_secrets(stack_id=stack_id)
+        ]
+    })
+
+
+@require_GET
+def undeclared_secrets(request: HttpRequest) -> JsonResponse:
+    """
+    List secrets that are used within a stack that neither it nor a stack it is layered on declares. Pass `stack` to
+    only look in one stack
+    """
+    try:
+        stack_id = _get_stack_filter(request)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    return JsonResponse({
+        "secrets": [secret.value for secret in secret_usage.find_undeclared_secrets(stack_id=stack_id)]
+    })
+
+
+@require_GET
+def export_stack(request: HttpRequest, stack_id: int) -> HttpResponse:
+    """
+    Download the canonical compose document for a stack
+
+    `format` may be 'yaml', the default, or 'json'. The same stack content always produces the same bytes, and the
+    document's digest is sent as its ETag so that unchanged documents are answered with a 304 when the ETag is sent
+    back through `If-None-Match`.
+    """
+    stack = get_object_or_404(Stack.objects.alive(), pk=stack_id)
+    output_format = request.GET.get("format", "yaml")
+
+    if output_format not in serialization.get_formats():
+        return JsonResponse(
+            {"error": f"Unknown format '{output_format}'. Use one of: {', '.join(serialization.get_formats())}"},
+            status=400
+        )
+
+    try:
+        document = stack.render()
+    except validation.ComposeValidationError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    etag = f'"{serialization.get_digest(document)}"'
+
+    if etag in request.headers.get("If-None-Match", ""):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(
+            serialization.encode(document, format=output_format),
+            content_type=serialization.get_content_type(output_format)
+        )
+        response["Content-Disposition"] = f'attachment; filename="{stack.name}.{output_format}"'
+
+    response["ETag"] = etag
+    return response
+
+
+@require_GET
+def stack_digests(request: HttpRequest, stack_id: int) -> JsonResponse:
+    """
+    Show the SHA-256 digest of a stack's canonical compose document and of each service, network, and secret within it
+    """
+    stack = get_object_or_404(Stack.objects.alive(), pk=stack_id)
+    return JsonResponse(serialization.get_digests(stack.render(validate=False)))
+
+
+def _get_change_cursor(request: HttpRequest) -> int:
+    """
+    :param request: A request that may carry an `after` query parameter or a `Last-Event-ID` header
+    :return: The primary key of the last event that the client has already processed
+    """
+    return int(request.headers.get("Last-Event-ID") or request.GET.get("after", 0))
+
+
+@require_GET
+def change_events(request: HttpRequest) -> JsonResponse:
+    """
+    Read the change feed from a cursor
+
+    Returns up to `limit` events recorded after the event whose id is `after`, along with the cursor to pass as `after`
+    next time. Pass `stack` or `model`, like 'builder.Service', to only include some events. Pass `wait` to hold the
+    request open for up to that many seconds until there is something to return.
+    """
+    try:
+        after = _get_change_cursor(request)
+        events = changes.wait_for_events(
+            after=after,
+            timeout=float(request.GET.get("wait", 0)),
+            limit=int(request.GET.get("limit", changes.DEFAULT_LIMIT)),
+            stack_id=_get_stack_filter(request),
+            model=request.GET.get("model")
+        )
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    return JsonResponse({
+        "events": [event.value for event in events],
+        "cursor": events[-1].pk if events else after,
+    })
+
+
+def _stream_changes(after: int, stack_id: typing.Optional[int], model: typing.Optional[str]) -> typing.Iterator[str]:
+    """
+    :return: Server sent events for everything recorded after the cursor, until the stream's time is up
+    """
+    deadline = time.monotonic() + application_settings.CHANGE_FEED_STREAM_DURATION
+    yield f"retry: {int(application_settings.CHANGE_FEED_POLL_INTERVAL * 1000)}\n\n"
+
+    while time.monotonic() < deadline:
+        timeout = min(application_settings.CHANGE_FEED_KEEPALIVE, deadline - time.monotonic())
+        events = changes.wait_for_events(after=after, timeout=timeout, stack_id=stack_id, model=model)
+
+        if not events:
+            yield ": keep-alive\n\n"
+            continue
+
+        for event in events:
+            yield f"id: {event.pk}\nevent: {event.action}\ndata: {json.dumps(event.value)}\n\n"
+        after = events[-1].pk
+
+
+@require_GET
+def change_stream(request: HttpRequest) -> HttpResponse:
+    """
+    Follow the change feed as server sent events
+
+    Each event's id is its cursor, so a client that reconnects with `Last-Event-ID` carries on where it left off.
+    Accepts `after`, `stack`, and `model` like the change feed itself. The stream ends after
+    `CHANGE_FEED_STREAM_DURATION` seconds and holds a worker for as long as it is open.
+    """
+    try:
+        after = _get_change_cursor(request)
+        stack_id = _get_stack_filter(request)
+        model = request.GET.get("model")
+        # Bad filters are reported before the stream starts, while there is still a status code to send
+        changes.get_events(after=after, limit=1, stack_id=stack_id, model=model)
+    except ValueError as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    response = StreamingHttpResponse(_stream_changes(after, stack_id, model), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response